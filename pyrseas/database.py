@@ -23,6 +23,7 @@ from pyrseas.dbobject.operator import OperatorDict
 from pyrseas.dbobject.rule import RuleDict
 from pyrseas.dbobject.trigger import TriggerDict
 from pyrseas.dbobject.conversion import ConversionDict
+from pyrseas.plan import merge_alter_table
 
 
 def flatten(lst):
@@ -67,6 +68,17 @@ class Database(object):
         """
         self.dbconn = dbconn
         self.db = None
+        self.type_changes = []
+
+    def _start(self, phase):
+        "Start timing a phase, if the connection has a profiler"
+        if self.dbconn and self.dbconn.profiler:
+            self.dbconn.profiler.start(phase)
+
+    def _stop(self, rows=None):
+        "Stop timing the current phase, if the connection has a profiler"
+        if self.dbconn and self.dbconn.profiler:
+            self.dbconn.profiler.stop(rows)
 
     def _link_refs(self, db):
         """Link related objects"""
@@ -85,10 +97,13 @@ class Database(object):
         dictionary are then linked to related objects, e.g., columns
         are linked to the tables they belong.
         """
+        self._start('from_catalog')
         self.db = self.Dicts(self.dbconn)
-        if self.dbconn.conn:
-            self.dbconn.conn.close()
+        self.dbconn.close()
+        self._start('link_refs')
         self._link_refs(self.db)
+        self._stop()
+        self._stop()
 
     def from_map(self, input_map):
         """Populate the new database objects from the input map
@@ -100,6 +115,7 @@ class Database(object):
         dictionary are then linked to related objects, e.g., columns
         are linked to the tables they belong.
         """
+        self._start('from_map')
         self.ndb = self.Dicts()
         input_schemas = {}
         input_langs = {}
@@ -116,42 +132,68 @@ class Database(object):
         self.ndb.languages.from_map(input_langs)
         self.ndb.schemas.from_map(input_schemas, self.ndb)
         self.ndb.casts.from_map(input_casts, self.ndb)
+        self._start('link_refs')
         self._link_refs(self.ndb)
+        self._stop()
+        self._stop()
 
     def to_map(self):
         """Convert the db maps to a single hierarchy suitable for YAML
 
         :return: a YAML-suitable dictionary (without Python objects)
+
+        Definitions fetched from the catalogs as hashes are first
+        fetched in full.
         """
         if not self.db:
             self.from_catalog()
+        self.db.functions.fetch_bodies()
+        self.db.tables.fetch_bodies()
+        self._start('to_map')
         dbmap = self.db.languages.to_map()
         dbmap.update(self.db.casts.to_map())
         dbmap.update(self.db.schemas.to_map())
+        self._stop()
         return dbmap
 
-    def diff_map(self, input_map):
+    def diff_map(self, input_map, online=False):
         """Generate SQL to transform an existing database
 
         :param input_map: a YAML map defining the new database
+        :param online: prefer statements that avoid long exclusive locks
         :return: list of SQL statements
 
         Compares the existing database definition, as fetched from the
         catalogs, to the input YAML map and generates SQL statements
         to transform the database into the one represented by the
-        input.
+        input.  ALTER TABLE statements on the same table are combined
+        where possible, so that each table is altered only once.
+
+        Column data type changes are classified according to whether
+        they rewrite the table, only rebuild its indexes or neither,
+        and the results are saved in the `type_changes` list.
+
+        If `online` is set, changes to existing tables that would
+        otherwise scan them under a strong lock are split into steps
+        that can run while the tables are in use, e.g., constraints
+        are added as NOT VALID and validated separately, and NOT NULL
+        is set with the help of a pre-validated CHECK constraint.
         """
         if not self.db:
             self.from_catalog()
         self.from_map(input_map)
+        self._start('diff_map')
         stmts = self.db.languages.diff_map(self.ndb.languages,
                                            self.dbconn.version)
         stmts.append(self.db.schemas.diff_map(self.ndb.schemas))
         stmts.append(self.db.types.diff_map(self.ndb.types))
         stmts.append(self.db.functions.diff_map(self.ndb.functions))
         stmts.append(self.db.operators.diff_map(self.ndb.operators))
-        stmts.append(self.db.tables.diff_map(self.ndb.tables))
-        stmts.append(self.db.constraints.diff_map(self.ndb.constraints))
+        self.type_changes = self.db.columns.classify_types(
+            self.ndb.columns, self.db.casts)
+        stmts.append(self.db.tables.diff_map(self.ndb.tables, online))
+        stmts.append(self.db.constraints.diff_map(self.ndb.constraints,
+                                                  online, self.db.tables))
         stmts.append(self.db.indexes.diff_map(self.ndb.indexes))
         stmts.append(self.db.columns.diff_map(self.ndb.columns))
         stmts.append(self.db.triggers.diff_map(self.ndb.triggers))
@@ -163,4 +205,6 @@ class Database(object):
         stmts.append(self.db.types._drop())
         stmts.append(self.db.schemas._drop())
         stmts.append(self.db.languages._drop())
-        return [s for s in flatten(stmts)]
+        stmts = merge_alter_table([s for s in flatten(stmts)])
+        self._stop(len(stmts))
+        return stmts
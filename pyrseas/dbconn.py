@@ -4,13 +4,14 @@
     ~~~~~~~~~~~~~~
 
     A `DbConnection` is a helper class representing a connection to a
-    PostgreSQL database.
+    PostgreSQL database.  A `RecordingDbConnection` also saves the
+    results of the queries to a fixture file, from which a
+    `ReplayDbConnection` can later serve them without a database.
 """
 
+import json
 import os
-
-from psycopg2 import connect
-from psycopg2.extras import DictConnection
+from copy import copy
 
 
 class DbConnection(object):
@@ -35,19 +36,35 @@ class DbConnection(object):
         else:
             self.port = "port=%d " % port
         self.conn = None
+        self.profiler = None
+        self.hash_definitions = False
         self._version = 0
 
+    def dsn(self, dbname=None):
+        """Return the connection string
+
+        :param dbname: database name, if not the connection's own
+        :return: libpq connection string
+
+        If user is None, the USER environment variable is used
+        instead.
+        """
+        return "%s%sdbname=%s user=%s" % (self.host, self.port,
+                                          dbname or self.dbname,
+                                          self.user or os.getenv("USER"))
+
     def connect(self):
         """Connect to the database
 
-        If user is None, the USER environment variable is used
-        instead. The password is either not required or supplied by
-        other means, e.g., a $HOME/.pgpass file.
+        The password is either not required or supplied by other
+        means, e.g., a $HOME/.pgpass file.  psycopg2 is only imported
+        here, so that connections replaying a fixture, and the
+        utilities' argument parsing, do not need it.
         """
-        self.conn = connect("%s%sdbname=%s user=%s" % (
-                self.host, self.port, self.dbname,
-                self.user or os.getenv("USER")),
-                            connection_factory=DictConnection)
+        from psycopg2 import connect
+        from psycopg2.extras import DictConnection
+
+        self.conn = connect(self.dsn(), connection_factory=DictConnection)
         try:
             self._execute("set search_path to public, pg_catalog")
         except:
@@ -55,6 +72,21 @@ class DbConnection(object):
             self._execute("set search_path to pg_catalog")
         self._version = int(self.fetchone("SHOW server_version_num")[0])
 
+    def clone(self):
+        """Return a new, disconnected, connection to the same database
+
+        :return: DbConnection
+        """
+        dbconn = copy(self)
+        dbconn.conn = None
+        return dbconn
+
+    def close(self):
+        """Close the connection if still open"""
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
     def _execute(self, query):
         """Create a cursor, execute a query and return the cursor"""
         curs = self.conn.cursor()
@@ -65,6 +97,19 @@ class DbConnection(object):
             raise
         return curs
 
+    def execute(self, stmt):
+        """Execute a statement without committing
+
+        :param stmt: an SQL statement to be executed
+        :return: the number of rows affected, or -1
+
+        The cursor is closed but the transaction is left open.
+        """
+        curs = self._execute(stmt)
+        rows = curs.rowcount
+        curs.close()
+        return rows
+
     def fetchone(self, query):
         """Execute a single row SELECT query and return data
 
@@ -97,3 +142,172 @@ class DbConnection(object):
     def version(self):
         "The server's version number"
         return self._version
+
+
+class RecordingDbConnection(DbConnection):
+    """A database connection that records the results of its queries"""
+
+    def __init__(self, dbname, user=None, host=None, port=None,
+                 fixture=None):
+        """Initialize the connection information
+
+        :param dbname: database name
+        :param user: user name
+        :param host: host name
+        :param port: host port number
+        :param fixture: name of the file the results are saved to
+        """
+        DbConnection.__init__(self, dbname, user, host, port)
+        self.fixture = fixture
+        self.queries = {}
+
+    def _record(self, query, curs, data):
+        "Save the column names and rows returned by a query"
+        self.queries[query] = {
+            'columns': [col[0] for col in curs.description or []],
+            'rows': [list(row) for row in data]}
+
+    def fetchone(self, query):
+        """Execute a single row SELECT query, record and return data
+
+        :param query: a SELECT query to be executed
+        :return: a psycopg2 DictRow
+        """
+        curs = self._execute(query)
+        data = curs.fetchone()
+        self._record(query, curs, data is not None and [data] or [])
+        curs.close()
+        self.conn.rollback()
+        return data
+
+    def fetchall(self, query):
+        """Execute a SELECT query, record and return data
+
+        :param query: a SELECT query to be executed
+        :return: a list of psycopg2 DictRow's
+        """
+        curs = self._execute(query)
+        data = curs.fetchall()
+        self._record(query, curs, data)
+        curs.close()
+        self.conn.rollback()
+        return data
+
+    def save(self):
+        """Write the recorded results to the fixture file
+
+        Values that JSON cannot represent, e.g., decimals, are saved
+        as strings.
+        """
+        output = open(self.fixture, 'w')
+        json.dump({'dbname': self.dbname, 'version': self.version,
+                   'queries': self.queries}, output, indent=1,
+                  sort_keys=True, default=unicode)
+        output.write('\n')
+        output.close()
+
+    def close(self):
+        """Close the connection if still open and save the results
+
+        Database.from_catalog closes the connection once it has
+        queried the catalogs, so the fixture is complete at that
+        point.
+        """
+        DbConnection.close(self)
+        if self.fixture and self.queries:
+            self.save()
+
+
+def _encode(value):
+    "Convert JSON strings back to the UTF-8 strings returned by psycopg2"
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, list):
+        return [_encode(elem) for elem in value]
+    return value
+
+
+class ReplayRow(list):
+    """A row served by a ReplayDbConnection
+
+    As a psycopg2 DictRow, it can be indexed by position or by column
+    name.
+    """
+
+    def __init__(self, columns, values):
+        list.__init__(self, values)
+        self._index = columns
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            key = self._index[key]
+        return list.__getitem__(self, key)
+
+    def keys(self):
+        return self._index.keys()
+
+    def items(self):
+        return [(col, self[idx]) for (col, idx) in self._index.items()]
+
+
+class ReplayDbConnection(DbConnection):
+    """A connection serving query results recorded in a fixture file"""
+
+    def __init__(self, fixture):
+        """Load the recorded results
+
+        :param fixture: name of a file saved by a RecordingDbConnection
+        """
+        data = json.load(open(fixture))
+        DbConnection.__init__(self, data['dbname'])
+        self.fixture = fixture
+        self.queries = data['queries']
+        self._version = data['version']
+
+    def connect(self):
+        "Pretend to connect: no database is needed"
+        self.conn = self
+
+    def close(self):
+        "Pretend to close the connection"
+        self.conn = None
+
+    def rollback(self):
+        "Do nothing, as nothing was changed"
+        pass
+
+    def execute(self, stmt):
+        """Refuse to execute a statement
+
+        :param stmt: an SQL statement
+        """
+        raise ValueError("cannot execute statements on replayed "
+                         "connection to %s" % self.dbname)
+
+    def _rows(self, query):
+        "Return the rows recorded for a query"
+        try:
+            result = self.queries[query]
+        except KeyError:
+            raise KeyError("query not recorded in %s: %s" % (self.fixture,
+                                                              query))
+        index = dict([(_encode(col), idx) for (idx, col) in enumerate(
+                    result['columns'])])
+        return [ReplayRow(index, _encode(row)) for row in result['rows']]
+
+    def fetchone(self, query):
+        """Return the single row recorded for a SELECT query
+
+        :param query: a SELECT query
+        :return: a ReplayRow, or None
+        """
+        rows = self._rows(query)
+        return rows and rows[0] or None
+
+    def fetchall(self, query):
+        """Return the rows recorded for a SELECT query
+
+        :param query: a SELECT query
+        :return: a list of ReplayRow's
+        """
+        return self._rows(query)
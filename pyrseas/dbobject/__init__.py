@@ -7,49 +7,32 @@
     Most Pyrseas classes are derived from either DbObject or
     DbObjectDict.
 """
-import string
+from hashlib import md5
 
+from pyrseas.identifier import quote_id, quote_qualname, split_qualname
 
-VALID_FIRST_CHARS = string.lowercase + '_'
-VALID_CHARS = string.lowercase + string.digits + '_$'
 
+def md5_hex(text):
+    """Return the MD5 digest of a string, as the server's md5()
 
-def quote_id(name):
-    """Quotes an identifier if necessary.
+    :param text: string, e.g., the source of a function or a plan
+    :return: string of 32 hexadecimal digits
 
-    :param name: string to be quoted
-
-    :return: possibly quoted string
+    Unicode strings are encoded in UTF-8, the server encoding assumed.
     """
-    # TODO: keywords
-    regular_id = True
-    if not name[0] in VALID_FIRST_CHARS:
-        regular_id = False
-    else:
-        for ltr in name[1:]:
-            if ltr not in VALID_CHARS:
-                regular_id = False
-                break
-
-    return regular_id and name or '"%s"' % name
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return md5(text).hexdigest()
 
 
 def split_schema_table(tbl, sch=None):
     """Return a (schema, table) tuple given a possibly schema-qualified name
 
-    :param tbl: table name or schema.table
+    :param tbl: table name or schema.table, possibly quoted
+    :param sch: schema to assume if not qualified (default 'public')
     :return: tuple
     """
-    qualsch = sch
-    if sch == None:
-        qualsch = 'public'
-    if '.' in tbl:
-        (qualsch, tbl) = tbl.split('.')
-    if tbl[:1] == '"' and tbl[-1:] == '"':
-        tbl = tbl[1:-1]
-    if sch != qualsch:
-        sch = qualsch
-    return (sch, tbl)
+    return split_qualname(tbl, sch)
 
 
 class DbObject(object):
@@ -157,8 +140,7 @@ class DbSchemaObject(DbObject):
 
         No qualification is used if the schema is 'public'.
         """
-        return self.schema == 'public' and quote_id(self.name) \
-            or "%s.%s" % (quote_id(self.schema), quote_id(self.name))
+        return quote_qualname(self.schema, self.name)
 
     def unqualify(self):
         """Adjust the schema and table name if the latter is qualified"""
@@ -197,6 +179,10 @@ class DbObjectDict(dict):
 
     cls = DbObject
     query = ''
+    # for dictionaries whose definitions can be fetched as hashes: the
+    # attribute holding the definition and the query fetching it by oid
+    hashed_attr = None
+    body_query = ''
 
     def __init__(self, dbconn=None):
         """Initialize the dictionary
@@ -208,8 +194,13 @@ class DbObjectDict(dict):
         """
         dict.__init__(self)
         self.dbconn = dbconn
+        self.hashed = {}
         if dbconn:
+            if dbconn.profiler:
+                dbconn.profiler.start(self.__class__.__name__)
             self._from_catalog()
+            if dbconn.profiler:
+                dbconn.profiler.stop(len(self))
 
     def _from_catalog(self):
         """Initialize the dictionary by querying the catalogs
@@ -226,5 +217,64 @@ class DbObjectDict(dict):
         """
         if not self.dbconn.conn:
             self.dbconn.connect()
+        if self.dbconn.profiler:
+            self.dbconn.profiler.start('query')
         data = self.dbconn.fetchall(self.query)
+        if self.dbconn.profiler:
+            self.dbconn.profiler.stop(len(data))
         return [self.cls(**dict(row)) for row in data]
+
+    def fetch_bodies(self, keys=None):
+        """Fetch the definitions of objects that were fetched as hashes
+
+        :param keys: keys of the objects, by default all those whose
+          definitions have not been fetched yet
+
+        The definitions are fetched by a single query, reconnecting
+        to the database if needed.
+        """
+        if keys is None:
+            keys = self.hashed.keys()
+        oids = {}
+        for key in keys:
+            oids[self.hashed.pop(key)] = key
+        if not oids:
+            return
+        opened = not self.dbconn.conn
+        if opened:
+            self.dbconn.connect()
+        data = self.dbconn.fetchall(self.body_query % ", ".join(
+                [str(oid) for oid in sorted(oids)]))
+        if opened:
+            self.dbconn.close()
+        for (oid, body) in data:
+            obj = self[oids[oid]]
+            setattr(obj, self.hashed_attr, body)
+            delattr(obj, self.hashed_attr + '_md5')
+
+    def match_hashes(self, inobjs):
+        """Compare definitions fetched as hashes to those of the input
+
+        :param inobjs: a dictionary of the input objects
+        :return: keys of the objects whose definitions differ, or that
+          have no counterpart in the input, e.g., if renamed
+
+        Objects whose definition hash matches that of the input
+        object are given the input definition, which is identical, so
+        that only the definitions that differ need to be fetched.
+        """
+        attr = self.hashed_attr
+        differ = []
+        for key in self.hashed.keys():
+            if key not in inobjs or not hasattr(inobjs[key], attr):
+                differ.append(key)
+                continue
+            obj = self[key]
+            indefn = getattr(inobjs[key], attr)
+            if getattr(obj, attr + '_md5') == md5_hex(indefn):
+                setattr(obj, attr, indefn)
+                delattr(obj, attr + '_md5')
+                del self.hashed[key]
+            else:
+                differ.append(key)
+        return differ
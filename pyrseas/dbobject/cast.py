@@ -133,12 +133,41 @@ class CastDict(DbObjectDict):
               OR (castfunc != 0 AND substring(pn.nspname for 3) != 'pg_')
            ORDER BY castsource, casttarget"""
 
+    binary_query = \
+        """SELECT castsource::regtype AS source,
+                  casttarget::regtype AS target
+           FROM pg_cast
+           WHERE castmethod = 'b'"""
+
+    binary_query_83 = \
+        """SELECT castsource::regtype AS source,
+                  casttarget::regtype AS target
+           FROM pg_cast
+           WHERE castfunc = 0"""
+
     def _from_catalog(self):
         """Use different query for older pg versions
+
+        Also fetches the pairs of binary coercible types, including
+        those defined in `pg_catalog`, into the `binary` set.
         """
         if self.dbconn.version < 84000:
             self.query = self.query_83
-        return DbObjectDict._from_catalog(self)
+            self.binary_query = self.binary_query_83
+        DbObjectDict._from_catalog(self)
+        self.binary = set([(src, trg) for (src, trg) in
+                           self.dbconn.fetchall(self.binary_query)])
+
+    def is_binary_coercible(self, source, target):
+        """Can values of one type be used as another without conversion?
+
+        :param source: name of the source type, as output by regtype
+        :param target: name of the target type, as output by regtype
+        :return: boolean
+        """
+        if not hasattr(self, 'binary'):
+            return False
+        return (source, target) in self.binary
 
     def to_map(self):
         """Convert the cast dictionary to a regular dictionary
@@ -6,9 +6,138 @@
     This module defines two classes: Column derived from
     DbSchemaObject and ColumnDict derived from DbObjectDict.
 """
+import re
+
 from pyrseas.dbobject import DbObjectDict, DbSchemaObject, quote_id
 
 
+NO_REWRITE = 'no rewrite'
+INDEX_REBUILD = 'index rebuild'
+REWRITE = 'table rewrite'
+
+TYPE_ALIASES = {'int': 'integer', 'int4': 'integer', 'int2': 'smallint',
+                'int8': 'bigint', 'bool': 'boolean', 'float4': 'real',
+                'float8': 'double precision', 'decimal': 'numeric',
+                'varchar': 'character varying', 'char': 'character',
+                'bpchar': 'character', 'varbit': 'bit varying',
+                'timestamp': 'timestamp without time zone',
+                'timestamptz': 'timestamp with time zone',
+                'time': 'time without time zone',
+                'timetz': 'time with time zone'}
+
+# types whose modifier can be relaxed without a rewrite (PG 9.2 and later)
+RELAXABLE = ['character varying', 'bit varying', 'numeric', 'interval',
+             'timestamp without time zone', 'timestamp with time zone']
+
+# binary coercible types that also share their index operator classes
+SAME_OPCLASS = [('character varying', 'text'), ('text', 'character varying')]
+
+TYPMOD = re.compile(r'^([^(\[]*)(?:\(([^)]*)\))?(.*)$')
+
+INTEGER_TYPES = ['smallint', 'integer', 'bigint']
+
+# functions whose use in a DEFAULT forces a rewrite on ADD COLUMN
+VOLATILE_FUNCS = ['nextval(', 'random(', 'clock_timestamp(', 'timeofday(',
+                  'gen_random_uuid(', 'uuid_generate_v', 'txid_current(']
+
+
+def backfill(table, assignment, key, condition=None):
+    """Return an UPDATE statement that can be executed in batches
+
+    :param table: qualified table name
+    :param assignment: SET clause, e.g., 'c1_new = c1'
+    :param key: integer column used to divide the table in batches
+    :param condition: WHERE clause selecting the rows still to update
+    :return: SQL statement
+
+    The statement is valid SQL updating the whole table.  The
+    trailing comment tells pyrseas.executor.Executor to run it
+    instead in committed batches over ranges of `key`.
+    """
+    return "UPDATE %s SET %s%s /* batched by %s */" % (
+        table, assignment, condition and " WHERE %s" % condition or '',
+        quote_id(key))
+
+
+def not_null_check(table, column):
+    """Return the name of a helper CHECK (column IS NOT NULL) constraint
+
+    :param table: table name
+    :param column: column name
+    :return: quoted constraint name
+
+    The '_nn_check' suffix is kept when the name is truncated to 63
+    characters, so that the name differs from '<table>_<column>_not_null',
+    which PostgreSQL 18 gives the NOT NULL constraint set afterwards.
+    """
+    return quote_id(("%s_%s" % (table, column))[:54] + '_nn_check')
+
+
+def split_type(typ):
+    """Split a data type into its normalized name and its modifiers
+
+    :param typ: data type, e.g., 'varchar(16)' or 'numeric(12,2)[]'
+    :return: tuple of type name, as output by format_type, and list of
+      modifiers
+    """
+    (name, mods, rest) = TYPMOD.match(typ.strip()).groups()
+    name = ' '.join((name + rest).split())
+    arr = ''
+    while name.endswith('[]'):
+        arr += '[]'
+        name = name[:-2].rstrip()
+    name = TYPE_ALIASES.get(name, name)
+    try:
+        mods = [int(mod) for mod in (mods or '').split(',') if mod.strip()]
+    except ValueError:
+        return (typ, None)
+    if name == 'character' and not mods:
+        mods = [1]
+    elif name == 'numeric' and len(mods) == 1:
+        mods.append(0)
+    return (name + arr, mods)
+
+
+def classify_type_change(oldtype, newtype, dbcasts=None, dbversion=0):
+    """Classify the work needed by ALTER COLUMN TYPE
+
+    :param oldtype: current data type of the column
+    :param newtype: new data type of the column
+    :param dbcasts: dictionary of casts in the database
+    :param dbversion: the server's version number
+    :return: NO_REWRITE, INDEX_REBUILD, REWRITE or None if the types
+      are the same
+
+    Relaxing the modifier of certain types, e.g., going to a longer
+    varchar, needs neither a table rewrite nor an index rebuild from
+    PostgreSQL 9.2 on.  Since 9.1, a change between binary coercible
+    types only rebuilds the indexes on the column, unless both types
+    use the same operator classes.
+    """
+    (oldname, oldmods) = split_type(oldtype)
+    (newname, newmods) = split_type(newtype)
+    if oldname == newname and oldmods == newmods:
+        return None
+    if oldmods is None or newmods is None:
+        return REWRITE
+    if oldname == newname:
+        if dbversion < 90200 or oldname not in RELAXABLE or not oldmods:
+            return REWRITE
+        if not newmods:
+            return NO_REWRITE
+        if oldname == 'numeric' and oldmods[1] != newmods[1]:
+            return REWRITE
+        return newmods[0] >= oldmods[0] and NO_REWRITE or REWRITE
+    # a new type modifier requires a length coercion
+    if newmods or dbversion < 90100:
+        return REWRITE
+    if (oldname, newname) in SAME_OPCLASS:
+        return NO_REWRITE
+    if dbcasts is not None and dbcasts.is_binary_coercible(oldname, newname):
+        return INDEX_REBUILD
+    return REWRITE
+
+
 class Column(DbSchemaObject):
     "A table column definition"
 
@@ -25,6 +154,7 @@ class Column(DbSchemaObject):
         for k in self.keylist:
             del dct[k]
         del dct['number'], dct['name'], dct['_table']
+        dct.pop('dependent_rules', None)
         if hasattr(self, 'inherited'):
             dct['inherited'] = (self.inherited != 0)
         return {self.name: dct}
@@ -87,10 +217,32 @@ class Column(DbSchemaObject):
                 quote_id(self.table), quote_id(self.name), self.default))
         return stmts
 
-    def diff_map(self, incol):
+    def set_not_null_online(self, table=None):
+        """Return SQL statements to SET NOT NULL without a long lock
+
+        :param table: the table, if the column is not linked to it
+        :return: list of SQL statements
+
+        A NOT VALID CHECK (col IS NOT NULL) constraint is added and
+        validated, which only needs a SHARE UPDATE EXCLUSIVE lock
+        while the table is scanned.  SET NOT NULL then uses the
+        validated constraint instead of scanning the table (PostgreSQL
+        12 or later) and the helper constraint is dropped.
+        """
+        tbl = (table or self._table).qualname()
+        chk = not_null_check(self.table, self.name)
+        return ["ALTER TABLE %s ADD CONSTRAINT %s CHECK (%s IS NOT NULL) "
+                "NOT VALID" % (tbl, chk, quote_id(self.name)),
+                "ALTER TABLE %s VALIDATE CONSTRAINT %s" % (tbl, chk),
+                "ALTER TABLE %s ALTER COLUMN %s SET NOT NULL" % (
+                tbl, quote_id(self.name)),
+                "ALTER TABLE %s DROP CONSTRAINT %s" % (tbl, chk)]
+
+    def diff_map(self, incol, online=False):
         """Generate SQL to transform an existing column
 
         :param insequence: a YAML map defining the new column
+        :param online: leave out SET NOT NULL (see `set_not_null_online`)
         :return: list of partial SQL statements
 
         Compares the column to an input column and generates partial
@@ -100,7 +252,8 @@ class Column(DbSchemaObject):
         stmts = []
         base = "ALTER COLUMN %s " % self.name
         # check NOT NULL
-        if not hasattr(self, 'not_null') and hasattr(incol, 'not_null'):
+        if not hasattr(self, 'not_null') and hasattr(incol, 'not_null') \
+                and not online:
             stmts.append(base + "SET NOT NULL")
         if hasattr(self, 'not_null') and not hasattr(incol, 'not_null'):
             stmts.append(base + "DROP NOT NULL")
@@ -109,8 +262,9 @@ class Column(DbSchemaObject):
             raise ValueError("Column '%s' missing datatype" % self.name)
         if not hasattr(incol, 'type'):
             raise ValueError("Input column '%s' missing datatype" % incol.name)
-        if self.type != incol.type:
-            # validate type conversion?
+        # type_change is set by ColumnDict.classify_types
+        if self.type != incol.type and (
+                not hasattr(incol, 'type_change') or incol.type_change):
             stmts.append(base + "TYPE %s" % incol.type)
         # check DEFAULTs
         if not hasattr(self, 'default') and hasattr(incol, 'default'):
@@ -129,7 +283,12 @@ class ColumnDict(DbObjectDict):
                   attnum AS number, format_type(atttypid, atttypmod) AS type,
                   attnotnull AS not_null, attinhcount AS inherited,
                   pg_get_expr(adbin, adrelid) AS default, description,
-                  attisdropped AS dropped
+                  attisdropped AS dropped,
+                  (SELECT count(*) FROM pg_depend
+                   WHERE classid = 'pg_rewrite'::regclass
+                         AND refclassid = 'pg_class'::regclass
+                         AND refobjid = attrelid
+                         AND refobjsubid = attnum) AS dependent_rules
            FROM pg_attribute JOIN pg_class ON (attrelid =  pg_class.oid)
                 JOIN pg_namespace ON (relnamespace = pg_namespace.oid)
                 JOIN pg_roles ON (nspowner = pg_roles.oid)
@@ -169,6 +328,42 @@ class ColumnDict(DbObjectDict):
                 cols.append(Column(schema=table.schema, table=table.name,
                                    name=key, **arg))
 
+    def classify_types(self, incols, dbcasts):
+        """Classify the data type changes of existing columns
+
+        :param incols: the new columns
+        :param dbcasts: dictionary of casts in the database
+        :return: list of tuples of table, column, old type, new type
+          and classification
+
+        Each input column whose data type differs from the existing
+        column gets a `type_change` attribute, set to the result of
+        `classify_type_change`.  A spelling difference such as
+        'varchar(16)' instead of 'character varying(16)' results in
+        None, i.e., no ALTER COLUMN TYPE is needed.
+        """
+        changes = []
+        dbversion = self.dbconn and self.dbconn.version or 0
+        for (sch, tbl) in incols.keys():
+            if (sch, tbl) not in self:
+                continue
+            dbcols = dict([(col.name, col) for col in self[(sch, tbl)]
+                           if not hasattr(col, 'dropped')])
+            for incol in incols[(sch, tbl)]:
+                col = dbcols.get(getattr(incol, 'oldname', incol.name))
+                if col is None or not hasattr(col, 'type') \
+                        or not hasattr(incol, 'type') \
+                        or col.type == incol.type:
+                    continue
+                incol.type_change = classify_type_change(
+                    col.type, incol.type, dbcasts, dbversion)
+                if incol.type_change:
+                    changes.append((
+                            DbSchemaObject(schema=sch, name=tbl).qualname(),
+                            incol.name, col.type, incol.type,
+                            incol.type_change))
+        return changes
+
     def diff_map(self, incols):
         """Generate SQL to transform existing columns
 
@@ -21,6 +21,7 @@ class Constraint(DbSchemaObject):
        unique constraint"""
 
     keylist = ['schema', 'table', 'name']
+    novalid_version = None
 
     def key_columns(self):
         """Return comma-separated list of key column names
@@ -57,11 +58,20 @@ class Constraint(DbSchemaObject):
                 self._qualtable(), self.name)
         return []
 
+    def validate(self):
+        """Return string to validate a NOT VALID constraint via ALTER TABLE
+
+        :return: SQL statement
+        """
+        return "ALTER TABLE %s VALIDATE CONSTRAINT %s" % (
+            self._qualtable(), quote_id(self.name))
+
 
 class CheckConstraint(Constraint):
     "A check constraint definition"
 
     objtype = "CHECK"
+    novalid_version = 90200
 
     def to_map(self, dbcols):
         """Convert a check constraint definition to a YAML-suitable format
@@ -79,13 +89,15 @@ class CheckConstraint(Constraint):
             del dct['keycols']
         return {self.name: dct}
 
-    def add(self):
+    def add(self, novalid=False):
         """Return string to add the CHECK constraint via ALTER TABLE
 
+        :param novalid: add the constraint as NOT VALID
         :return: SQL statement
         """
-        return "ALTER TABLE %s ADD CONSTRAINT %s %s (%s)" % (
-            self._qualtable(), self.name, self.objtype, self.expression)
+        return "ALTER TABLE %s ADD CONSTRAINT %s %s (%s)%s" % (
+            self._qualtable(), self.name, self.objtype, self.expression,
+            novalid and " NOT VALID" or '')
 
     def diff_map(self, inchk):
         """Generate SQL to transform an existing CHECK constraint
@@ -139,6 +151,7 @@ class ForeignKey(Constraint):
     "A foreign key constraint definition"
 
     objtype = "FOREIGN KEY"
+    novalid_version = 90100
 
     def ref_columns(self):
         """Return comma-separated list of reference column names
@@ -167,9 +180,10 @@ class ForeignKey(Constraint):
         del dct['ref_table'], dct['ref_cols']
         return {self.name: dct}
 
-    def add(self):
+    def add(self, novalid=False):
         """Return string to add the foreign key via ALTER TABLE
 
+        :param novalid: add the constraint as NOT VALID
         :return: SQL statement
         """
         actions = ''
@@ -177,6 +191,8 @@ class ForeignKey(Constraint):
             actions = " ON UPDATE %s" % self.on_update.upper()
         if hasattr(self, 'on_delete'):
             actions += " ON DELETE %s" % self.on_delete.upper()
+        if novalid:
+            actions += " NOT VALID"
         return "ALTER TABLE %s ADD CONSTRAINT %s FOREIGN KEY (%s) " \
             "REFERENCES %s (%s)%s" % (
             self._qualtable(), self.name, self.key_columns(),
@@ -387,17 +403,43 @@ class ConstraintDict(DbObjectDict):
                     unq.access_method = val['access_method']
                 self[(table.schema, table.name, cns)] = unq
 
-    def diff_map(self, inconstrs):
+    def _add_online(self, inconstr, dbtables):
+        """Can the constraint be added as NOT VALID and validated later?
+
+        :param inconstr: the input constraint to be added
+        :param dbtables: dictionary of existing tables, if available
+        :return: boolean
+        """
+        if not inconstr.novalid_version or not self.dbconn \
+                or self.dbconn.version < inconstr.novalid_version:
+            return False
+        # a table created by the same plan is empty: no need to validate
+        if dbtables is not None \
+                and (inconstr.schema, inconstr.table) not in dbtables:
+            return False
+        return True
+
+    def diff_map(self, inconstrs, online=False, dbtables=None):
         """Generate SQL to transform existing constraints
 
         :param inconstrs: a YAML map defining the new constraints
+        :param online: add constraints on existing tables as NOT VALID
+        :param dbtables: dictionary of existing tables
         :return: list of SQL statements
 
         Compares the existing constraint definitions, as fetched from
         the catalogs, to the input map and generates SQL statements to
         transform the constraints accordingly.
+
+        If `online` is set, new CHECK constraints and foreign keys on
+        tables found in `dbtables` are added as NOT VALID, which does
+        not scan the table, and a VALIDATE CONSTRAINT statement for
+        each of them is issued after all other constraint changes.
+        Validation only takes a SHARE UPDATE EXCLUSIVE lock on the
+        table.
         """
         stmts = []
+        validate = []
         # foreign keys are processed in a second pass
         # constraints cannot be renamed
         for turn in (1, 2):
@@ -427,9 +469,13 @@ class ConstraintDict(DbObjectDict):
                 # does it exist in the database?
                 if (sch, tbl, cns) not in self:
                     # add the new constraint
-                    stmts.append(inconstr.add())
+                    if online and self._add_online(inconstr, dbtables):
+                        stmts.append(inconstr.add(novalid=True))
+                        validate.append(inconstr.validate())
+                    else:
+                        stmts.append(inconstr.add())
                 else:
                     # check constraint objects
                     stmts.append(self[(sch, tbl, cns)].diff_map(inconstr))
 
-        return stmts
+        return stmts + validate
@@ -146,6 +146,8 @@ class ProcDict(DbObjectDict):
     "The collection of regular and aggregate functions in a database"
 
     cls = Proc
+    hashed_attr = 'source'
+    body_query = "SELECT oid, prosrc FROM pg_proc WHERE oid IN (%s)"
     query = \
         """SELECT nspname AS schema, proname AS name,
                   pg_get_function_arguments(p.oid) AS arguments,
@@ -221,15 +223,26 @@ class ProcDict(DbObjectDict):
            ORDER BY nspname, proname"""
 
     def _from_catalog(self):
-        """Initialize the dictionary of procedures by querying the catalogs"""
+        """Initialize the dictionary of procedures by querying the catalogs
+
+        If the connection's `hash_definitions` is set, only the MD5
+        hashes of the function sources are fetched, as `source_md5`.
+        """
         if self.dbconn.version < 84000:
             self.query = self.query_83
+        if self.dbconn.hash_definitions:
+            self.query = self.query.replace(
+                "prosrc AS source", "p.oid, md5(prosrc) AS source_md5")
 
         for proc in self.fetch():
             sch, prc, arg = proc.key()
+            oid = proc.__dict__.pop('oid', None)
             if hasattr(proc, 'proisagg'):
                 del proc.proisagg
-                del proc.source
+                if oid:
+                    del proc.source_md5
+                else:
+                    del proc.source
                 del proc.volatility
                 del proc.returns
                 if proc.finalfunc == '-':
@@ -237,6 +250,8 @@ class ProcDict(DbObjectDict):
                 self[(sch, prc, arg)] = Aggregate(**proc.__dict__)
             else:
                 self[(sch, prc, arg)] = Function(**proc.__dict__)
+                if oid:
+                    self.hashed[(sch, prc, arg)] = oid
 
     def from_map(self, schema, infuncs):
         """Initalize the dictionary of functions by converting the input map
@@ -290,10 +305,12 @@ class ProcDict(DbObjectDict):
 
         Compares the existing function definitions, as fetched from
         the catalogs, to the input map and generates SQL statements to
-        transform the functions accordingly.
+        transform the functions accordingly.  Sources fetched as
+        hashes are only fetched in full if they differ from the input.
         """
         stmts = []
         created = False
+        self.fetch_bodies(self.match_hashes(infuncs))
         # check input functions
         for (sch, fnc, arg) in infuncs.keys():
             infunc = infuncs[(sch, fnc, arg)]
@@ -7,16 +7,40 @@
     DbSchemaObject, Sequence and Table derived from DbClass, and
     ClassDict derived from DbObjectDict.
 """
+import re
 import sys
 
 from pyrseas.dbobject import DbObjectDict, DbSchemaObject
 from pyrseas.dbobject import quote_id, split_schema_table
+from column import INDEX_REBUILD, INTEGER_TYPES, REWRITE, VOLATILE_FUNCS
+from column import backfill, not_null_check
 from constraint import CheckConstraint, PrimaryKey, ForeignKey, \
     UniqueConstraint
 
 MAX_BIGINT = 9223372036854775807L
 
 
+def _mentions(expr, name):
+    "Does an expression refer to a column name?"
+    return re.search(r'(?<![\w"])%s(?![\w"])' % re.escape(quote_id(name)),
+                     expr or '') is not None
+
+
+def _literal(text):
+    "Return a string as a SQL literal"
+    return "'%s'" % text.replace("'", "''")
+
+
+def _named_foreign_key(fkey, table):
+    """Return a copy of a foreign key fetched from the catalogs, with
+    column names instead of numbers"""
+    named = ForeignKey(**fkey.__dict__)
+    named.keycols = [table.columns[num - 1].name for num in fkey.keycols]
+    named.ref_cols = [quote_id(fkey.references.columns[num - 1].name)
+                      for num in fkey.ref_cols]
+    return named
+
+
 class DbClass(DbSchemaObject):
     """A table, sequence or view"""
 
@@ -273,15 +297,256 @@ class Table(DbClass):
             stmts.append("DROP TABLE %s" % self.identifier())
         return stmts
 
-    def diff_map(self, intable):
+    def batch_key(self):
+        """Return the column by which to update the table in batches
+
+        :return: Column or None
+
+        Only a single-column primary key of an integer type is used,
+        and only if the table is not part of an inheritance hierarchy.
+        """
+        if hasattr(self, 'inherits') or hasattr(self, 'descendants'):
+            return None
+        if not hasattr(self, 'primary_key') or \
+                len(self.primary_key.keycols) != 1:
+            return None
+        col = self.columns[self.primary_key.keycols[0] - 1]
+        return col.type in INTEGER_TYPES and col or None
+
+    def _shadow_not_null(self, col, incol):
+        "Must the shadow column replacing a column be NOT NULL?"
+        return hasattr(incol, 'not_null') or (
+            hasattr(self, 'primary_key') and
+            col.number in self.primary_key.keycols)
+
+    def _shadow_type_change(self, col, incol, dbversion):
+        "Can the type of a column be changed through a shadow column?"
+        if dbversion < 90200 or getattr(incol, 'type_change', None) \
+                not in (REWRITE, INDEX_REBUILD):
+            return False
+        if not self.batch_key():
+            return False
+        # views and rules selecting the column prevent dropping it in
+        # the swap, after all the work on the shadow column
+        if hasattr(col, 'dependent_rules'):
+            return False
+        # before PostgreSQL 12, SET NOT NULL in the swap scans the table
+        # under an ACCESS EXCLUSIVE lock
+        if dbversion < 120000 and self._shadow_not_null(col, incol):
+            return False
+        # indexes mixing columns and expressions are not rebuilt
+        for idx in getattr(self, 'indexes', {}).values():
+            if hasattr(idx, 'keycols') and '0' in idx.keycols.split() and (
+                    str(col.number) in idx.keycols.split()
+                    or _mentions(idx.expression, col.name)):
+                return False
+        return True
+
+    def _batched_default(self, incol, dbversion):
+        "Would adding a column with its DEFAULT rewrite the table?"
+        if not hasattr(incol, 'default') or \
+                incol.default.startswith('nextval') or not self.batch_key():
+            return False
+        return dbversion < 110000 or len([
+                func for func in VOLATILE_FUNCS if func in incol.default]) > 0
+
+    def add_column_online(self, incol, dbversion):
+        """Return SQL statements to add a column with a DEFAULT online
+
+        :param incol: the input column
+        :param dbversion: the server's version number
+        :return: list of SQL statements
+
+        The column is added without a DEFAULT, which is then set so
+        that it only applies to new rows.  The existing rows are set
+        to the DEFAULT in batches (see
+        `pyrseas.dbobject.column.backfill`).  NOT NULL is set last,
+        with the help of a validated CHECK constraint on PostgreSQL 12
+        or later.
+        """
+        tbl = self.qualname()
+        name = quote_id(incol.name)
+        base = "ALTER TABLE %s\n    " % tbl
+        stmts = [base + "ADD COLUMN %s %s" % (name, incol.type),
+                 base + "ALTER COLUMN %s SET DEFAULT %s" % (
+                name, incol.default),
+                 backfill(tbl, "%s = DEFAULT" % name, self.batch_key().name,
+                          "%s IS NULL" % name)]
+        if hasattr(incol, 'not_null'):
+            if dbversion >= 120000:
+                stmts.extend(incol.set_not_null_online(self))
+            else:
+                stmts.append(base + "ALTER COLUMN %s SET NOT NULL" % name)
+        return stmts
+
+    def change_type_online(self, col, incol, dbversion, referrers=None):
+        """Return SQL statements to change the type of a column online
+
+        :param col: the existing column
+        :param incol: the input column, with the new type
+        :param dbversion: the server's version number
+        :param referrers: list of (table, foreign key) pairs, for the
+          foreign keys referencing the table
+        :return: list of SQL statements
+
+        A shadow column of the new type is added and kept in sync by a
+        trigger while the existing rows are copied in batches (see
+        `pyrseas.dbobject.column.backfill`).  The indexes, primary key
+        and unique constraints on the column are built concurrently
+        on the shadow column.  A short final transaction then swaps
+        the columns and attaches the new indexes.  A NOT NULL column,
+        including one in the primary key, is first given a validated
+        CHECK constraint, so that the swap can set NOT NULL without
+        scanning the table, which requires PostgreSQL 12.  Afterwards,
+        foreign keys and CHECK constraints involving the column are
+        added back as NOT VALID and validated, and expression indexes
+        on the column are recreated concurrently.  Note that the
+        column moves to the end of the table.  A column that views or
+        rules depend on is not changed online, since it could not be
+        dropped in the swap.
+        """
+        tbl = self.qualname()
+        name = quote_id(col.name)
+        shadow = quote_id(col.name[:59] + '_new')
+        base = "ALTER TABLE %s " % tbl
+        sync = ("%s_%s_sync" % (self.name, col.name))[:63]
+        func = DbSchemaObject(schema=self.schema, name=sync).qualname()
+        stmts = [base + "ADD COLUMN %s %s" % (shadow, incol.type),
+                 "CREATE FUNCTION %s() RETURNS trigger LANGUAGE plpgsql AS "
+                 "$_$BEGIN NEW.%s := NEW.%s; RETURN NEW; END$_$" % (
+                func, shadow, name),
+                 "CREATE TRIGGER %s BEFORE INSERT OR UPDATE ON %s FOR EACH "
+                 "ROW EXECUTE PROCEDURE %s()" % (quote_id(sync), tbl, func),
+                 backfill(tbl, "%s = %s" % (shadow, name),
+                          self.batch_key().name, "%s IS NULL AND %s IS NOT "
+                          "NULL" % (shadow, name))]
+        chk = None
+        if self._shadow_not_null(col, incol):
+            chk = not_null_check(self.name, col.name)
+            stmts.append(base + "ADD CONSTRAINT %s CHECK (%s IS NOT NULL) "
+                         "NOT VALID" % (chk, shadow))
+            stmts.append(base + "VALIDATE CONSTRAINT %s" % chk)
+
+        # build the new indexes
+        names = self.column_names()
+
+        def keycols(nums):
+            return ", ".join([num == col.number and shadow
+                              or quote_id(names[num - 1]) for num in nums])
+        attach = []
+        exprindexes = []
+        for idxname in sorted(getattr(self, 'indexes', {})):
+            idx = self.indexes[idxname]
+            if not hasattr(idx, 'keycols'):
+                if _mentions(idx.expression, col.name):
+                    exprindexes.append(idx)
+                continue
+            nums = [int(num) for num in idx.keycols.split()]
+            if col.number not in nums:
+                continue
+            newname = idx.name[:59] + '_new'
+            stmts.append("CREATE %sINDEX CONCURRENTLY %s ON %s %s(%s)" % (
+                    getattr(idx, 'unique', False) and 'UNIQUE ' or '',
+                    quote_id(newname), tbl, hasattr(idx, 'access_method')
+                    and 'USING %s ' % idx.access_method or '',
+                    keycols(nums)))
+            attach.append("ALTER INDEX %s RENAME TO %s" % (
+                    DbSchemaObject(schema=self.schema,
+                                   name=newname).qualname(),
+                    quote_id(idx.name)))
+        constrs = []
+        if hasattr(self, 'primary_key'):
+            constrs.append(self.primary_key)
+        for cns in sorted(getattr(self, 'unique_constraints', {})):
+            constrs.append(self.unique_constraints[cns])
+        for cns in constrs:
+            if col.number not in cns.keycols:
+                continue
+            newname = cns.name[:59] + '_new'
+            stmts.append("CREATE UNIQUE INDEX CONCURRENTLY %s ON %s (%s)"
+                         % (quote_id(newname), tbl, keycols(cns.keycols)))
+            attach.append(base + "ADD CONSTRAINT %s %s USING INDEX %s" % (
+                    quote_id(cns.name), cns.objtype, quote_id(newname)))
+
+        # foreign keys depending on the column must be dropped first
+        fkeys = {}
+        for (table, fkey) in referrers or []:
+            if col.number in fkey.ref_cols:
+                fkeys[fkey.key()] = _named_foreign_key(fkey, table)
+        for fkey in getattr(self, 'foreign_keys', {}).values():
+            if col.number in fkey.keycols:
+                fkeys[fkey.key()] = _named_foreign_key(fkey, self)
+        fkeys = [fkeys[key] for key in sorted(fkeys)]
+
+        # the swap: a serial sequence must not be dropped with the column
+        swap = ["DROP TRIGGER %s ON %s" % (quote_id(sync), tbl)]
+        for fkey in fkeys:
+            swap.append("ALTER TABLE %s DROP CONSTRAINT %s" % (
+                    fkey._qualtable(), quote_id(fkey.name)))
+        swap.append("IF serial_seq IS NOT NULL THEN\n        EXECUTE "
+                    "'ALTER SEQUENCE ' || serial_seq || ' OWNED BY NONE';"
+                    "\n    END IF")
+        swap.append(base + "DROP COLUMN %s" % name)
+        swap.append(base + "RENAME COLUMN %s TO %s" % (shadow, name))
+        if chk:
+            swap.append(base + "ALTER COLUMN %s SET NOT NULL" % name)
+            swap.append(base + "DROP CONSTRAINT %s" % chk)
+        if hasattr(incol, 'default'):
+            swap.append(base + "ALTER COLUMN %s SET DEFAULT %s" % (
+                    name, incol.default))
+        seqtype = ''
+        if dbversion >= 100000 and incol.type in INTEGER_TYPES:
+            seqtype = "\n        EXECUTE 'ALTER SEQUENCE ' || serial_seq " \
+                "|| ' AS %s';" % incol.type
+        swap.append("IF serial_seq IS NOT NULL THEN%s\n        EXECUTE "
+                    "'ALTER SEQUENCE ' || serial_seq || %s;\n    END IF" % (
+                seqtype, _literal(" OWNED BY %s.%s" % (tbl, name))))
+        swap.extend(attach)
+        stmts.append("DO $_$\nDECLARE\n    serial_seq text := "
+                     "pg_get_serial_sequence(%s, %s);\nBEGIN\n%s;\nEND\n"
+                     "$_$" % (_literal(tbl), _literal(col.name),
+                              ";\n".join(["    " + stmt for stmt in swap])))
+
+        # rebuild what was dropped with the column
+        stmts.append("DROP FUNCTION %s()" % func)
+        for fkey in fkeys:
+            stmts.append(fkey.add(novalid=True))
+            stmts.append(fkey.validate())
+        for cns in sorted(getattr(self, 'check_constraints', {})):
+            check = self.check_constraints[cns]
+            if col.number in (getattr(check, 'keycols', None) or []):
+                stmts.append(check.add(novalid=True))
+                stmts.append(check.validate())
+        for idx in exprindexes:
+            stmts.append("CREATE %sINDEX CONCURRENTLY %s ON %s %s(%s)" % (
+                    getattr(idx, 'unique', False) and 'UNIQUE ' or '',
+                    quote_id(idx.name), tbl, hasattr(idx, 'access_method')
+                    and 'USING %s ' % idx.access_method or '',
+                    idx.expression))
+        if hasattr(incol, 'description'):
+            stmts.append("COMMENT ON COLUMN %s.%s IS %s" % (
+                    tbl, name, _literal(incol.description)))
+        return stmts
+
+    def diff_map(self, intable, online=False, dbversion=0, referrers=None):
         """Generate SQL to transform an existing table
 
         :param intable: a YAML map defining the new table
+        :param online: avoid long exclusive locks on the table
+        :param dbversion: the server's version number
+        :param referrers: list of (table, foreign key) pairs, for the
+          foreign keys referencing the table
         :return: list of SQL statements
 
         Compares the table to an input table and generates SQL
         statements to transform it into the one represented by the
         input.
+
+        If `online` is set, a column type change that would rewrite
+        the table or rebuild its indexes uses `change_type_online`,
+        and a new column whose DEFAULT would rewrite the table uses
+        `add_column_online`, provided the table has an integer primary
+        key to update it in batches (see `batch_key`).
         """
         stmts = []
         if not hasattr(intable, 'columns'):
@@ -289,6 +554,8 @@ class Table(DbClass):
         dbcols = len(self.columns)
 
         base = "ALTER TABLE %s\n    " % self.qualname()
+        # SET NOT NULL can rely on a validated CHECK only from PG 12 on
+        notnull_online = online and dbversion >= 120000
         # check input columns
         for (num, incol) in enumerate(intable.columns):
             if hasattr(incol, 'oldname'):
@@ -296,13 +563,25 @@ class Table(DbClass):
                 stmts.append(self.columns[num].rename(incol.name))
             # add new columns
             if num >= dbcols:
-                stmts.append(base + "ADD COLUMN %s" % incol.add())
+                if online and self._batched_default(incol, dbversion):
+                    stmts.append(self.add_column_online(incol, dbversion))
+                else:
+                    stmts.append(base + "ADD COLUMN %s" % incol.add())
             # check existing columns
             # TODO: more work is needed, for columns out of order
             elif self.columns[num].name == incol.name:
-                stmt = self.columns[num].diff_map(incol)
+                col = self.columns[num]
+                if online and self._shadow_type_change(col, incol,
+                                                       dbversion):
+                    stmts.append(self.change_type_online(
+                            col, incol, dbversion, referrers))
+                    continue
+                stmt = col.diff_map(incol, notnull_online)
                 if stmt:
                     stmts.append(base + stmt)
+                if notnull_online and not hasattr(col, 'not_null') \
+                        and hasattr(incol, 'not_null'):
+                    stmts.append(col.set_not_null_online())
 
         stmts.append(self.diff_description(intable))
 
@@ -360,6 +639,9 @@ class ClassDict(DbObjectDict):
     "The collection of tables and similar objects in a database"
 
     cls = DbClass
+    hashed_attr = 'definition'
+    body_query = "SELECT c.oid, pg_get_viewdef(c.oid, TRUE) " \
+        "FROM pg_class c WHERE c.oid IN (%s)"
     query = \
         """SELECT nspname AS schema, relname AS name, relkind AS kind,
                   CASE WHEN relkind = 'v' THEN pg_get_viewdef(c.oid, TRUE)
@@ -381,9 +663,20 @@ class ClassDict(DbObjectDict):
            ORDER BY 1, 3"""
 
     def _from_catalog(self):
-        """Initialize the dictionary of tables by querying the catalogs"""
+        """Initialize the dictionary of tables by querying the catalogs
+
+        If the connection's `hash_definitions` is set, only the MD5
+        hashes of the view definitions are fetched, as
+        `definition_md5`.
+        """
+        if self.dbconn.hash_definitions:
+            self.query = self.query.replace(
+                "pg_get_viewdef(c.oid, TRUE)",
+                "md5(pg_get_viewdef(c.oid, TRUE))").replace(
+                "END AS definition,", "END AS definition_md5, c.oid,")
         for table in self.fetch():
             sch, tbl = table.key()
+            oid = table.__dict__.pop('oid', None)
             kind = table.kind
             del table.kind
             if kind == 'r':
@@ -394,6 +687,8 @@ class ClassDict(DbObjectDict):
                 inst.get_dependent_table(self.dbconn)
             elif kind == 'v':
                 self[(sch, tbl)] = View(**table.__dict__)
+                if oid:
+                    self.hashed[(sch, tbl)] = oid
         for (tbl, partbl, num) in self.dbconn.fetchall(self.inhquery):
             (sch, tbl) = split_schema_table(tbl)
             table = self[(sch, tbl)]
@@ -557,17 +852,21 @@ class ClassDict(DbObjectDict):
             raise
         return stmt
 
-    def diff_map(self, intables):
+    def diff_map(self, intables, online=False):
         """Generate SQL to transform existing tables and sequences
 
         :param intables: a YAML map defining the new tables/sequences
+        :param online: avoid long exclusive locks on existing tables
         :return: list of SQL statements
 
         Compares the existing table/sequence definitions, as fetched
         from the catalogs, to the input map and generates SQL
         statements to transform the tables/sequences accordingly.
+        View definitions fetched as hashes are only fetched in full if
+        they differ from the input.
         """
         stmts = []
+        self.fetch_bodies(self.match_hashes(intables))
         # first pass: sequences owned by a table
         for (sch, seq) in intables.keys():
             inseq = intables[(sch, seq)]
@@ -636,14 +935,27 @@ class ClassDict(DbObjectDict):
                     # create new sequence
                     stmts.append(inseq.create())
 
+        # foreign keys referencing each table
+        referrers = {}
+        for table in self.values():
+            if isinstance(table, Table) and hasattr(table, 'foreign_keys'):
+                for fkey in table.foreign_keys.values():
+                    ref = fkey.references
+                    referrers.setdefault((ref.schema, ref.name), []).append(
+                        (table, fkey))
+
         # check database tables, sequences and views
         for (sch, tbl) in self.keys():
             table = self[(sch, tbl)]
             # if missing, mark it for dropping
             if (sch, tbl) not in intables:
                 table.dropped = False
+            elif isinstance(table, Table):
+                stmts.append(table.diff_map(intables[(sch, tbl)], online,
+                                            self.dbconn.version,
+                                            referrers.get((sch, tbl))))
             else:
-                # check table/sequence/view objects
+                # check sequence/view objects
                 stmts.append(table.diff_map(intables[(sch, tbl)]))
 
         # now drop the marked tables
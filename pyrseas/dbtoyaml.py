@@ -1,14 +1,17 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
-"""dbtoyaml - extract the schema of a PostgreSQL database in YAML format"""
+"""dbtoyaml - extract the schema of a PostgreSQL database in YAML format
+
+PyYAML, psycopg2 and the modules implementing the options are only
+imported once the arguments have been parsed, and only if needed, to
+keep the startup of short runs fast.
+"""
 
 import os
+import sys
 from optparse import OptionParser
 
-import yaml
-
 from pyrseas.dbconn import DbConnection
-from pyrseas.database import Database
 
 
 def main(host='localhost', port=5432, schema=None):
@@ -25,18 +28,42 @@ def main(host='localhost', port=5432, schema=None):
                      help="only for named schema (default %default)")
     parser.add_option('-t', '--table', dest='tablist', action='append',
                      help="only for named tables (default all)")
+    parser.add_option('--profile', action='store_true', dest='profile',
+                      help="report the time and memory used by each phase "
+                      "on stderr")
+    parser.add_option('--profile-stats', dest='profile_stats',
+                      help="with --profile, dump cProfile statistics to "
+                      "this file")
+    parser.add_option('--metrics', dest='metrics',
+                      help="write counters and timings of the run to this "
+                      "file")
+    parser.add_option('--metrics-format', dest='metrics_format',
+                      type='choice', choices=['json', 'prometheus'],
+                      help="format of the --metrics file: json or "
+                      "prometheus (default %default)")
 
     parser.set_defaults(host=host, port=port, username=os.getenv("USER"),
-                        schema=schema)
+                        schema=schema, metrics_format='json')
     (options, args) = parser.parse_args()
     if len(args) > 1:
         parser.error("too many arguments")
     elif len(args) != 1:
         parser.error("database name not specified")
+    if options.profile_stats and not options.profile:
+        parser.error("--profile-stats requires --profile")
     dbname = args[0]
 
-    db = Database(DbConnection(dbname, options.username, options.host,
-                               options.port))
+    import yaml
+    from pyrseas.database import Database
+
+    dbconn = DbConnection(dbname, options.username, options.host,
+                          options.port)
+    profiler = None
+    if options.profile or options.metrics:
+        from pyrseas.profiler import Profiler
+        profiler = dbconn.profiler = Profiler(options.profile_stats)
+        profiler.enable()
+    db = Database(dbconn)
     dbmap = db.to_map()
     # trim the map of schemas/tables not selected
     if options.schema:
@@ -53,7 +80,22 @@ def main(host='localhost', port=5432, schema=None):
             if not dbmap[sch]:
                 del dbmap[sch]
 
-    print yaml.dump(dbmap, default_flow_style=False)
+    if profiler:
+        output = profiler.timed('yaml_dump', yaml.dump, dbmap,
+                                default_flow_style=False)
+        profiler.disable()
+    else:
+        output = yaml.dump(dbmap, default_flow_style=False)
+    print output
+    if options.profile:
+        print >> sys.stderr, "\n".join(profiler.report())
+    if options.metrics:
+        from pyrseas.metrics import Metrics
+        metrics = Metrics('dbtoyaml', dbname)
+        metrics.from_profiler(profiler)
+        metrics.objects(db.db)
+        metrics.add('yaml_bytes', len(output))
+        metrics.write(open(options.metrics, 'w'), options.metrics_format)
 
 if __name__ == '__main__':
     main()
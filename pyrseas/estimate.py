@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+    pyrseas.estimate
+    ~~~~~~~~~~~~~~~~
+
+    A `CostEstimator` combines the statements generated by
+    Database.diff_map with the sizes of the tables they affect, to
+    estimate the I/O volume and duration of each statement.
+"""
+from pyrseas.dbobject import DbSchemaObject
+from pyrseas.plan import analyze_plan
+
+MB = 1024.0 * 1024.0
+
+
+class CostEstimator(object):
+    """An estimator of migration costs based on relation sizes"""
+
+    read_rate = 100.0
+    write_rate = 50.0
+    index_ratio = 0.3
+    overhead = 0.01
+
+    query = \
+        """SELECT nspname AS schema, relname AS name, c.relpages AS pages,
+                  c.reltuples AS rows, pg_relation_size(c.oid) AS heap,
+                  COALESCE(pg_relation_size(NULLIF(c.reltoastrelid, 0)),
+                           0) AS toast,
+                  pg_indexes_size(c.oid) AS indexes,
+                  (SELECT count(*) FROM pg_index
+                   WHERE indrelid = c.oid) AS num_indexes
+           FROM pg_class c
+                JOIN pg_namespace ON (relnamespace = pg_namespace.oid)
+           WHERE relkind = 'r'
+                 AND substring(nspname for 3) != 'pg_'
+                 AND nspname != 'information_schema'"""
+
+    def __init__(self, dbconn, read_rate=None, write_rate=None,
+                 index_ratio=None, overhead=None):
+        """Initialize the estimator
+
+        :param dbconn: a DbConnection object
+        :param read_rate: sequential read throughput, in MB per second
+        :param write_rate: write throughput, including WAL, in MB/s
+        :param index_ratio: size of a new index relative to its table
+        :param overhead: fixed time per statement, in seconds
+        """
+        self.dbconn = dbconn
+        if read_rate:
+            self.read_rate = read_rate
+        if write_rate:
+            self.write_rate = write_rate
+        if index_ratio:
+            self.index_ratio = index_ratio
+        if overhead is not None:
+            self.overhead = overhead
+        self.sizes = None
+
+    def fetch_sizes(self):
+        """Fetch the size of each table, its TOAST table and indexes
+
+        :return: dictionary keyed by the qualified table name
+        """
+        if not self.dbconn.conn:
+            self.dbconn.connect()
+        self.sizes = {}
+        for row in self.dbconn.fetchall(self.query):
+            row = dict(row)
+            name = DbSchemaObject(schema=row.pop('schema'),
+                                  name=row.pop('name')).qualname()
+            self.sizes[name] = row
+        return self.sizes
+
+    def _cost(self, info):
+        """Return bytes read and written by an analyzed statement"""
+        read = write = 0
+        for table in info['tables'][:1]:
+            if table not in self.sizes:
+                continue
+            size = self.sizes[table]
+            data = size['heap'] + size['toast']
+            if info['rewrite']:
+                # the table is copied and all its indexes rebuilt
+                read += data * (1 + size['num_indexes'])
+                write += data + size['indexes']
+            else:
+                if info['scan']:
+                    read += size['heap']
+                if info['index_build']:
+                    read += data
+                    write += size['heap'] * self.index_ratio
+        return (read, write)
+
+    def estimate(self, stmts, type_changes=None):
+        """Estimate the cost of each statement and table
+
+        :param stmts: list of SQL statements
+        :param type_changes: list of column type classifications, as
+          saved by Database.diff_map
+        :return: tuple of a list with one dictionary per statement
+          and a dictionary keyed by table name
+
+        Each statement dictionary has the keys returned by
+        `pyrseas.plan.analyze_statement`, plus `statement`, `rows`
+        (estimated rows in the first table), `read_mb`, `write_mb` and
+        `seconds`.  The table dictionary accumulates `statements`,
+        `read_mb`, `write_mb` and `seconds` per table, along with its
+        current sizes.
+        """
+        if self.sizes is None:
+            self.fetch_sizes()
+        stmtcosts = []
+        tables = {}
+        for (stmt, info) in zip(stmts, analyze_plan(
+                stmts, self.dbconn.version, type_changes)):
+            (read, write) = self._cost(info)
+            info.update(statement=stmt, read_mb=read / MB,
+                        write_mb=write / MB,
+                        seconds=self.overhead + read / MB / self.read_rate
+                        + write / MB / self.write_rate, rows=0)
+            if info['tables'] and info['tables'][0] in self.sizes:
+                table = info['tables'][0]
+                info['rows'] = int(self.sizes[table]['rows'])
+                if table not in tables:
+                    tables[table] = dict(self.sizes[table], statements=0,
+                                         read_mb=0.0, write_mb=0.0,
+                                         seconds=0.0, rewrite=False,
+                                         scan=False)
+                tblcost = tables[table]
+                tblcost['statements'] += 1
+                for key in ['read_mb', 'write_mb', 'seconds']:
+                    tblcost[key] += info[key]
+                for key in ['rewrite', 'scan']:
+                    tblcost[key] = tblcost[key] or info[key]
+            stmtcosts.append(info)
+        return (stmtcosts, tables)
+
+    def report(self, stmts, type_changes=None):
+        """Return a printable report of the estimated costs
+
+        :param stmts: list of SQL statements
+        :param type_changes: list of column type classifications
+        :return: list of lines
+        """
+        (stmtcosts, tables) = self.estimate(stmts, type_changes)
+        lines = ["-- estimated cost per statement:"]
+        for (num, info) in enumerate(stmtcosts):
+            if not info['tables']:
+                continue
+            flags = [flag for flag in ['rewrite', 'scan', 'index_build']
+                     if info[flag]]
+            lines.append("-- %4d %-30s %-22s %10.1f MB read %10.1f MB "
+                         "written %8.1f s %s" % (
+                    num + 1, info['tables'][0], info['lock'] or '',
+                    info['read_mb'], info['write_mb'], info['seconds'],
+                    ",".join(flags)))
+            lines.append("--      %s" % info['statement'].split('\n')[0])
+        lines.append("-- estimated cost per table:")
+        for table in sorted(tables.keys()):
+            tblcost = tables[table]
+            lines.append("-- %-30s %12d rows %10.1f MB read %10.1f MB "
+                         "written %8.1f s %s" % (
+                    table, tblcost['rows'], tblcost['read_mb'],
+                    tblcost['write_mb'], tblcost['seconds'],
+                    tblcost['rewrite'] and 'rewrite' or
+                    (tblcost['scan'] and 'scan' or '')))
+        lines.append("-- estimated total: %.1f s" % sum(
+                [info['seconds'] for info in stmtcosts]))
+        return lines
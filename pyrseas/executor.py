@@ -0,0 +1,590 @@
+# -*- coding: utf-8 -*-
+"""
+    pyrseas.executor
+    ~~~~~~~~~~~~~~~~
+
+    An `Executor` applies the statements generated by
+    Database.diff_map to a database, timing each statement and
+    recording the locks it acquired.
+"""
+import heapq
+import json
+import random
+import time
+from Queue import Queue
+from threading import Thread
+
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+from pyrseas.plan import SEARCH_PATH, analyze_plan, chunk_plan
+from pyrseas.plan import parse_backfill, statement_dependencies
+
+OK = 'ok'
+FAILED = 'failed'
+ROLLED_BACK = 'rolled back'
+TIMED_OUT = 'timed out'
+
+LOCK_NOT_AVAILABLE = '55P03'
+QUERY_CANCELED = '57014'
+
+
+class Executor(object):
+    """An executor of SQL statements over a DbConnection"""
+
+    locks_query = \
+        """SELECT relation::regclass::text AS relation, mode
+           FROM pg_locks
+           WHERE pid = pg_backend_pid() AND locktype = 'relation'
+                 AND granted AND relation >= 16384
+           ORDER BY 1, 2"""
+
+    def __init__(self, dbconn, lock_timeout=None, statement_timeout=None,
+                 onetrans=False, time_limit=None, retries=0,
+                 retry_delay=0.5, max_delay=30.0, watchdog=None,
+                 throttle=None, journal=None, chunking=None,
+                 chunk_size=None, batch_size=10000, batch_sleep=0.0,
+                 progress=None):
+        """Initialize the executor
+
+        :param dbconn: a DbConnection object
+        :param lock_timeout: maximum wait for a lock, in milliseconds
+        :param statement_timeout: maximum duration of a statement, in
+          milliseconds
+        :param onetrans: run all statements in a single transaction
+        :param time_limit: time, in seconds, after which no further
+          statements are started
+        :param retries: number of times to retry a statement that
+          timed out waiting for a lock
+        :param retry_delay: delay, in seconds, before the first retry
+        :param max_delay: maximum delay, in seconds, between retries
+        :param watchdog: a `pyrseas.monitor.Watchdog`, to be started
+          during execution
+        :param throttle: a `pyrseas.monitor.LagThrottle`, to wait on
+          before each statement
+        :param journal: a `pyrseas.journal.Journal`, recording the
+          status of each statement
+        :param chunking: strategy for grouping statements in
+          transactions, as for `pyrseas.plan.chunk_plan`
+        :param chunk_size: maximum number of statements per chunk
+        :param batch_size: range of key values updated by each batch of
+          a backfill (see `run_batches`)
+        :param batch_sleep: pause, in seconds, between batches
+        :param progress: file to write the progress of backfills to
+        """
+        self.dbconn = dbconn
+        self.lock_timeout = lock_timeout
+        self.statement_timeout = statement_timeout
+        self.onetrans = onetrans
+        self.time_limit = time_limit
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.max_delay = max_delay
+        self.watchdog = watchdog
+        self.throttle = throttle
+        self.journal = journal
+        self.chunking = chunking
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.batch_sleep = batch_sleep
+        self.progress = progress
+        self.completed = set()
+        self.intrans = False
+        self.timed_out = False
+        self.started = None
+        self.duration = 0.0
+        self.report = []
+
+    def set_timeouts(self, dbconn=None):
+        """Set the lock and statement timeouts for the session
+
+        :param dbconn: DbConnection to use, if not the executor's own
+
+        The lock timeout is only available on PostgreSQL 9.3 or later.
+        """
+        dbconn = dbconn or self.dbconn
+        if self.lock_timeout is not None and dbconn.version >= 90300:
+            dbconn.execute("SET lock_timeout = %d" % self.lock_timeout)
+        if self.statement_timeout is not None:
+            dbconn.execute("SET statement_timeout = %d" %
+                           self.statement_timeout)
+        dbconn.conn.commit()
+
+    def _locks(self, dbconn):
+        "Return the relation locks held by the current transaction"
+        curs = dbconn.conn.cursor()
+        curs.execute(self.locks_query)
+        locks = [[row['relation'], row['mode']] for row in curs.fetchall()]
+        curs.close()
+        return locks
+
+    def _expired(self):
+        "Has the time limit been reached?"
+        if self.time_limit is not None and \
+                time.time() - self.started >= self.time_limit:
+            self.timed_out = True
+        return self.timed_out
+
+    def backoff(self, attempt):
+        """Return the delay before retrying a statement
+
+        :param attempt: number of the failed attempt, starting at 0
+        :return: delay in seconds
+
+        The delay doubles with each attempt, up to `max_delay`, and
+        is randomized between half and all of that value, so that
+        retries from concurrent migrations do not coincide.
+        """
+        delay = min(self.retry_delay * 2 ** attempt, self.max_delay)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def attempt(self, stmt, info, dbconn):
+        """Make a single attempt at executing a statement
+
+        :param stmt: SQL statement
+        :param info: dictionary returned by `analyze_statement`
+        :param dbconn: DbConnection to use
+        :return: dictionary reporting the attempt
+
+        Unless running in a transaction with other statements, the
+        statement is committed right away. Statements that cannot run in a
+        transaction block are executed in autocommit mode.  If there
+        is a watchdog, the sessions blocked by the statement are
+        reported under `blocking`.
+        """
+        entry = {'status': OK, 'rows': None, 'locks': [], 'error': None,
+                 'sqlstate': None, 'started': time.time() - self.started}
+        conn = dbconn.conn
+        autocommit = not info['transactional'] and not self.intrans
+        if autocommit:
+            isolation_level = conn.isolation_level
+            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        if self.watchdog:
+            pid = conn.get_backend_pid()
+            self.watchdog.watch(pid)
+        start = time.time()
+        try:
+            try:
+                rows = dbconn.execute(stmt)
+                duration = time.time() - start
+                if rows >= 0:
+                    entry['rows'] = rows
+                if not autocommit:
+                    entry['locks'] = self._locks(dbconn)
+                    if not self.intrans:
+                        start = time.time()
+                        conn.commit()
+                        duration += time.time() - start
+            except Exception, exc:
+                duration = time.time() - start
+                entry['status'] = FAILED
+                entry['error'] = str(exc.args[0]).strip()
+                entry['sqlstate'] = getattr(exc, 'pgcode', None)
+                if not autocommit:
+                    conn.rollback()
+        finally:
+            if self.watchdog:
+                entry['blocking'] = self.watchdog.unwatch(pid)
+            if autocommit:
+                conn.set_isolation_level(isolation_level)
+        entry['duration'] = duration
+        return entry
+
+    def _retryable(self, result):
+        "Did the attempt fail waiting for or holding a lock too long?"
+        return result['sqlstate'] == LOCK_NOT_AVAILABLE or (
+            result['sqlstate'] == QUERY_CANCELED and
+            result.get('blocking') and result['blocking']['cancelled'])
+
+    def run(self, stmt, info, dbconn=None):
+        """Execute a single statement, retrying on lock timeouts
+
+        :param stmt: SQL statement
+        :param info: dictionary returned by `analyze_statement`
+        :param dbconn: DbConnection to use, if not the executor's own
+        :return: dictionary reporting the execution
+
+        A statement that fails because it could not obtain a lock
+        within the lock timeout, or that was cancelled by the watchdog
+        for blocking other sessions, is retried, after a `backoff`
+        delay, up to `retries` times, except in a transaction with other
+        statements.  The
+        result of each attempt is reported under `attempts`, together
+        with the delay that followed it.  If there is a throttle, the
+        time spent waiting for the standbys to catch up is reported
+        under `throttled`.
+
+        Outside a transaction with other statements, a backfill is
+        executed in batches by `run_batches`.
+        """
+        dbconn = dbconn or self.dbconn
+        parsed = not self.intrans and parse_backfill(stmt)
+        if parsed:
+            return self.run_batches(stmt, info, parsed, dbconn)
+        attempts = []
+        throttled = 0.0
+        for num in range(self.retries + 1):
+            if self.throttle:
+                throttled += self.throttle.wait()
+            result = self.attempt(stmt, info, dbconn)
+            attempts.append(result)
+            if not self._retryable(result) or self.intrans \
+                    or num == self.retries or self._expired():
+                break
+            result['delay'] = self.backoff(num)
+            time.sleep(result['delay'])
+        entry = dict(result, statement=stmt, tables=info['tables'],
+                     lock=info['lock'], started=attempts[0]['started'])
+        if self.throttle:
+            entry['throttled'] = throttled
+        if len(attempts) > 1:
+            entry['attempts'] = attempts
+        return entry
+
+    def run_batches(self, stmt, info, parsed, dbconn):
+        """Execute a backfill in batches over ranges of its key
+
+        :param stmt: SQL statement
+        :param info: dictionary returned by `analyze_statement`
+        :param parsed: tuple returned by `pyrseas.plan.parse_backfill`
+        :param dbconn: DbConnection to use
+        :return: dictionary reporting the execution
+
+        Each batch updates the rows whose key falls in a range of
+        `batch_size` values, between the minimum and maximum found
+        when starting, and is committed, retried and throttled like a
+        statement on its own.  The backfill stops at the first failed
+        batch, or with a status of 'timed out' once the time limit is
+        reached.  Since the batches only update the rows that still
+        need it, an interrupted backfill can simply be run again.  The
+        number of batches is reported under `batches` and the rows,
+        locks and waits are summed over all batches.  If a progress
+        file was given, a line is written to it after each batch (see
+        `write_progress`).
+        """
+        (table, assignment, condition, key) = parsed
+        started = time.time() - self.started
+        (low, high) = dbconn.fetchone("SELECT min(%s), max(%s) FROM %s" % (
+                key, key, table))
+        entry = {'statement': stmt, 'tables': info['tables'],
+                 'lock': info['lock'], 'status': OK, 'started': started,
+                 'rows': 0, 'locks': [], 'error': None, 'sqlstate': None,
+                 'batches': 0}
+        if self.throttle:
+            entry['throttled'] = 0.0
+        start = low
+        while low is not None and start <= high:
+            if entry['batches']:
+                if self._expired():
+                    entry['status'] = TIMED_OUT
+                    break
+                if self.batch_sleep:
+                    time.sleep(self.batch_sleep)
+            where = "%s >= %d AND %s < %d" % (key, start, key,
+                                              start + self.batch_size)
+            if condition:
+                where = "(%s) AND %s" % (condition, where)
+            result = self.run("UPDATE %s SET %s WHERE %s" % (
+                    table, assignment, where), info, dbconn)
+            entry['batches'] += 1
+            entry['rows'] += result['rows'] or 0
+            for lock in result['locks']:
+                if lock not in entry['locks']:
+                    entry['locks'].append(lock)
+            if self.throttle:
+                entry['throttled'] += result['throttled']
+            if result['status'] != OK:
+                for attr in ['status', 'error', 'sqlstate']:
+                    entry[attr] = result[attr]
+                break
+            start += self.batch_size
+            if self.progress:
+                self.write_progress(table, entry, float(start - low) / (
+                        high - low + 1), time.time() - self.started - started)
+        entry['duration'] = time.time() - self.started - started
+        return entry
+
+    def write_progress(self, table, entry, done, elapsed):
+        """Write a line reporting the progress of a backfill
+
+        :param table: name of the table being updated
+        :param entry: dictionary reporting the backfill so far
+        :param done: fraction of the key range processed
+        :param elapsed: time, in seconds, since the backfill started
+
+        The remaining time is extrapolated from the time taken so far
+        to process the fraction of the key range done, assuming the
+        keys are evenly distributed.
+        """
+        done = min(done, 1.0)
+        remaining = int(elapsed * (1 - done) / done)
+        self.progress.write(
+            "%s: %d batches, %d rows, %.1f%% done, %d:%02d:%02d "
+            "remaining\n" % (table, entry['batches'], entry['rows'],
+                             done * 100, remaining // 3600,
+                             remaining // 60 % 60, remaining % 60))
+        self.progress.flush()
+
+    def execute(self, stmts, type_changes=None):
+        """Execute a list of statements, stopping at the first failure
+
+        :param stmts: list of SQL statements
+        :param type_changes: list of column type classifications, as
+          saved by Database.diff_map
+        :return: list of dictionaries, one per statement executed
+
+        Execution also stops if the time limit is reached.  Unless
+        running in a single transaction or in chunks (see `chunks`),
+        each statement is committed separately.  If a chunk fails, the
+        statements already executed in it are reported as rolled back.
+
+        Each dictionary has the keys `statement`, `tables` and `lock`
+        (as analyzed by `pyrseas.plan.analyze_plan`), `status`,
+        `started` (seconds since the start of the execution),
+        `duration` (in seconds), `rows` (affected, if known), `locks`
+        (list of relation and lock mode pairs actually held) and, if
+        the statement failed, `error` and `sqlstate`.  If the statement
+        was retried, `attempts` lists the result of each attempt.
+
+        With a journal, statements recorded as completed by a previous
+        execution are skipped, except for SET search_path.
+        """
+        self._begin()
+        try:
+            self.set_timeouts()
+            infos = analyze_plan(stmts, self.dbconn.version, type_changes)
+            for chunk in self.chunks(stmts, infos):
+                if not self._execute_chunk(stmts, infos, chunk):
+                    break
+        finally:
+            self._end()
+        return self.report
+
+    def chunks(self, stmts, infos):
+        """Return the chunks of statements to be run as transactions
+
+        :param stmts: list of SQL statements
+        :param infos: list of dictionaries, as returned by `analyze_plan`
+        :return: list of lists of statement indexes
+        """
+        if self.onetrans:
+            return [range(len(stmts))]
+        elif self.chunking:
+            return chunk_plan(stmts, infos, self.chunking, self.chunk_size)
+        return [[idx] for idx in range(len(stmts))]
+
+    def _execute_chunk(self, stmts, infos, chunk):
+        "Execute a chunk of statements, returning False to stop"
+        chunk = [idx for idx in chunk if not self._skip(idx, stmts[idx])]
+        self.intrans = self.onetrans or len(chunk) > 1
+        executed = []
+        for idx in chunk:
+            if self._expired():
+                if self.intrans:
+                    self.dbconn.conn.rollback()
+                    self._rollback(executed)
+                return False
+            entry = self.run(stmts[idx], infos[idx])
+            self.report.append(entry)
+            if entry['status'] != OK:
+                if self.intrans:
+                    self._rollback(executed)
+                self._record(idx, entry)
+                return False
+            executed.append((idx, entry))
+            if not self.intrans:
+                self._record(idx, entry)
+        if self.intrans:
+            self.dbconn.conn.commit()
+            for (idx, entry) in executed:
+                self._record(idx, entry)
+        return True
+
+    def _skip(self, idx, stmt):
+        "Was the statement completed by a previous execution?"
+        return idx in self.completed and not (
+            isinstance(stmt, basestring) and SEARCH_PATH.match(stmt))
+
+    def _record(self, idx, entry):
+        "Record the status of a statement in the journal"
+        if self.journal:
+            self.journal.record(idx, entry['status'])
+
+    def _rollback(self, executed):
+        "Mark the statements executed in a transaction as rolled back"
+        for (idx, entry) in executed:
+            entry['status'] = ROLLED_BACK
+            self._record(idx, entry)
+
+    def _begin(self):
+        "Connect and prepare for executing statements"
+        if not self.dbconn.conn:
+            self.dbconn.connect()
+        self.started = time.time()
+        self.timed_out = False
+        self.report = []
+        self.completed = self.journal and self.journal.completed() or set()
+        if self.journal:
+            self.journal.start(self.dbconn)
+        if self.watchdog:
+            self.watchdog.start()
+
+    def _end(self):
+        "Clean up after executing statements"
+        if self.watchdog:
+            self.watchdog.stop()
+        if self.throttle:
+            self.throttle.close()
+        if self.journal:
+            self.journal.finish()
+        self.duration = time.time() - self.started
+
+    def failed(self):
+        """Return the report entry of the failed statement, if any
+
+        :return: dictionary or None
+        """
+        for entry in self.report:
+            if entry['status'] == FAILED:
+                return entry
+        return None
+
+    def status(self):
+        """Return the overall status of the execution
+
+        :return: 'ok', 'failed' or 'timed out'
+        """
+        if self.failed():
+            return FAILED
+        elif self.timed_out:
+            return TIMED_OUT
+        return OK
+
+    def write_report(self, output):
+        """Write the execution report in JSON format
+
+        :param output: file to write to
+        """
+        json.dump({'database': self.dbconn.dbname,
+                   'started': time.strftime(
+                    '%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                   'duration': self.duration,
+                   'throttled': sum([entry.get('throttled', 0.0)
+                                     for entry in self.report]),
+                   'status': self.status(),
+                   'statements': self.report}, output, indent=2)
+        output.write('\n')
+
+
+class ParallelExecutor(Executor):
+    """An executor running independent statements concurrently"""
+
+    def __init__(self, dbconn, workers=2, **kwargs):
+        """Initialize the executor
+
+        :param dbconn: a DbConnection object
+        :param workers: maximum number of concurrent connections
+        :param kwargs: other options, as for `Executor`, except
+          `onetrans` and `chunking`
+        """
+        super(ParallelExecutor, self).__init__(dbconn, **kwargs)
+        self.workers = workers
+
+    def _work(self, dbconn, tasks, done):
+        "Run the statements received from tasks on a connection"
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            (idx, stmt, info) = task
+            done.put((idx, self.run(stmt, info, dbconn)))
+
+    def execute(self, stmts, type_changes=None):
+        """Execute a list of statements, in parallel where possible
+
+        :param stmts: list of SQL statements
+        :param type_changes: list of column type classifications, as
+          saved by Database.diff_map
+        :return: list of dictionaries, one per statement executed
+
+        A statement is started once all the statements it depends on,
+        as determined by `pyrseas.plan.statement_dependencies`, have
+        completed, on the first idle connection.  SET search_path
+        statements are run on every connection.  After a failure, or
+        once the time limit is reached, no further statements are
+        started, but those already running are allowed to complete.
+        The dictionaries are as described for `Executor.execute`.
+        """
+        self._begin()
+        dbconns = [self.dbconn]
+        tasks = Queue()
+        done = Queue()
+        threads = []
+        entries = {}
+        running = 0
+        stop = False
+        try:
+            infos = analyze_plan(stmts, self.dbconn.version, type_changes)
+            deps = statement_dependencies(stmts, infos)
+            dependents = [[] for stmt in stmts]
+            for (idx, prior) in enumerate(deps):
+                for dep in prior:
+                    dependents[dep].append(idx)
+            for (idx, stmt) in enumerate(stmts):
+                if self._skip(idx, stmt):
+                    for dependent in dependents[idx]:
+                        deps[dependent].discard(idx)
+            ready = [idx for (idx, prior) in enumerate(deps)
+                     if not prior and not self._skip(idx, stmts[idx])]
+            heapq.heapify(ready)
+
+            for num in range(1, min(self.workers, len(stmts))):
+                dbconn = self.dbconn.clone()
+                dbconn.connect()
+                dbconns.append(dbconn)
+            for dbconn in dbconns:
+                self.set_timeouts(dbconn)
+            for dbconn in dbconns:
+                thread = Thread(target=self._work, args=(dbconn, tasks, done))
+                thread.start()
+                threads.append(thread)
+
+            while True:
+                while ready and running < len(dbconns) and not stop:
+                    if self._expired():
+                        stop = True
+                        break
+                    idx = heapq.heappop(ready)
+                    (stmt, info) = (stmts[idx], infos[idx])
+                    if isinstance(stmt, basestring) and \
+                            SEARCH_PATH.match(stmt):
+                        # session setting: nothing else is running
+                        for dbconn in dbconns[1:]:
+                            self.run(stmt, info, dbconn)
+                        done.put((idx, self.run(stmt, info)))
+                    else:
+                        tasks.put((idx, stmt, info))
+                    running += 1
+                if not running:
+                    break
+                (idx, entry) = done.get()
+                running -= 1
+                entries[idx] = entry
+                self._record(idx, entry)
+                if entry['status'] != OK:
+                    stop = True
+                    continue
+                for dependent in dependents[idx]:
+                    deps[dependent].discard(idx)
+                    if not deps[dependent] and \
+                            not self._skip(dependent, stmts[dependent]):
+                        heapq.heappush(ready, dependent)
+        finally:
+            for thread in threads:
+                tasks.put(None)
+            for thread in threads:
+                thread.join()
+            for dbconn in dbconns[1:]:
+                dbconn.close()
+            self._end()
+        self.report = [entries[idx] for idx in sorted(entries.keys())]
+        return self.report
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+    pyrseas.identifier
+    ~~~~~~~~~~~~~~~~~~
+
+    Functions to quote SQL identifiers, taking into account the
+    keywords of each PostgreSQL version, and to parse possibly quoted
+    and schema-qualified names.  The parsing results are kept in a
+    least recently used memo, since the same names recur for every
+    object that refers to them.
+"""
+import re
+
+REGULAR_ID = re.compile(r'[a-z_][a-z0-9_$]*\Z')
+_regular = REGULAR_ID.match
+PART = r'(?:"((?:[^"]|"")*)"|([^".]*))'
+QUALNAME = re.compile(r'%s(?:\.%s)?\Z' % (PART, PART))
+
+# Keywords that are not usable as column names without quoting, i.e.,
+# other than PostgreSQL's unreserved keywords, mapped to the first
+# server version where that is the case.
+KEYWORDS = {
+    'all': 0, 'analyse': 0, 'analyze': 0, 'and': 0, 'any': 0,
+    'array': 0, 'as': 0, 'asc': 0, 'asymmetric': 0, 'authorization': 0,
+    'between': 0, 'bigint': 0, 'binary': 0, 'bit': 0, 'boolean': 0,
+    'both': 0, 'case': 0, 'cast': 0, 'char': 0, 'character': 0,
+    'check': 0, 'coalesce': 0, 'collate': 90100, 'collation': 90100,
+    'column': 0, 'concurrently': 80200, 'constraint': 0, 'create': 0,
+    'cross': 0, 'current_catalog': 80400, 'current_date': 0,
+    'current_role': 0, 'current_schema': 90000, 'current_time': 0,
+    'current_timestamp': 0, 'current_user': 0, 'dec': 0, 'decimal': 0,
+    'default': 0, 'deferrable': 0, 'desc': 0, 'distinct': 0, 'do': 0,
+    'else': 0, 'end': 0, 'except': 0, 'exists': 0, 'extract': 0,
+    'false': 0, 'fetch': 80400, 'float': 0, 'for': 0, 'foreign': 0,
+    'freeze': 0, 'from': 0, 'full': 0, 'grant': 0, 'greatest': 0,
+    'group': 0, 'grouping': 90500, 'having': 0, 'ilike': 0, 'in': 0,
+    'initially': 0, 'inner': 0, 'inout': 0, 'int': 0, 'integer': 0,
+    'intersect': 0, 'interval': 0, 'into': 0, 'is': 0, 'isnull': 0,
+    'join': 0, 'json': 160000, 'json_array': 160000,
+    'json_arrayagg': 160000, 'json_exists': 170000,
+    'json_object': 160000, 'json_objectagg': 160000,
+    'json_query': 170000, 'json_scalar': 160000,
+    'json_serialize': 160000, 'json_table': 170000,
+    'json_value': 170000, 'lateral': 90300, 'leading': 0, 'least': 0,
+    'left': 0, 'like': 0, 'limit': 0, 'localtime': 0,
+    'localtimestamp': 0, 'merge_action': 170000, 'national': 0,
+    'natural': 0, 'nchar': 0, 'none': 0, 'normalize': 130000, 'not': 0,
+    'notnull': 0, 'null': 0, 'nullif': 0, 'numeric': 0, 'offset': 0,
+    'on': 0, 'only': 0, 'or': 0, 'order': 0, 'out': 0, 'outer': 0,
+    'overlaps': 0, 'overlay': 0, 'placing': 0, 'position': 0,
+    'precision': 0, 'primary': 0, 'real': 0, 'references': 0,
+    'returning': 80200, 'right': 0, 'row': 0, 'select': 0,
+    'session_user': 0, 'setof': 0, 'similar': 0, 'smallint': 0,
+    'some': 0, 'substring': 0, 'symmetric': 0, 'system_user': 160000,
+    'table': 0, 'tablesample': 90500, 'then': 0, 'time': 0,
+    'timestamp': 0, 'to': 0, 'trailing': 0, 'treat': 0, 'trim': 0,
+    'true': 0, 'union': 0, 'unique': 0, 'user': 0, 'using': 0,
+    'values': 0, 'varchar': 0, 'variadic': 80400, 'verbose': 0,
+    'when': 0, 'where': 0, 'window': 80400, 'with': 0,
+    'xmlattributes': 80300, 'xmlconcat': 80300, 'xmlelement': 80300,
+    'xmlexists': 90100, 'xmlforest': 80300, 'xmlnamespaces': 100000,
+    'xmlparse': 80300, 'xmlpi': 80300, 'xmlroot': 80300,
+    'xmlserialize': 80300, 'xmltable': 100000}
+
+ALL_KEYWORDS = frozenset(KEYWORDS)
+_keywords = {}
+
+
+def keywords(version=None):
+    """Return the keywords that must be quoted as identifiers
+
+    :param version: the server's version number, e.g., 90400, or None
+      for the most recent
+    :return: frozenset of lowercase keywords
+    """
+    if not version:
+        return ALL_KEYWORDS
+    try:
+        return _keywords[version]
+    except KeyError:
+        kwds = _keywords[version] = frozenset(
+            [kwd for (kwd, since) in KEYWORDS.items() if since <= version])
+        return kwds
+
+
+def quote_id(name, version=None):
+    """Quote an identifier if necessary
+
+    :param name: identifier to be quoted
+    :param version: the server's version number, or None to quote all
+      the keywords of the most recent version
+    :return: possibly quoted string
+
+    An identifier is quoted unless it consists only of lowercase
+    letters, digits, underscores and dollar signs, does not start
+    with a digit or dollar sign and is not a keyword.  Embedded
+    double quotes are doubled.
+
+    The database objects do not pass a version: they quote the
+    keywords of the most recent version, which is valid on every
+    server, so that the statements and YAML output do not depend on
+    the server they were generated for.
+    """
+    if _regular(name):
+        if version:
+            if name not in keywords(version):
+                return name
+        elif name not in ALL_KEYWORDS:
+            return name
+    if '"' in name:
+        return '"%s"' % name.replace('"', '""')
+    return '"' + name + '"'
+
+
+class LRUMemo(object):
+    """A least recently used memo of the results of a function
+
+    The function must take hashable positional arguments only.  The
+    entries form a circular doubly linked list, most recently used
+    first, so that hits and evictions take constant time.
+    """
+
+    def __init__(self, func, maxsize=10000):
+        """Initialize the memo
+
+        :param func: function whose results are to be kept
+        :param maxsize: maximum number of results kept
+        """
+        self.func = func
+        self.maxsize = maxsize
+        self.__doc__ = func.__doc__
+        self.__name__ = func.__name__
+        self.clear()
+
+    def clear(self):
+        "Forget all the results and reset the hit and miss counts"
+        self.hits = self.misses = 0
+        self.cache = {}
+        # each link is [previous, next, key, result]
+        self.root = root = []
+        root[:] = [root, root, None, None]
+
+    def __call__(self, *args):
+        cache = self.cache
+        link = cache.get(args)
+        root = self.root
+        if link is not None:
+            (prev, nxt) = link[:2]
+            prev[1] = nxt
+            nxt[0] = prev
+            first = root[1]
+            link[0] = root
+            link[1] = first
+            first[0] = root[1] = link
+            self.hits += 1
+            return link[3]
+        result = self.func(*args)
+        self.misses += 1
+        if len(cache) >= self.maxsize:
+            last = root[0]
+            root[0] = last[0]
+            last[0][1] = root
+            del cache[last[2]]
+        first = root[1]
+        link = [root, first, args, result]
+        first[0] = root[1] = cache[args] = link
+        return result
+
+
+def memoize(maxsize=10000):
+    """Return a decorator keeping the results of a function in an LRUMemo
+
+    :param maxsize: maximum number of results kept
+    """
+    def decorator(func):
+        return LRUMemo(func, maxsize)
+    return decorator
+
+
+@memoize()
+def split_qualname(name, schema=None):
+    """Parse a possibly quoted and schema-qualified name
+
+    :param name: name, e.g., 't1', 's1.t1' or '"My Schema"."a.b"'
+    :param schema: schema to assume if the name is not qualified, by
+      default 'public'
+    :return: tuple of unquoted schema and name
+
+    Unquoted parts are returned as is, i.e., not folded to lowercase.
+    A name that cannot be parsed is returned whole.
+    """
+    match = QUALNAME.match(name)
+    if not match:
+        return (schema or 'public', name)
+    (qsch, sch, qname, qualname) = match.groups()
+    if qname is None and qualname is None:
+        return (schema or 'public', qsch is not None and
+                qsch.replace('""', '"') or sch)
+    return (qsch is not None and qsch.replace('""', '"') or sch,
+            qname is not None and qname.replace('""', '"') or qualname)
+
+
+def quote_qualname(schema, name, version=None):
+    """Return a schema-qualified name, quoting each part if necessary
+
+    :param schema: schema name, omitted if 'public'
+    :param name: object name
+    :param version: the server's version number
+    :return: SQL name
+    """
+    if schema == 'public':
+        return quote_id(name, version)
+    return "%s.%s" % (quote_id(schema, version), quote_id(name, version))
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+    pyrseas.journal
+    ~~~~~~~~~~~~~~~
+
+    A `Journal` persists a plan, i.e., the statements generated by
+    Database.diff_map, together with the completion status of each
+    statement, so that an interrupted migration can be resumed.
+"""
+import json
+import os
+
+from pyrseas.dbobject import md5_hex
+from pyrseas.executor import OK
+
+PENDING = 'pending'
+
+USER_SCHEMAS = "nspname NOT IN ('pg_catalog', 'information_schema') " \
+    "AND nspname !~ '^pg_(toast|temp_)'"
+
+CATALOG_QUERY = """
+    SELECT md5(array_to_string(ARRAY(
+        SELECT 'n ' || n.oid || ' ' || nspname || ' ' || nspowner || ' ' ||
+               coalesce(nspacl::text, '')
+        FROM pg_namespace n WHERE %(user)s
+      UNION ALL
+        SELECT 'c ' || c.oid || ' ' || relname || ' ' || relkind || ' ' ||
+               relowner || ' ' || coalesce(relacl::text, '')
+        FROM pg_class c JOIN pg_namespace n ON (relnamespace = n.oid)
+        WHERE %(user)s
+      UNION ALL
+        SELECT 'a ' || attrelid || ' ' || attnum || ' ' || attname || ' ' ||
+               atttypid || ' ' || atttypmod || ' ' || attnotnull || ' ' ||
+               attisdropped || ' ' || coalesce(pg_get_expr(adbin, adrelid), '')
+        FROM pg_attribute JOIN pg_class c ON (attrelid = c.oid)
+             JOIN pg_namespace n ON (relnamespace = n.oid)
+             LEFT JOIN pg_attrdef ON (adrelid = attrelid AND adnum = attnum)
+        WHERE attnum > 0 AND %(user)s
+      UNION ALL
+        SELECT 'k ' || c.oid || ' ' || conname || ' ' ||
+               pg_get_constraintdef(c.oid)
+        FROM pg_constraint c JOIN pg_namespace n ON (connamespace = n.oid)
+        WHERE %(user)s
+      UNION ALL
+        SELECT 'i ' || indexrelid || ' ' || indisvalid
+        FROM pg_index JOIN pg_class c ON (indexrelid = c.oid)
+             JOIN pg_namespace n ON (relnamespace = n.oid)
+        WHERE %(user)s
+      UNION ALL
+        SELECT 'p ' || p.oid || ' ' || proname || ' ' || md5(prosrc) || ' ' ||
+               proowner || ' ' || coalesce(proacl::text, '')
+        FROM pg_proc p JOIN pg_namespace n ON (pronamespace = n.oid)
+        WHERE %(user)s
+      UNION ALL
+        SELECT 't ' || t.oid || ' ' || typname || ' ' || typowner
+        FROM pg_type t JOIN pg_namespace n ON (typnamespace = n.oid)
+        WHERE %(user)s
+      UNION ALL
+        SELECT 'e ' || enumtypid || ' ' || enumlabel FROM pg_enum
+      UNION ALL
+        SELECT 'g ' || t.oid || ' ' || tgname || ' ' || tgenabled
+        FROM pg_trigger t JOIN pg_class c ON (tgrelid = c.oid)
+             JOIN pg_namespace n ON (relnamespace = n.oid)
+        WHERE %(user)s
+      UNION ALL
+        SELECT 'r ' || r.oid || ' ' || rulename || ' ' ||
+               md5(ev_action::text)
+        FROM pg_rewrite r JOIN pg_class c ON (ev_class = c.oid)
+             JOIN pg_namespace n ON (relnamespace = n.oid)
+        WHERE %(user)s
+      UNION ALL
+        SELECT 'd ' || objoid || ' ' || objsubid || ' ' || md5(description)
+        FROM pg_description
+      ORDER BY 1), ','))""" % {'user': USER_SCHEMAS}
+
+
+def catalog_checksum(dbconn):
+    """Return a checksum of the current state of a database's catalogs
+
+    :param dbconn: a DbConnection object
+    :return: hexadecimal digest
+
+    The checksum covers the schemas, relations, columns, constraints,
+    indexes, functions, types, triggers, rules and comments, with
+    their object identifiers, owners and privileges, so that any
+    change to the objects that a plan may create, alter or drop
+    changes it.  It is computed by the server in a single query,
+    cheaply enough to be recorded after every statement.
+    """
+    return dbconn.fetchone(CATALOG_QUERY)[0]
+
+
+class Journal(object):
+    """A journal of the execution of a plan, kept in a JSON file"""
+
+    def __init__(self, path):
+        """Initialize the journal
+
+        :param path: name of the journal file
+        """
+        self.path = path
+        self.state = None
+        self.dbconn = None
+
+    def load(self):
+        """Read the journal file, if it exists
+
+        :return: True if there is an incomplete plan to resume
+        """
+        if not os.path.exists(self.path):
+            self.state = None
+            return False
+        self.state = json.load(open(self.path))
+        return not self.state['complete']
+
+    def save(self):
+        "Write the journal file, replacing it atomically"
+        tmppath = self.path + '.tmp'
+        output = open(tmppath, 'w')
+        json.dump(self.state, output, indent=2)
+        output.write('\n')
+        output.close()
+        os.rename(tmppath, self.path)
+
+    def begin(self, stmts, spec_checksum, type_changes=None):
+        """Start journaling a new plan
+
+        :param stmts: list of SQL statements
+        :param spec_checksum: checksum of the input specification
+        :param type_changes: list of column type classifications, as
+          saved by Database.diff_map
+        """
+        self.state = {'plan_checksum': md5_hex("\n".join(stmts)),
+                      'spec_checksum': spec_checksum,
+                      'catalog_checksum': None, 'complete': False,
+                      'type_changes': [list(change) for change in
+                                       type_changes or []],
+                      'statements': [{'statement': stmt, 'status': PENDING}
+                                     for stmt in stmts]}
+        self.save()
+
+    @property
+    def statements(self):
+        "The SQL statements of the plan"
+        return [stmt['statement'] for stmt in self.state['statements']]
+
+    @property
+    def type_changes(self):
+        """The column type classifications made with the plan
+
+        A resumed plan is analyzed with them, as it was originally,
+        since the columns have possibly changed type in the meantime.
+        """
+        return [tuple(change) for change in
+                self.state.get('type_changes', [])]
+
+    def completed(self):
+        """Return the indexes of the statements already completed
+
+        :return: set of integers
+        """
+        return set([idx for (idx, stmt) in enumerate(
+                    self.state['statements']) if stmt['status'] == OK])
+
+    def start(self, dbconn):
+        """Record the start of an execution
+
+        :param dbconn: a DbConnection object, cloned to compute the
+          catalog checksums while statements run on the original
+        """
+        self.dbconn = dbconn.clone()
+        self.dbconn.connect()
+
+    def record(self, idx, status):
+        """Record the status of a statement
+
+        :param idx: index of the statement in the plan
+        :param status: execution status
+
+        A checksum of the catalogs, as committed once the statement
+        has completed, is recorded with it, so that an execution that
+        is killed before it can finish can still be verified.
+        """
+        self.state['statements'][idx]['status'] = status
+        self.state['catalog_checksum'] = self.dbconn and \
+            catalog_checksum(self.dbconn)
+        self.save()
+
+    def finish(self):
+        """Record the end of an execution
+
+        If all the statements have completed, the plan is marked as
+        complete.  Otherwise, a checksum of the catalogs is recorded,
+        to be verified before resuming.
+        """
+        if len(self.completed()) == len(self.state['statements']):
+            self.state['complete'] = True
+        else:
+            self.state['catalog_checksum'] = catalog_checksum(self.dbconn)
+        self.save()
+        self.dbconn.close()
+        self.dbconn = None
+
+    def verify(self, dbconn, spec_checksum, stmts=None):
+        """Verify that the plan can be resumed
+
+        :param dbconn: a DbConnection object
+        :param spec_checksum: checksum of the input specification
+        :param stmts: plan regenerated from the current catalogs, used
+          if no catalog checksum was recorded
+        :return: error message, or None if the plan can be resumed
+
+        The input specification must not have changed since the plan
+        was generated and the catalogs must match their state when
+        the last statement was recorded.  If the execution was
+        interrupted before any statement was recorded, the plan must
+        instead be the one that would now be generated.
+        """
+        if md5_hex("\n".join(self.statements)) != \
+                self.state['plan_checksum']:
+            return "journal %s has been modified" % self.path
+        if spec_checksum != self.state['spec_checksum']:
+            return "input specification has changed since journal " \
+                "%s was started" % self.path
+        if self.state['catalog_checksum'] is not None:
+            if catalog_checksum(dbconn) != self.state['catalog_checksum']:
+                return "database has changed since journal %s was " \
+                    "last updated" % self.path
+        else:
+            done = self.completed()
+            pending = [stmt for (idx, stmt) in enumerate(self.statements)
+                       if idx not in done]
+            if stmts is None or stmts != pending:
+                return "database does not match the statements pending " \
+                    "in journal %s" % self.path
+        return None
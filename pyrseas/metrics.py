@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+    pyrseas.metrics
+    ~~~~~~~~~~~~~~~
+
+    `Metrics` collects counters and timings of a dbtoyaml or yamltodb
+    run, e.g., the duration of each catalog query, the number of
+    objects of each type, the statements generated of each kind and
+    the size of the YAML output, and writes them as a JSON stats file
+    or in the Prometheus text exposition format.
+"""
+import json
+import time
+
+from pyrseas.plan import statement_kind
+
+DESCRIPTIONS = {
+    'phase_seconds': "Wall clock time of each phase, in seconds",
+    'phase_cpu_seconds': "CPU time of each phase, in seconds",
+    'catalog_query_seconds': "Duration of each catalog query, in seconds",
+    'catalog_query_rows': "Rows returned by each catalog query",
+    'objects': "Database objects, by type",
+    'statements': "SQL statements generated, by kind",
+    'yaml_bytes': "Size of the YAML output, in bytes",
+    'peak_memory_bytes': "Peak memory of the process, in bytes",
+    'run_timestamp_seconds': "Time the run ended, in seconds since the "
+    "epoch"}
+
+
+class Metrics(object):
+    """A set of named values, each qualified by labels"""
+
+    prefix = 'pyrseas_'
+
+    def __init__(self, program, dbname):
+        """Initialize the metrics
+
+        :param program: name of the utility, e.g., 'dbtoyaml'
+        :param dbname: name of the database
+        """
+        self.labels = {'program': program, 'database': dbname}
+        self.values = {}
+
+    def add(self, name, value, **labels):
+        """Add a value to a metric
+
+        :param name: name of the metric, without prefix
+        :param value: number to add
+        :param labels: labels qualifying the value
+
+        Values with the same name and labels are summed, e.g., the
+        durations of a phase run more than once.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        self.values[key] = self.values.get(key, 0) + value
+
+    def from_profiler(self, profiler):
+        """Add the timings recorded by a profiler
+
+        :param profiler: a Profiler
+
+        The catalog queries of each DbObjectDict are labeled with the
+        name of the dictionary class.
+        """
+        peak = 0
+        for phase in profiler.phases:
+            if 'maxrss_kb' not in phase:
+                continue
+            peak = max(peak, phase['maxrss_kb'])
+            if phase['phase'] == 'query':
+                self.add('catalog_query_seconds', phase['wall'],
+                         dict=phase['parent'])
+                self.add('catalog_query_rows', phase['rows'],
+                         dict=phase['parent'])
+            elif phase['depth'] == 0 or phase['phase'] == 'link_refs':
+                self.add('phase_seconds', phase['wall'],
+                         phase=phase['phase'])
+                self.add('phase_cpu_seconds', phase['cpu'],
+                         phase=phase['phase'])
+        self.add('peak_memory_bytes', peak * 1024)
+
+    def objects(self, db):
+        """Count the objects of each type
+
+        :param db: a Database.Dicts object
+        """
+        for objdict in vars(db).values():
+            for obj in objdict.values():
+                for elem in isinstance(obj, list) and obj or [obj]:
+                    self.add('objects', 1, type=elem.__class__.__name__)
+
+    def statements(self, stmts):
+        """Count the statements of each kind
+
+        :param stmts: list of SQL statements
+        """
+        for stmt in stmts:
+            if isinstance(stmt, basestring):
+                self.add('statements', 1, kind=statement_kind(stmt))
+
+    def _sorted(self):
+        "Return the values, sorted by name and labels"
+        self.values[('run_timestamp_seconds', ())] = int(time.time())
+        return sorted(self.values.items())
+
+    def write_json(self, output):
+        """Write the metrics as a JSON stats file
+
+        :param output: file object
+        """
+        metrics = []
+        for ((name, labels), value) in self._sorted():
+            metrics.append({'name': name, 'labels': dict(labels),
+                            'value': value})
+        json.dump({'labels': self.labels, 'metrics': metrics}, output,
+                  indent=2)
+        output.write('\n')
+
+    def write_prometheus(self, output):
+        """Write the metrics in the Prometheus text exposition format
+
+        :param output: file object
+
+        All metrics are written as gauges, e.g., for collection by
+        the node exporter's textfile collector.
+        """
+        last = None
+        for ((name, labels), value) in self._sorted():
+            if name != last:
+                output.write("# HELP %s%s %s\n" % (self.prefix, name,
+                                                   DESCRIPTIONS[name]))
+                output.write("# TYPE %s%s gauge\n" % (self.prefix, name))
+                last = name
+            labels = sorted(self.labels.items()) + list(labels)
+            output.write("%s%s{%s} %s\n" % (
+                    self.prefix, name, ",".join([
+                            '%s="%s"' % (label, str(val).replace(
+                                    '\\', '\\\\').replace('"', '\\"'))
+                            for (label, val) in labels]), value))
+
+    def write(self, output, format='json'):
+        """Write the metrics in the given format
+
+        :param output: file object
+        :param format: 'json' or 'prometheus'
+        """
+        if format == 'prometheus':
+            self.write_prometheus(output)
+        else:
+            self.write_json(output)
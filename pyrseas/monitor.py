@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+    pyrseas.monitor
+    ~~~~~~~~~~~~~~~
+
+    A `Watchdog` watches, from a separate connection, the sessions
+    that are blocked by the statements being executed by an
+    Executor, and cancels a statement that blocks too many sessions
+    or for too long.  A `LagThrottle` pauses the execution while the
+    standbys lag too far behind.
+"""
+import sys
+import time
+from threading import Event, Lock, Thread
+
+
+class Watchdog(object):
+    """A monitor of the sessions blocked by a migration"""
+
+    blocking_query = \
+        """SELECT blocker AS pid, count(*) AS blocked,
+                  COALESCE(max(EXTRACT(epoch FROM now() - query_start)),
+                           0) AS wait
+           FROM (SELECT unnest(pg_blocking_pids(pid)) AS blocker,
+                        query_start
+                 FROM pg_stat_activity) a
+           WHERE blocker IN (%s)
+           GROUP BY blocker"""
+
+    blocking_query_locks = \
+        """SELECT l.pid, count(DISTINCT w.pid) AS blocked,
+                  COALESCE(max(EXTRACT(epoch FROM now() - a.query_start)),
+                           0) AS wait
+           FROM pg_locks l
+                JOIN pg_locks w ON (w.locktype = l.locktype
+                     AND w.database IS NOT DISTINCT FROM l.database
+                     AND w.relation IS NOT DISTINCT FROM l.relation
+                     AND w.transactionid IS NOT DISTINCT FROM l.transactionid
+                     AND w.pid != l.pid AND NOT w.granted)
+                JOIN pg_stat_activity a ON (a.%s = w.pid)
+           WHERE l.granted AND l.pid IN (%s)
+           GROUP BY l.pid"""
+
+    def __init__(self, dbconn, max_blocked=None, max_blocking_time=None,
+                 interval=1.0):
+        """Initialize the watchdog
+
+        :param dbconn: a DbConnection object, cloned for monitoring
+        :param max_blocked: number of blocked sessions at which a
+          statement is cancelled
+        :param max_blocking_time: time, in seconds, that a session may
+          be kept waiting before the statement is cancelled
+        :param interval: time, in seconds, between checks
+        """
+        self.dbconn = dbconn.clone()
+        self.max_blocked = max_blocked
+        self.max_blocking_time = max_blocking_time
+        self.interval = interval
+        self.stats = {}
+        self._lock = Lock()
+        self._stopped = Event()
+        self._thread = None
+
+    def start(self):
+        "Connect and start checking in a background thread"
+        if not self.dbconn.conn:
+            self.dbconn.connect()
+        self._stopped.clear()
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        "Stop checking and disconnect"
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.dbconn.close()
+
+    def watch(self, pid):
+        """Start watching a backend that is about to run a statement
+
+        :param pid: backend process ID
+        """
+        self._lock.acquire()
+        try:
+            self.stats[pid] = {'max_blocked': 0, 'max_wait': 0.0,
+                               'cancelled': False}
+        finally:
+            self._lock.release()
+
+    def unwatch(self, pid):
+        """Stop watching a backend and return its blocking statistics
+
+        :param pid: backend process ID
+        :return: dictionary with `max_blocked`, the maximum number of
+          sessions blocked at once, `max_wait`, the longest wait
+          observed, in seconds, and `cancelled`, whether the statement
+          was cancelled by the watchdog
+        """
+        self._lock.acquire()
+        try:
+            return self.stats.pop(pid, None)
+        finally:
+            self._lock.release()
+
+    def query(self, pids):
+        """Return the query counting the sessions blocked by backends
+
+        :param pids: list of backend process IDs
+        :return: SQL query
+
+        pg_blocking_pids() is used on PostgreSQL 9.6 or later.
+        Otherwise, sessions waiting for a lock granted to the backends
+        are found in pg_locks.
+        """
+        pids = ", ".join([str(pid) for pid in pids])
+        if self.dbconn.version >= 90600:
+            return self.blocking_query % pids
+        return self.blocking_query_locks % (
+            self.dbconn.version < 90200 and 'procpid' or 'pid', pids)
+
+    def check(self):
+        """Check the watched backends once, cancelling if needed
+
+        :return: list of cancelled backend process IDs
+
+        A backend is only cancelled if it is still running the
+        statement that was checked, i.e., it has not been unwatched
+        or watched again, e.g., for the next statement or a retry,
+        since the check query was issued.  The lock is held until the
+        cancel request is sent, so that the executor cannot start
+        another statement in the meantime.
+        """
+        self._lock.acquire()
+        try:
+            watched = self.stats.copy()
+        finally:
+            self._lock.release()
+        if not watched:
+            return []
+        if not self.dbconn.conn:
+            self.dbconn.connect()
+        cancel = []
+        rows = self.dbconn.fetchall(self.query(watched.keys()))
+        self._lock.acquire()
+        try:
+            for row in rows:
+                stats = self.stats.get(row['pid'])
+                if stats is None or stats is not watched.get(row['pid']) \
+                        or stats['cancelled']:
+                    continue
+                stats['max_blocked'] = max(stats['max_blocked'],
+                                           row['blocked'])
+                stats['max_wait'] = max(stats['max_wait'],
+                                        float(row['wait']))
+                if (self.max_blocked is not None and
+                    row['blocked'] >= self.max_blocked) or \
+                    (self.max_blocking_time is not None and
+                     float(row['wait']) >= self.max_blocking_time):
+                    stats['cancelled'] = True
+                    cancel.append(row['pid'])
+                    self.dbconn.fetchone("SELECT pg_cancel_backend(%d)"
+                                         % row['pid'])
+        finally:
+            self._lock.release()
+        return cancel
+
+    def _run(self):
+        """Check periodically until stopped
+
+        A failed check is reported on stderr and the connection is
+        re-established for the next check, so that monitoring goes on.
+        """
+        while not self._stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception, exc:
+                print >> sys.stderr, "watchdog check failed: %s" % exc
+                try:
+                    self.dbconn.close()
+                except Exception:
+                    self.dbconn.conn = None
+
+
+class LagThrottle(object):
+    """A throttle pausing a migration while standbys lag behind"""
+
+    def __init__(self, dbconn, max_lag, standby=None, interval=1.0):
+        """Initialize the throttle
+
+        :param dbconn: a DbConnection object to the primary, cloned
+        :param max_lag: replay lag, in bytes of WAL, above which the
+          migration is paused
+        :param standby: a DbConnection object to a standby, if the lag
+          is not to be taken from pg_stat_replication
+        :param interval: time, in seconds, between checks while paused
+        """
+        self.dbconn = dbconn.clone()
+        self.max_lag = max_lag
+        self.standby = standby
+        self.interval = interval
+        self.throttled = 0.0
+        self._lock = Lock()
+
+    def _functions(self, version):
+        "Return the names of the WAL location functions and column"
+        if version >= 100000:
+            return ('pg_current_wal_lsn', 'pg_wal_lsn_diff', 'replay_lsn',
+                    'pg_last_wal_replay_lsn')
+        return ('pg_current_xlog_location', 'pg_xlog_location_diff',
+                'replay_location', 'pg_last_xlog_replay_location')
+
+    def lag(self):
+        """Return the current replay lag
+
+        :return: lag in bytes of WAL, of the configured standby or the
+          most lagging one listed in pg_stat_replication (PostgreSQL
+          9.2 or later)
+        """
+        if not self.dbconn.conn:
+            self.dbconn.connect()
+        (current, diff, replay, last_replay) = self._functions(
+            self.dbconn.version)
+        if self.standby:
+            if not self.standby.conn:
+                self.standby.connect()
+            location = self.standby.fetchone("SELECT %s()" % self._functions(
+                    self.standby.version)[3])[0]
+            if location is None:
+                return 0
+            query = "SELECT %s(%s(), '%s')" % (diff, current, location)
+        else:
+            query = "SELECT max(%s(%s(), %s)) FROM pg_stat_replication" % (
+                diff, current, replay)
+        return int(self.dbconn.fetchone(query)[0] or 0)
+
+    def wait(self):
+        """Wait until the replay lag is below the maximum
+
+        :return: time waited, in seconds
+        """
+        self._lock.acquire()
+        try:
+            start = time.time()
+            waited = 0.0
+            while self.lag() > self.max_lag:
+                time.sleep(self.interval)
+                waited = time.time() - start
+            self.throttled += waited
+            return waited
+        finally:
+            self._lock.release()
+
+    def close(self):
+        "Close the connections"
+        self.dbconn.close()
+        if self.standby:
+            self.standby.close()
@@ -0,0 +1,532 @@
+# -*- coding: utf-8 -*-
+"""
+    pyrseas.plan
+    ~~~~~~~~~~~~
+
+    This module defines functions that analyze and rearrange a plan,
+    i.e., the list of SQL statements generated by
+    Database.diff_map.
+"""
+import re
+
+from pyrseas.dbobject.column import INDEX_REBUILD, NO_REWRITE
+from pyrseas.dbobject.column import VOLATILE_FUNCS
+
+
+IDENT = r'(?:"(?:[^"]|"")+"|[^\s",.()]+)'
+QUALNAME = r'%s(?:\.%s)?' % (IDENT, IDENT)
+QUALIFIED = re.compile(r'^%s\.%s$' % (IDENT, IDENT))
+
+ALTER_TABLE = re.compile(r'ALTER TABLE\s+(%s)\s+(.*)$' % QUALNAME, re.DOTALL)
+REFERENCES = re.compile(r'\bREFERENCES\s+(%s)' % QUALNAME)
+
+# ALTER TABLE subcommands that can share a statement with others
+MERGEABLE = ('ADD COLUMN', 'ALTER COLUMN', 'DROP COLUMN', 'ADD CONSTRAINT')
+
+
+def normalize_name(name):
+    """Return a relation name without the implicit 'public' schema
+
+    :param name: possibly schema-qualified relation name
+    :return: string
+    """
+    if name.startswith('public.'):
+        return name[7:]
+    return name
+
+
+def parse_alter_table(stmt):
+    """Split an ALTER TABLE statement into its components
+
+    :param stmt: SQL statement
+    :return: tuple of table name, subcommands and referenced tables,
+      or None if `stmt` is not an ALTER TABLE
+    """
+    match = ALTER_TABLE.match(stmt)
+    if not match:
+        return None
+    (table, subcmds) = match.groups()
+    return (table, subcmds.strip(), REFERENCES.findall(subcmds))
+
+
+def merge_alter_table(stmts):
+    """Combine ALTER TABLE subcommands on the same table
+
+    :param stmts: list of SQL statements
+    :return: list of SQL statements
+
+    An ALTER TABLE statement is folded into an earlier ALTER TABLE on
+    the same table when both only consist of subcommands in
+    `MERGEABLE` and no statement in between refers to the table or
+    to the tables referenced by the later statement.  Any statement
+    other than ALTER TABLE, e.g., SET search_path or CREATE INDEX,
+    prevents moving later statements before it.  This way, a table
+    is rewritten and locked once, instead of once per subcommand.
+    Tables are compared by their names qualified by the current
+    schema, following SET search_path, but the merged statement
+    names the table as the first statement did.
+    """
+    merged = []
+    subcmds = {}
+    tables = {}
+    opened = {}
+    last = {}
+    schema = 'public'
+    for stmt in stmts:
+        parsed = isinstance(stmt, basestring) and parse_alter_table(stmt)
+        if not parsed:
+            merged.append(stmt)
+            opened = {}
+            last = {}
+            match = isinstance(stmt, basestring) and SEARCH_PATH.match(stmt)
+            if match:
+                schema = match.group(1)
+            continue
+        (name, subcmd, refs) = parsed
+        table = qualify(name, schema)
+        refs = [qualify(ref, schema) for ref in refs]
+        mergeable = subcmd.startswith(MERGEABLE)
+        idx = opened.get(table)
+        if mergeable and idx is not None and last.get(table) == idx \
+                and max([last.get(ref, -1) for ref in refs] + [-1]) <= idx:
+            subcmds[idx].append(subcmd)
+            merged[idx] = "ALTER TABLE %s\n    %s" % (
+                tables[idx], ",\n    ".join(subcmds[idx]))
+            for ref in refs:
+                last[ref] = idx
+            continue
+        idx = len(merged)
+        merged.append(stmt)
+        for tbl in [table] + refs:
+            last[tbl] = idx
+        if mergeable:
+            opened[table] = idx
+            subcmds[idx] = [subcmd]
+            tables[idx] = name
+        elif table in opened:
+            del opened[table]
+    return merged
+
+
+ACCESS_EXCLUSIVE = 'ACCESS EXCLUSIVE'
+SHARE_ROW_EXCLUSIVE = 'SHARE ROW EXCLUSIVE'
+SHARE = 'SHARE'
+SHARE_UPDATE_EXCLUSIVE = 'SHARE UPDATE EXCLUSIVE'
+ROW_EXCLUSIVE = 'ROW EXCLUSIVE'
+LOCK_LEVELS = [ROW_EXCLUSIVE, SHARE_UPDATE_EXCLUSIVE, SHARE,
+               SHARE_ROW_EXCLUSIVE, ACCESS_EXCLUSIVE]
+
+SEARCH_PATH = re.compile(r'SET search_path TO (%s)' % IDENT)
+CREATE_INDEX = re.compile(
+    r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+(CONCURRENTLY\s+)?(?:%s\s+)?ON\s+(%s)'
+    % (IDENT, QUALNAME))
+ON_TABLE = re.compile(
+    r'(?:CREATE|DROP)\s+(?:CONSTRAINT\s+)?TRIGGER\s.*?\sON\s+(%s)'
+    % QUALNAME, re.DOTALL)
+RULE_TABLE = re.compile(
+    r'(?:CREATE\s+(?:OR\s+REPLACE\s+)?RULE\s+%s\s+AS\s+ON\s+\w+\s+TO'
+    r'|DROP\s+RULE\s+%s\s+ON)\s+(%s)' % (IDENT, IDENT, QUALNAME))
+RELATION = re.compile(
+    r'(CREATE|DROP|ALTER|COMMENT ON)\s+(?:OR\s+REPLACE\s+)?'
+    r'(TABLE|VIEW|SEQUENCE|INDEX)\s+(?:CONCURRENTLY\s+)?(%s)' % QUALNAME)
+COMMENT_COLUMN = re.compile(r'COMMENT ON COLUMN (%s)\.%s\s' % (QUALNAME,
+                                                               IDENT))
+ADD_VALUE = re.compile(r'ALTER TYPE\s+%s\s+ADD VALUE' % QUALNAME)
+NOT_NULL_CHECK = re.compile(r'ADD CONSTRAINT (%s) CHECK \((%s) IS NOT NULL\)'
+                            % (IDENT, IDENT))
+VALIDATE = re.compile(r'VALIDATE CONSTRAINT (%s)' % IDENT)
+DO_BLOCK = re.compile(r'DO \$_\$\n.*?^BEGIN\n(.*)^END\n\$_\$$',
+                      re.DOTALL | re.MULTILINE)
+BACKFILL = re.compile(r'UPDATE\s+(%s)\s+SET\s+(.*?)(?:\s+WHERE\s+(.*?))?'
+                      r'\s+/\* batched by (%s) \*/$' % (QUALNAME, IDENT),
+                      re.DOTALL)
+
+
+def parse_backfill(stmt):
+    """Parse an UPDATE generated by pyrseas.dbobject.column.backfill
+
+    :param stmt: SQL statement
+    :return: tuple of table, SET clause, WHERE clause (or None) and
+      key column, or None if the statement is not a batched backfill
+    """
+    if not isinstance(stmt, basestring):
+        return None
+    match = BACKFILL.match(stmt.strip())
+    return match and match.groups() or None
+
+
+def split_subcommands(subcmds):
+    """Split the subcommands of an ALTER TABLE statement
+
+    :param subcmds: comma-separated subcommands
+    :return: list of strings
+
+    Commas within parentheses or quotes do not separate subcommands.
+    """
+    result = []
+    depth = 0
+    quote = None
+    start = 0
+    for (pos, char) in enumerate(subcmds):
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            result.append(subcmds[start:pos].strip())
+            start = pos + 1
+    result.append(subcmds[start:].strip())
+    return [sub for sub in result if sub]
+
+
+def qualify(name, schema):
+    """Return a relation name qualified by the current schema
+
+    :param name: relation name, possibly schema-qualified
+    :param schema: first schema in the search_path
+    :return: string, not qualified for the 'public' schema
+    """
+    if QUALIFIED.match(name):
+        return normalize_name(name)
+    if schema == 'public':
+        return name
+    return "%s.%s" % (schema, name)
+
+
+def analyze_statement(stmt, schema='public', dbversion=0, type_changes=None,
+                      checked=None):
+    """Determine the tables affected by a statement and its effects
+
+    :param stmt: SQL statement
+    :param schema: first schema in the search_path
+    :param dbversion: the server's version number
+    :param type_changes: dictionary of column type classifications,
+      keyed by table and column name
+    :param checked: set of (table, column) with a validated NOT NULL
+      CHECK constraint
+    :return: dictionary
+
+    The dictionary returned has the following keys: `tables`, a list
+    of affected (existing or new) tables, indexes or views; `lock`,
+    the strongest lock taken on them or None; `rewrite`, `scan` and
+    `index_build`, flags telling whether the tables are rewritten,
+    scanned or have indexes built; and `transactional`, False if the
+    statement cannot run inside a transaction block.  A batched
+    backfill (see `parse_backfill`) counts as a rewrite, since it
+    writes a new version of every row.  The statements of a DO block
+    generated by Pyrseas, e.g., the swap of a column type change
+    made online, are analyzed in turn and their effects combined.
+    A column renamed by a statement inherits the validated NOT NULL
+    CHECK constraint of its former name in `checked`.
+    """
+    info = {'tables': [], 'lock': None, 'rewrite': False, 'scan': False,
+            'index_build': False, 'transactional': True}
+    if not isinstance(stmt, basestring):
+        return info
+    stmt = stmt.strip()
+    type_changes = type_changes or {}
+    checked = checked if checked is not None else set()
+    match = DO_BLOCK.match(stmt)
+    if match:
+        for inner in match.group(1).split(';\n'):
+            inner = analyze_statement(inner.strip().rstrip(';'), schema,
+                                      dbversion, type_changes, checked)
+            for table in inner['tables']:
+                if table not in info['tables']:
+                    info['tables'].append(table)
+            if inner['lock'] and (not info['lock'] or LOCK_LEVELS.index(
+                    inner['lock']) > LOCK_LEVELS.index(info['lock'])):
+                info['lock'] = inner['lock']
+            for flag in ['rewrite', 'scan', 'index_build']:
+                info[flag] = info[flag] or inner[flag]
+        return info
+    parsed = parse_alter_table(stmt)
+    if parsed:
+        (table, subcmds, refs) = parsed
+        table = qualify(table, schema)
+        info['tables'] = [table] + [qualify(ref, schema) for ref in refs]
+        subcmds = split_subcommands(subcmds)
+        info['lock'] = ACCESS_EXCLUSIVE
+        if all([sub.startswith('VALIDATE') for sub in subcmds]):
+            info['lock'] = SHARE_UPDATE_EXCLUSIVE
+        elif all([sub.startswith('ADD CONSTRAINT') and 'FOREIGN KEY' in sub
+                  for sub in subcmds]):
+            info['lock'] = SHARE_ROW_EXCLUSIVE
+        for sub in subcmds:
+            words = sub.split()
+            if sub.startswith('ALTER COLUMN') and len(words) > 3 \
+                    and words[3] == 'TYPE':
+                change = type_changes.get((table, words[2]))
+                if change == INDEX_REBUILD:
+                    info['index_build'] = True
+                elif change != NO_REWRITE:
+                    info['rewrite'] = True
+            elif sub.startswith('ALTER COLUMN') and sub.endswith(
+                    'SET NOT NULL'):
+                if dbversion < 120000 or (table, words[2]) not in checked:
+                    info['scan'] = True
+            elif sub.startswith('ADD COLUMN') and ' DEFAULT ' in sub:
+                default = sub[sub.index(' DEFAULT ') + 9:]
+                if dbversion < 110000 or [func for func in VOLATILE_FUNCS
+                                          if func in default]:
+                    info['rewrite'] = True
+            elif sub.startswith('RENAME COLUMN') and len(words) == 5:
+                if (table, words[2]) in checked:
+                    checked.add((table, words[4]))
+            elif sub.startswith('ADD CONSTRAINT'):
+                if 'PRIMARY KEY' in sub or 'UNIQUE' in sub:
+                    # an existing index is attached without a build
+                    if 'USING INDEX' not in sub:
+                        info['index_build'] = True
+                elif not sub.endswith('NOT VALID'):
+                    info['scan'] = True
+            elif sub.startswith('VALIDATE'):
+                info['scan'] = True
+        return info
+    parsed = parse_backfill(stmt)
+    if parsed:
+        info['tables'] = [qualify(parsed[0], schema)]
+        info['lock'] = ROW_EXCLUSIVE
+        info['rewrite'] = True
+        return info
+    if ADD_VALUE.match(stmt):
+        info['lock'] = ACCESS_EXCLUSIVE
+        info['transactional'] = dbversion >= 120000
+        return info
+    match = CREATE_INDEX.match(stmt)
+    if match:
+        (concurrently, table) = match.groups()
+        info['tables'] = [qualify(table, schema)]
+        info['index_build'] = True
+        if concurrently:
+            info['lock'] = SHARE_UPDATE_EXCLUSIVE
+            info['transactional'] = False
+        else:
+            info['lock'] = SHARE
+        return info
+    match = ON_TABLE.match(stmt)
+    if match:
+        info['tables'] = [qualify(match.group(1), schema)]
+        info['lock'] = stmt.startswith('CREATE') and SHARE_ROW_EXCLUSIVE \
+            or ACCESS_EXCLUSIVE
+        return info
+    match = RULE_TABLE.match(stmt)
+    if match:
+        info['tables'] = [qualify(match.group(1), schema)]
+        info['lock'] = ACCESS_EXCLUSIVE
+        return info
+    match = COMMENT_COLUMN.match(stmt)
+    if match:
+        info['tables'] = [qualify(match.group(1), schema)]
+        return info
+    match = RELATION.match(stmt)
+    if match:
+        (verb, objtype, name) = match.groups()
+        info['tables'] = [qualify(name, schema)]
+        if verb == 'DROP' and 'CONCURRENTLY' in stmt:
+            info['transactional'] = False
+        if verb == 'DROP' or (verb != 'COMMENT ON' and objtype != 'SEQUENCE'
+                              and not stmt.startswith('CREATE TABLE')):
+            info['lock'] = ACCESS_EXCLUSIVE
+    return info
+
+
+def analyze_plan(stmts, dbversion=0, type_changes=None):
+    """Analyze each statement of a plan
+
+    :param stmts: list of SQL statements
+    :param dbversion: the server's version number
+    :param type_changes: list of column type classifications, as
+      returned by ColumnDict.classify_types
+    :return: list of dictionaries, as returned by `analyze_statement`
+
+    Follows SET search_path statements, so that unqualified names
+    are attributed to the right schema, and NOT NULL helper CHECK
+    constraints, so that a SET NOT NULL following their validation
+    is not counted as a scan.
+    """
+    changes = {}
+    for (table, col, oldtype, newtype, change) in type_changes or []:
+        changes[(table, col)] = change
+    schema = 'public'
+    pending = {}
+    checked = set()
+    result = []
+    for stmt in stmts:
+        if isinstance(stmt, basestring):
+            match = SEARCH_PATH.match(stmt)
+            if match:
+                schema = match.group(1)
+        info = analyze_statement(stmt, schema, dbversion, changes, checked)
+        if info['tables'] and isinstance(stmt, basestring):
+            for (cns, col) in NOT_NULL_CHECK.findall(stmt):
+                pending[(info['tables'][0], cns)] = col
+            for cns in VALIDATE.findall(stmt):
+                if (info['tables'][0], cns) in pending:
+                    checked.add((info['tables'][0],
+                                 pending[(info['tables'][0], cns)]))
+        result.append(info)
+    return result
+
+
+STATEMENT_KIND = re.compile(
+    r'(CREATE|ALTER|DROP)\s+(?:OR\s+REPLACE\s+|UNIQUE\s+|TRUSTED\s+|'
+    r'PROCEDURAL\s+|DEFAULT\s+|CONSTRAINT\s+)*(\w+)')
+
+
+def statement_kind(stmt):
+    """Return the kind of a statement
+
+    :param stmt: SQL statement
+    :return: command and, for CREATE, ALTER and DROP, object type,
+      e.g., 'CREATE INDEX', 'ALTER TABLE' or 'COMMENT'
+    """
+    stmt = stmt.lstrip()
+    match = STATEMENT_KIND.match(stmt)
+    if match:
+        return "%s %s" % match.groups()
+    return stmt.split(None, 1)[0].upper()
+
+
+WORD = re.compile(r'"(?:[^"]|"")+"|\w+')
+
+
+def _unquote(name):
+    "Return an identifier without its double quotes"
+    if name.startswith('"'):
+        return name[1:-1].replace('""', '"')
+    return name.lower()
+
+
+def statement_dependencies(stmts, infos):
+    """Determine which earlier statements each statement depends on
+
+    :param stmts: list of SQL statements
+    :param infos: list of dictionaries, as returned by `analyze_plan`
+    :return: list of sets of statement indexes
+
+    A statement depends on an earlier one if either of them affects a
+    table (or index or view) whose name is mentioned by the other, so
+    that, e.g., a view is created after the tables it selects from.
+    A statement that does not affect any table, e.g., CREATE SCHEMA
+    or SET search_path, is a barrier: it depends on all preceding
+    statements and all following statements depend on it.
+    """
+    deps = []
+    barrier = None
+    touched = {}
+    mentioned = {}
+    for (idx, (stmt, info)) in enumerate(zip(stmts, infos)):
+        if not info['tables'] or not isinstance(stmt, basestring):
+            deps.append(set(range(barrier or 0, idx)))
+            barrier = idx
+            touched = {}
+            mentioned = {}
+            continue
+        names = set([_unquote(tbl.rsplit('.', 1)[-1])
+                     for tbl in info['tables']])
+        words = set([_unquote(word) for word in WORD.findall(stmt)])
+        prior = set()
+        if barrier is not None:
+            prior.add(barrier)
+        for name in words:
+            prior.update(touched.get(name, []))
+        for name in names:
+            prior.update(mentioned.get(name, []))
+        deps.append(prior)
+        for name in names:
+            touched.setdefault(name, []).append(idx)
+        for name in words:
+            mentioned.setdefault(name, []).append(idx)
+    return deps
+
+
+CHUNK_STRATEGIES = ('table', 'count', 'group')
+
+
+def chunk_plan(stmts, infos, strategy, size=None):
+    """Split a plan into chunks, each to be run in a transaction
+
+    :param stmts: list of SQL statements
+    :param infos: list of dictionaries, as returned by `analyze_plan`
+    :param strategy: 'table', 'count' or 'group'
+    :param size: maximum number of statements per chunk, for 'count'
+    :return: list of lists of statement indexes
+
+    The 'table' strategy puts consecutive statements on the same
+    table in a chunk, 'count' puts up to `size` consecutive statements
+    in a chunk and 'group' puts together the statements that depend
+    on each other, as determined by `statement_dependencies`, up to
+    the next barrier.  With 'group', the chunks are thus not
+    necessarily in plan order, but the statements within each chunk
+    are.  A statement that cannot run inside a transaction block is
+    always in a chunk by itself.
+    """
+    if strategy not in CHUNK_STRATEGIES:
+        raise KeyError("Unrecognized chunking strategy: %s" % strategy)
+    if strategy == 'group':
+        return _chunk_groups(stmts, infos)
+    chunks = []
+    current = []
+    key = None
+    for (idx, info) in enumerate(infos):
+        if not info['transactional']:
+            if current:
+                chunks.append(current)
+            chunks.append([idx])
+            current = []
+            continue
+        newkey = info['tables'] and info['tables'][0] or None
+        if current and ((strategy == 'table' and newkey != key) or
+                        (strategy == 'count' and len(current) >= size)):
+            chunks.append(current)
+            current = []
+        current.append(idx)
+        key = newkey
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _chunk_groups(stmts, infos):
+    "Split a plan into chunks of interdependent statements"
+    deps = statement_dependencies(stmts, infos)
+    barriers = set([idx for (idx, info) in enumerate(infos)
+                    if not info['tables'] or not info['transactional']
+                    or not isinstance(stmts[idx], basestring)])
+    parent = range(len(stmts))
+
+    def find(idx):
+        while parent[idx] != idx:
+            parent[idx] = parent[parent[idx]]
+            idx = parent[idx]
+        return idx
+
+    for (idx, prior) in enumerate(deps):
+        if idx in barriers:
+            continue
+        for dep in prior:
+            if dep not in barriers:
+                parent[find(dep)] = find(idx)
+    chunks = []
+    groups = {}
+    order = []
+    for idx in range(len(stmts)):
+        if idx in barriers:
+            chunks.extend([groups[root] for root in order])
+            groups = {}
+            order = []
+            chunks.append([idx])
+            continue
+        root = find(idx)
+        if root not in groups:
+            groups[root] = []
+            order.append(root)
+        groups[root].append(idx)
+    chunks.extend([groups[root] for root in order])
+    return chunks
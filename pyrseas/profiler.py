@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+    pyrseas.profiler
+    ~~~~~~~~~~~~~~~~
+
+    A `Profiler` records the wall clock time, CPU time, row counts and
+    peak memory of the phases of a dbtoyaml or yamltodb run, e.g.,
+    the catalog query of each DbObjectDict, link_refs, to_map or
+    diff_map, and optionally collects cProfile statistics.
+"""
+import cProfile
+import resource
+import sys
+import time
+
+
+def maxrss():
+    """Return the peak memory of the process
+
+    :return: peak resident set size, in kilobytes
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on Mac OS X, in kilobytes elsewhere
+    return sys.platform == 'darwin' and rss // 1024 or rss
+
+
+class Profiler(object):
+    """A recorder of the cost of each phase of a run"""
+
+    def __init__(self, stats=None):
+        """Initialize the profiler
+
+        :param stats: name of a file to dump cProfile statistics to
+        """
+        self.phases = []
+        self.stats = stats
+        self._open = []
+        self._profile = stats and cProfile.Profile() or None
+
+    def enable(self):
+        "Start collecting cProfile statistics, if requested"
+        if self._profile:
+            self._profile.enable()
+
+    def disable(self):
+        "Stop collecting cProfile statistics and dump them to the file"
+        if self._profile:
+            self._profile.disable()
+            self._profile.dump_stats(self.stats)
+
+    def start(self, name):
+        """Start timing a phase
+
+        :param name: name of the phase
+
+        Phases started before the current one is stopped are nested
+        within it, which is recorded as their parent.
+        """
+        phase = {'phase': name, 'depth': len(self._open), 'rows': None,
+                 'parent': self._open and self._open[-1]['phase'] or None,
+                 'wall': time.time(), 'cpu': time.clock()}
+        self.phases.append(phase)
+        self._open.append(phase)
+
+    def stop(self, rows=None):
+        """Stop timing the current phase
+
+        :param rows: number of rows or objects processed by the phase
+        """
+        phase = self._open.pop()
+        phase['wall'] = time.time() - phase['wall']
+        phase['cpu'] = time.clock() - phase['cpu']
+        phase['rows'] = rows
+        phase['maxrss_kb'] = maxrss()
+
+    def timed(self, name, func, *args, **kwargs):
+        """Call a function as a phase
+
+        :param name: name of the phase
+        :param func: function to call
+        :param args: positional arguments to the function
+        :param kwargs: keyword arguments to the function
+        :return: the function's return value
+        """
+        self.start(name)
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            self.stop()
+        return result
+
+    def report(self):
+        """Return a printable report of the phases
+
+        :return: list of lines
+
+        Nested phases are indented under the phase that includes
+        them.  Memory is the peak of the process at the end of the
+        phase.
+        """
+        lines = ["%-40s %10s %10s %10s %12s" % (
+                'phase', 'wall (s)', 'cpu (s)', 'rows', 'memory (kB)')]
+        for phase in self.phases:
+            if 'maxrss_kb' not in phase:
+                continue
+            lines.append("%-40s %10.3f %10.3f %10s %12d" % (
+                    '  ' * phase['depth'] + phase['phase'], phase['wall'],
+                    phase['cpu'], phase['rows'] is not None and
+                    str(phase['rows']) or '', phase['maxrss_kb']))
+        return lines
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+    pyrseas.rehearse
+    ~~~~~~~~~~~~~~~~
+
+    A `Rehearsal` applies a plan, i.e., the statements generated by
+    Database.diff_map, to a scratch copy of a database, so that the
+    duration and locks of each statement are known before the plan
+    is applied to the database itself.
+"""
+import subprocess
+import tempfile
+import time
+
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+from pyrseas.dbobject import DbSchemaObject
+from pyrseas.executor import Executor
+from pyrseas.identifier import quote_id
+
+
+class Rehearsal(object):
+    """A trial run of a plan against a scratch database"""
+
+    tables_query = \
+        """SELECT nspname AS schema, relname AS name
+           FROM pg_class c
+                JOIN pg_namespace ON (relnamespace = pg_namespace.oid)
+           WHERE relkind = 'r'
+                 AND substring(nspname for 3) != 'pg_'
+                 AND nspname != 'information_schema'
+           ORDER BY nspname, relname"""
+
+    def __init__(self, dbconn, scratch=None, template=False, sample=None,
+                 maintenance_db='postgres', keep=False, **kwargs):
+        """Initialize the rehearsal
+
+        :param dbconn: a DbConnection object to the source database
+        :param scratch: name of the scratch database, by default the
+          source database name followed by '_rehearsal'
+        :param template: create the scratch database with the source
+          database as template, instead of copying its schema
+        :param sample: percentage of the rows of each table to copy to
+          the scratch database, if its schema was copied
+        :param maintenance_db: database to connect to in order to
+          create and drop the scratch database
+        :param keep: do not drop the scratch database at the end
+        :param kwargs: options for the `pyrseas.executor.Executor`
+        """
+        self.dbconn = dbconn
+        self.scratch = scratch or "%s_rehearsal" % dbconn.dbname
+        self.template = template
+        self.sample = sample
+        self.maintenance_db = maintenance_db
+        self.keep = keep
+        self.options = kwargs
+        self.executor = None
+        self.created = False
+        self.setup = 0.0
+
+    def _admin(self, stmt):
+        "Execute a statement in autocommit mode on the maintenance database"
+        admin = self.dbconn.clone()
+        admin.dbname = self.maintenance_db
+        admin.connect()
+        try:
+            admin.conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            admin.execute(stmt)
+        finally:
+            admin.close()
+
+    def create(self):
+        """Create the scratch database
+
+        With `template`, the scratch database is a full copy made by
+        CREATE DATABASE ... TEMPLATE, which requires that no other
+        session be connected to the source database.  Otherwise, the
+        schema is copied with :program:`pg_dump` and :program:`psql`,
+        and a sample of the data, if requested, with `copy_sample`.
+        """
+        start = time.time()
+        if self.template:
+            self._admin("CREATE DATABASE %s TEMPLATE %s" % (
+                    quote_id(self.scratch), quote_id(self.dbconn.dbname)))
+            self.created = True
+        else:
+            self._admin("CREATE DATABASE %s TEMPLATE template0" %
+                        quote_id(self.scratch))
+            self.created = True
+            dump = subprocess.Popen(['pg_dump', '--schema-only',
+                                     self.dbconn.dsn()],
+                                    stdout=subprocess.PIPE)
+            restore = subprocess.Popen(['psql', '-q', '-X', '-o',
+                                        '/dev/null', '-v', 'ON_ERROR_STOP=1',
+                                        self.dbconn.dsn(self.scratch)],
+                                       stdin=dump.stdout)
+            dump.stdout.close()
+            if restore.wait() or dump.wait():
+                raise RuntimeError("could not copy the schema of %s" %
+                                   self.dbconn.dbname)
+        scratchconn = self.dbconn.clone()
+        scratchconn.dbname = self.scratch
+        if self.sample and not self.template:
+            try:
+                self.copy_sample(scratchconn)
+            except Exception:
+                scratchconn.close()
+                raise
+        self.setup = time.time() - start
+        return scratchconn
+
+    def copy_sample(self, scratchconn):
+        """Copy a random sample of each table to the scratch database
+
+        :param scratchconn: a DbConnection object to the scratch database
+
+        Blocks of rows are sampled with TABLESAMPLE SYSTEM on
+        PostgreSQL 9.5 or later, and rows with random() before.  The
+        rows are loaded with triggers, including those checking
+        foreign keys, disabled, since referenced rows may not be part
+        of the sample.  This requires superuser privileges.
+        """
+        if not self.dbconn.conn:
+            self.dbconn.connect()
+        if not scratchconn.conn:
+            scratchconn.connect()
+        if self.dbconn.version >= 90500:
+            sample = "TABLESAMPLE SYSTEM (%s)" % self.sample
+        else:
+            sample = "WHERE random() < %s" % (self.sample / 100.0)
+        scratchconn.execute("SET session_replication_role = replica")
+        for (sch, tbl) in self.dbconn.fetchall(self.tables_query):
+            table = DbSchemaObject(schema=sch, name=tbl).qualname()
+            data = tempfile.TemporaryFile()
+            curs = self.dbconn.conn.cursor()
+            curs.copy_expert("COPY (SELECT * FROM %s %s) TO STDOUT" % (
+                    table, sample), data)
+            curs.close()
+            self.dbconn.conn.rollback()
+            data.seek(0)
+            curs = scratchconn.conn.cursor()
+            curs.copy_expert("COPY %s FROM STDIN" % table, data)
+            curs.close()
+            data.close()
+        scratchconn.execute("SET session_replication_role = DEFAULT")
+        scratchconn.conn.commit()
+
+    def drop(self):
+        "Drop the scratch database, if it was created"
+        if self.created:
+            self._admin("DROP DATABASE %s" % quote_id(self.scratch))
+            self.created = False
+
+    def run(self, stmts, type_changes=None):
+        """Apply a plan to a scratch database
+
+        :param stmts: list of SQL statements
+        :param type_changes: list of column type classifications, as
+          saved by Database.diff_map
+        :return: list of dictionaries, as for `Executor.execute`
+
+        The scratch database is dropped afterwards, even if its setup
+        failed, unless `keep` was requested.
+        """
+        scratchconn = None
+        try:
+            scratchconn = self.create()
+            self.executor = Executor(scratchconn, **self.options)
+            report = self.executor.execute(stmts, type_changes)
+        finally:
+            if scratchconn:
+                scratchconn.close()
+            if not self.keep:
+                self.drop()
+        return report
+
+    def report(self):
+        """Return a printable report of the rehearsal
+
+        :return: list of lines
+        """
+        lines = ["-- rehearsal on %s (setup %.1f s):" % (self.scratch,
+                                                        self.setup)]
+        for (num, entry) in enumerate(self.executor.report):
+            lines.append("-- %4d %-30s %-22s %10.3f s %10s rows %s" % (
+                    num + 1, entry['tables'] and entry['tables'][0] or '',
+                    entry['lock'] or '', entry['duration'],
+                    entry['rows'] is not None and str(entry['rows']) or '',
+                    entry['status']))
+            lines.append("--      %s" % entry['statement'].split('\n')[0])
+            if entry['locks']:
+                lines.append("--      locks: %s" % ", ".join(
+                        ["%s %s" % (rel, mode)
+                         for (rel, mode) in entry['locks']]))
+            if entry['error']:
+                lines.append("--      error: %s" % entry['error'])
+        lines.append("-- rehearsal total: %.1f s, %s" % (
+                self.executor.duration, self.executor.status()))
+        return lines
@@ -1,15 +1,33 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 """yamltodb - generate SQL statements to update a PostgreSQL database
-to match the schema specified in a YAML file"""
+to match the schema specified in a YAML file
+
+PyYAML, psycopg2 and the modules implementing the options, e.g., the
+executor used by --apply, are only imported once the arguments have
+been parsed, and only if needed, to keep the startup of short runs
+fast.
+"""
 
 import os
+import sys
 from optparse import OptionParser
 
-import yaml
-
 from pyrseas.dbconn import DbConnection
-from pyrseas.database import Database
+
+
+def load_spec(yamlspec, profiler=None):
+    """Load the input YAML specification
+
+    :param yamlspec: name of the YAML file
+    :param profiler: a Profiler, to time the load as a phase
+    :return: a YAML map
+    """
+    import yaml
+
+    if profiler:
+        return profiler.timed('yaml_load', yaml.load, open(yamlspec))
+    return yaml.load(open(yamlspec))
 
 
 def main(host='localhost', port=5432):
@@ -25,20 +43,261 @@ def main(host='localhost', port=5432):
     parser.add_option('-1', '--single-transaction', action='store_true',
                       dest='onetrans',
                       help="wrap commands in BEGIN/COMMIT")
+    parser.add_option('--chunk', dest='chunking', type='choice',
+                      choices=['table', 'count', 'group'],
+                      help="with --apply, commit statements in chunks: per "
+                      "table, per COUNT statements or per group of "
+                      "dependent statements")
+    parser.add_option('--chunk-size', dest='chunk_size', type='int',
+                      help="number of statements per chunk with --chunk "
+                      "count (default %default)")
+    parser.add_option('--online', action='store_true', dest='online',
+                      help="avoid long exclusive locks on existing tables")
+    parser.add_option('--batch-size', dest='batch_size', type='int',
+                      help="range of primary key values updated by each "
+                      "batch of a backfill, for --apply (default %default)")
+    parser.add_option('--batch-sleep', dest='batch_sleep', type='float',
+                      help="seconds to pause between backfill batches, "
+                      "for --apply (default %default)")
+    parser.add_option('--apply', action='store_true', dest='apply',
+                      help="execute the statements instead of printing "
+                      "them")
+    parser.add_option('--progress', action='store_true', dest='progress',
+                      help="report the progress of backfills on stderr, "
+                      "for --apply")
+    parser.add_option('--lock-timeout', dest='lock_timeout', type='int',
+                      help="maximum wait for a lock, in milliseconds, "
+                      "for --apply")
+    parser.add_option('--retries', dest='retries', type='int',
+                      help="retry a statement that timed out waiting for "
+                      "a lock up to this many times (default %default)")
+    parser.add_option('--retry-delay', dest='retry_delay', type='float',
+                      help="seconds to wait before the first retry, "
+                      "doubled on each attempt (default %default)")
+    parser.add_option('--statement-timeout', dest='statement_timeout',
+                      type='int', help="maximum duration of a statement, "
+                      "in milliseconds, for --apply")
+    parser.add_option('-j', '--jobs', dest='jobs', type='int',
+                      help="run independent statements concurrently over "
+                      "this many connections, for --apply")
+    parser.add_option('--time-limit', dest='time_limit', type='float',
+                      help="do not start further statements after this "
+                      "many seconds, for --apply")
+    parser.add_option('--max-blocked', dest='max_blocked', type='int',
+                      help="cancel a statement blocking this many "
+                      "sessions, for --apply")
+    parser.add_option('--max-blocking-time', dest='max_blocking_time',
+                      type='float', help="cancel a statement blocking "
+                      "another session for this many seconds, for --apply")
+    parser.add_option('--max-lag', dest='max_lag', type='float',
+                      help="pause while standbys lag more than this many "
+                      "MB of WAL behind, for --apply")
+    parser.add_option('--standby', dest='standby',
+                      help="check the lag on this standby host[:port] "
+                      "instead of using pg_stat_replication")
+    parser.add_option('--journal', dest='journal',
+                      help="record progress in this file and resume an "
+                      "interrupted plan from it, for --apply")
+    parser.add_option('--report', dest='report',
+                      help="write a JSON execution report to this file, "
+                      "for --apply")
+    parser.add_option('--rehearse', action='store_true', dest='rehearse',
+                      help="apply the statements to a scratch copy of the "
+                      "database and report their timing and locks")
+    parser.add_option('--template', action='store_true', dest='template',
+                      help="with --rehearse, copy the database with CREATE "
+                      "DATABASE ... TEMPLATE instead of copying its schema")
+    parser.add_option('--sample', dest='sample', type='float',
+                      help="with --rehearse, copy this percentage of the "
+                      "rows of each table")
+    parser.add_option('--estimate', action='store_true', dest='estimate',
+                      help="estimate the cost of the statements instead "
+                      "of printing them")
+    parser.add_option('--read-rate', dest='read_rate', type='float',
+                      help="read throughput in MB/s for --estimate "
+                      "(default %default)")
+    parser.add_option('--write-rate', dest='write_rate', type='float',
+                      help="write throughput in MB/s for --estimate "
+                      "(default %default)")
+    parser.add_option('--report-types', action='store_true',
+                      dest='report_types',
+                      help="report the cost of column type changes as "
+                      "SQL comments")
+    parser.add_option('--hash-definitions', action='store_true',
+                      dest='hash_definitions',
+                      help="fetch only hashes of function sources and view "
+                      "definitions, and in full only those that differ")
+    parser.add_option('--profile', action='store_true', dest='profile',
+                      help="report the time and memory used by each phase "
+                      "on stderr")
+    parser.add_option('--profile-stats', dest='profile_stats',
+                      help="with --profile, dump cProfile statistics to "
+                      "this file")
+    parser.add_option('--metrics', dest='metrics',
+                      help="write counters and timings of the run to this "
+                      "file")
+    parser.add_option('--metrics-format', dest='metrics_format',
+                      type='choice', choices=['json', 'prometheus'],
+                      help="format of the --metrics file: json or "
+                      "prometheus (default %default)")
 
-    parser.set_defaults(host=host, port=port, username=os.getenv("USER"))
+    parser.set_defaults(host=host, port=port, username=os.getenv("USER"),
+                        retries=0, retry_delay=0.5, chunk_size=100,
+                        batch_size=10000, batch_sleep=0.0,
+                        read_rate=100.0, write_rate=50.0,
+                        metrics_format='json')
     (options, args) = parser.parse_args()
     if len(args) > 2:
         parser.error("too many arguments")
     elif len(args) != 2:
         parser.error("missing arguments")
+    if options.retries and options.lock_timeout is None and not (
+            options.max_blocked or options.max_blocking_time):
+        parser.error("--retries requires --lock-timeout, --max-blocked "
+                     "or --max-blocking-time")
+    if options.chunking and not options.apply:
+        parser.error("--chunk requires --apply")
+    if options.chunking and (options.onetrans or options.jobs > 1):
+        parser.error("--chunk cannot be used with --single-transaction "
+                     "or --jobs")
+    if options.journal and not options.apply:
+        parser.error("--journal requires --apply")
+    if options.rehearse and options.apply:
+        parser.error("--rehearse cannot be used with --apply")
+    if (options.template or options.sample) and not options.rehearse:
+        parser.error("--template and --sample require --rehearse")
+    if options.template and options.sample:
+        parser.error("--sample cannot be used with --template")
+    if options.jobs > 1 and options.onetrans:
+        parser.error("--jobs cannot be used with --single-transaction")
+    if options.online and options.onetrans:
+        parser.error("--online cannot be used with --single-transaction")
+    if options.profile_stats and not options.profile:
+        parser.error("--profile-stats requires --profile")
     dbname = args[0]
     yamlspec = args[1]
 
-    db = Database(DbConnection(dbname, options.username, options.host,
-                               options.port))
-    stmts = db.diff_map(yaml.load(open(yamlspec)))
+    from pyrseas.database import Database
+
+    dbconn = DbConnection(dbname, options.username, options.host,
+                          options.port)
+    dbconn.hash_definitions = options.hash_definitions
+    profiler = None
+    if options.profile or options.metrics:
+        from pyrseas.profiler import Profiler
+        profiler = dbconn.profiler = Profiler(options.profile_stats)
+        profiler.enable()
+    db = Database(dbconn)
+    journal = None
+    if options.journal:
+        from pyrseas.dbobject import md5_hex
+        from pyrseas.journal import Journal
+        journal = Journal(options.journal)
+        spec_checksum = md5_hex(open(yamlspec).read())
+    if journal and journal.load():
+        newstmts = None
+        if journal.state['catalog_checksum'] is None:
+            newstmts = db.diff_map(load_spec(yamlspec, profiler),
+                                   options.online)
+        error = journal.verify(dbconn, spec_checksum, newstmts)
+        if error:
+            print >> sys.stderr, "cannot resume: %s" % error
+            sys.exit(1)
+        stmts = journal.statements
+        db.type_changes = journal.type_changes
+    else:
+        stmts = db.diff_map(load_spec(yamlspec, profiler), options.online)
+        if journal:
+            journal.begin(stmts, spec_checksum, db.type_changes)
+    if profiler:
+        profiler.disable()
+        dbconn.profiler = None
+    if options.profile:
+        print >> sys.stderr, "\n".join(profiler.report())
+    if options.metrics:
+        from pyrseas.metrics import Metrics
+        metrics = Metrics('yamltodb', dbname)
+        metrics.from_profiler(profiler)
+        if db.db:
+            metrics.objects(db.db)
+        metrics.statements(stmts)
+        metrics.write(open(options.metrics, 'w'), options.metrics_format)
+    if options.rehearse:
+        from pyrseas.executor import OK
+        from pyrseas.rehearse import Rehearsal
+        rehearsal = Rehearsal(dbconn, template=options.template,
+                              sample=options.sample, onetrans=options.onetrans,
+                              lock_timeout=options.lock_timeout,
+                              statement_timeout=options.statement_timeout,
+                              batch_size=options.batch_size,
+                              batch_sleep=options.batch_sleep)
+        rehearsal.run(stmts, db.type_changes)
+        dbconn.close()
+        print "\n".join(rehearsal.report())
+        if options.report:
+            rehearsal.executor.write_report(open(options.report, 'w'))
+        if rehearsal.executor.status() != OK:
+            sys.exit(1)
+        return
+    if options.estimate:
+        from pyrseas.estimate import CostEstimator
+        estimator = CostEstimator(dbconn, options.read_rate,
+                                  options.write_rate)
+        print "\n".join(estimator.report(stmts, db.type_changes))
+        return
+    if options.apply:
+        from pyrseas.executor import Executor, ParallelExecutor, OK
+        from pyrseas.monitor import Watchdog, LagThrottle
+        kwargs = {'lock_timeout': options.lock_timeout,
+                  'statement_timeout': options.statement_timeout,
+                  'time_limit': options.time_limit,
+                  'retries': options.retries,
+                  'retry_delay': options.retry_delay,
+                  'batch_size': options.batch_size,
+                  'batch_sleep': options.batch_sleep,
+                  'progress': options.progress and sys.stderr or None,
+                  'journal': journal}
+        if options.max_blocked or options.max_blocking_time:
+            kwargs['watchdog'] = Watchdog(dbconn, options.max_blocked,
+                                          options.max_blocking_time)
+        if options.max_lag is not None:
+            standby = None
+            if options.standby:
+                (shost, sep, sport) = options.standby.partition(':')
+                standby = DbConnection(dbname, options.username, shost,
+                                       sport and int(sport) or None)
+            kwargs['throttle'] = LagThrottle(
+                dbconn, int(options.max_lag * 1024 * 1024), standby)
+        if options.jobs > 1:
+            executor = ParallelExecutor(dbconn, options.jobs, **kwargs)
+        else:
+            executor = Executor(dbconn, onetrans=options.onetrans,
+                                chunking=options.chunking,
+                                chunk_size=options.chunk_size, **kwargs)
+        executor.execute(stmts, db.type_changes)
+        dbconn.close()
+        if options.report:
+            executor.write_report(open(options.report, 'w'))
+        failed = executor.failed()
+        if failed:
+            print >> sys.stderr, "%s\n%s" % (failed['error'],
+                                             failed['statement'])
+        elif executor.status() != OK:
+            print >> sys.stderr, "time limit reached after %d of %d " \
+                "statements" % (len(executor.report), len(stmts))
+        if executor.status() != OK:
+            sys.exit(1)
+        return
+    if options.report_types:
+        for (tbl, col, oldtype, newtype, cost) in db.type_changes:
+            print "-- %s.%s: %s to %s: %s" % (tbl, col, oldtype, newtype,
+                                              cost)
     if stmts:
+        from pyrseas.plan import parse_backfill
+        if [stmt for stmt in stmts if parse_backfill(stmt)]:
+            print >> sys.stderr, "warning: backfills are only run in " \
+                "batches with --apply; as printed, each UPDATE rewrites " \
+                "its whole table in a single transaction"
         if options.onetrans:
             print "BEGIN;"
         print ";\n".join(stmts) + ';'
@@ -0,0 +1,229 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Time Pyrseas operations on synthetic schemas of increasing size
+
+The benchmark creates, for each requested size, a database with that
+many tables (see generator.SchemaGenerator) and then times the phases
+of dbtoyaml (Database.to_map and the YAML dump) and of yamltodb (the
+YAML load and Database.diff_map, which includes reading the catalogs
+and from_map) against it.  Wall clock time, CPU time and the peak
+memory of the process are recorded for each phase and written as
+JSON, so that results can be compared across commits.
+
+With --record, the catalog queries of an existing database are saved
+to a fixture file instead.  With --replay, the phases that do not
+change the database are timed against such fixtures, without
+connecting to a server, to isolate the costs on the Python side.
+"""
+
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+
+import yaml
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+from pyrseas.dbconn import DbConnection, RecordingDbConnection
+from pyrseas.dbconn import ReplayDbConnection
+from pyrseas.database import Database
+from pyrseas.identifier import quote_id
+from generator import SchemaGenerator
+
+BENCH_DBNAME = os.environ.get("PYRSEAS_BENCH_DB", 'pyrseas_benchdb')
+ADMIN_DB = os.environ.get("PYRSEAS_ADMIN_DB", 'postgres')
+
+
+def maxrss():
+    "Return the peak memory of the process, in kilobytes"
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on Mac OS X, in kilobytes elsewhere
+    return sys.platform == 'darwin' and rss // 1024 or rss
+
+
+def commit_id():
+    "Return the current git commit of the source tree, if known"
+    try:
+        return subprocess.Popen(
+            ['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+            stderr=open(os.devnull, 'w'),
+            cwd=os.path.dirname(os.path.abspath(__file__))).communicate()[0]. \
+            strip() or None
+    except OSError:
+        return None
+
+
+class Benchmark(object):
+    """A set of timed phases against a generated database"""
+
+    def __init__(self, dbconn):
+        """Initialize the benchmark
+
+        :param dbconn: a DbConnection object to the benchmark database
+        """
+        self.dbconn = dbconn
+        self.results = []
+
+    def recreate(self, create=True):
+        """Drop and create the benchmark database
+
+        :param create: create the database after dropping it
+        """
+        admin = self.dbconn.clone()
+        admin.dbname = ADMIN_DB
+        admin.connect()
+        admin.conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        dbname = quote_id(self.dbconn.dbname)
+        admin.execute("DROP DATABASE IF EXISTS %s" % dbname)
+        if create:
+            admin.execute("CREATE DATABASE %s TEMPLATE template0" % dbname)
+        admin.close()
+
+    def timed(self, size, phase, func, *args, **kwargs):
+        """Run a function and record its timing
+
+        :param size: number of tables in the database
+        :param phase: name of the phase
+        :param func: function to call
+        :param args: positional arguments to the function
+        :param kwargs: keyword arguments to the function
+        :return: the function's return value
+        """
+        wall = time.time()
+        cpu = time.clock()
+        result = func(*args, **kwargs)
+        self.results.append({'tables': size, 'phase': phase,
+                             'wall': time.time() - wall,
+                             'cpu': time.clock() - cpu,
+                             'maxrss_kb': maxrss()})
+        return result
+
+    def run(self, generator):
+        """Generate a database and time the dbtoyaml and yamltodb phases
+
+        :param generator: a SchemaGenerator
+        """
+        size = generator.tables
+        self.recreate()
+        self.dbconn.connect()
+        self.timed(size, 'generate', generator.create, self.dbconn.conn)
+        self.dbconn.close()
+        dbmap = self.timed(size, 'to_map', Database(self.dbconn).to_map)
+        spec = self.timed(size, 'yaml_dump', yaml.dump, dbmap,
+                          default_flow_style=False)
+        self.results[-1]['bytes'] = len(spec)
+        del dbmap
+        inmap = self.timed(size, 'yaml_load', yaml.load, spec)
+        stmts = self.timed(size, 'diff_map_same',
+                           Database(self.dbconn).diff_map, inmap)
+        inmap = generator.alter_map(inmap)
+        stmts = self.timed(size, 'diff_map_changed',
+                           Database(self.dbconn).diff_map, inmap)
+        self.results[-1]['statements'] = len(stmts)
+
+    def replay(self, fixture):
+        """Time the dbtoyaml and yamltodb phases against recorded catalogs
+
+        :param fixture: name of a file saved by a RecordingDbConnection
+        """
+        dbconn = ReplayDbConnection(fixture)
+        db = Database(dbconn)
+        db.from_catalog()
+        size = len([key for key in db.db.tables
+                    if db.db.tables[key].objtype == 'TABLE'])
+        dbmap = self.timed(size, 'to_map', Database(dbconn).to_map)
+        spec = self.timed(size, 'yaml_dump', yaml.dump, dbmap,
+                          default_flow_style=False)
+        self.results[-1]['bytes'] = len(spec)
+        del dbmap
+        inmap = self.timed(size, 'yaml_load', yaml.load, spec)
+        self.timed(size, 'diff_map_same', Database(dbconn).diff_map, inmap)
+        for result in self.results:
+            result.setdefault('fixture', os.path.basename(fixture))
+
+
+def main():
+    """Run the benchmarks and write the results"""
+    parser = OptionParser("usage: %prog [options] [dbname]")
+    parser.add_option('-H', '--host', dest='host',
+                      help="database server host or socket directory")
+    parser.add_option('-p', '--port', dest='port', type='int',
+                      help="database server port")
+    parser.add_option('-U', '--username', dest='username',
+                      help="database user name (default %default)")
+    parser.add_option('--sizes', dest='sizes',
+                      help="comma-separated numbers of tables "
+                      "(default %default)")
+    parser.add_option('--schemas', dest='schemas', type='int',
+                      help="number of schemas (default %default)")
+    parser.add_option('--columns', dest='columns', type='int',
+                      help="columns per table (default %default)")
+    parser.add_option('--fkeys', dest='fkeys', type='int',
+                      help="foreign keys per table (default %default)")
+    parser.add_option('--indexes', dest='indexes', type='int',
+                      help="indexes per table (default %default)")
+    parser.add_option('--functions', dest='functions', type='float',
+                      help="functions per table (default %default)")
+    parser.add_option('--triggers', dest='triggers', type='float',
+                      help="triggers per table (default %default)")
+    parser.add_option('--record', dest='record',
+                      help="save the catalog queries of database DBNAME "
+                      "to this fixture file and exit")
+    parser.add_option('--replay', dest='replay', action='append',
+                      help="time the phases against this fixture file "
+                      "instead of generated databases")
+    parser.add_option('-o', '--output', dest='output',
+                      help="JSON results file (default standard output)")
+    parser.set_defaults(username=os.getenv("USER"), sizes='1000,10000,100000',
+                        schemas=10, columns=5, fkeys=1, indexes=1,
+                        functions=0.1, triggers=0.01)
+    (options, args) = parser.parse_args()
+    if options.record:
+        if len(args) != 1:
+            parser.error("--record requires a database name")
+        Database(RecordingDbConnection(
+                args[0], options.username, options.host, options.port,
+                fixture=options.record)).from_catalog()
+        return
+    if args:
+        parser.error("too many arguments")
+
+    started = time.strftime('%Y-%m-%dT%H:%M:%S')
+    output = options.output and open(options.output, 'w') or sys.stdout
+    if options.replay:
+        bench = Benchmark(None)
+        for fixture in options.replay:
+            bench.replay(fixture)
+        json.dump({'commit': commit_id(), 'python': platform.python_version(),
+                   'started': started, 'results': bench.results},
+                  output, indent=2)
+        output.write('\n')
+        return
+    dbconn = DbConnection(BENCH_DBNAME, options.username, options.host,
+                          options.port)
+    bench = Benchmark(dbconn)
+    generators = []
+    for size in [int(size) for size in options.sizes.split(',')]:
+        generator = SchemaGenerator(
+            size, options.schemas, options.columns, options.fkeys,
+            options.indexes, int(size * options.functions),
+            int(size * options.triggers))
+        generators.append(generator.params())
+        bench.run(generator)
+    dbconn.connect()
+    version = dbconn.version
+    dbconn.close()
+    bench.recreate(create=False)
+    json.dump({'commit': commit_id(), 'python': platform.python_version(),
+               'server_version': version,
+               'started': started,
+               'generators': generators, 'results': bench.results},
+              output, indent=2)
+    output.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""Generate synthetic schemas of configurable size"""
+
+COLTYPES = ['integer', 'text', 'date', 'numeric(12,2)', 'boolean',
+            'timestamp with time zone', 'bigint', 'character varying(40)']
+
+
+class SchemaGenerator(object):
+    """A generator of DDL statements for a synthetic database
+
+    The tables are spread evenly over the schemas.  Each table has an
+    integer primary key, `columns` other columns and `fkeys` integer
+    columns referencing earlier tables in the same schema, and
+    `indexes` indexes on its first columns.  Functions and triggers
+    are spread over the schemas and the first tables of each schema.
+    """
+
+    def __init__(self, tables, schemas=1, columns=5, fkeys=1, indexes=1,
+                 functions=0, triggers=0):
+        """Initialize the generator
+
+        :param tables: total number of tables
+        :param schemas: number of schemas
+        :param columns: number of columns per table, besides the key
+        :param fkeys: number of foreign keys per table
+        :param indexes: number of indexes per table, up to `columns`
+        :param functions: total number of SQL functions
+        :param triggers: total number of triggers
+        """
+        self.tables = tables
+        self.schemas = schemas
+        self.columns = columns
+        self.fkeys = fkeys
+        self.indexes = min(indexes, columns)
+        self.functions = functions
+        self.triggers = triggers
+
+    def params(self):
+        """Return the generator parameters
+
+        :return: dictionary
+        """
+        return dict(self.__dict__)
+
+    def _count(self, total, sch):
+        "Number of objects of a total that go into a schema"
+        return total // self.schemas + (sch < total % self.schemas and 1
+                                        or 0)
+
+    def schema_statements(self, sch):
+        """Return the statements creating one schema and its objects
+
+        :param sch: schema number
+        :return: list of SQL statements
+        """
+        schema = "s%d" % sch
+        stmts = ["CREATE SCHEMA %s" % schema]
+        if self.triggers:
+            stmts.append("CREATE FUNCTION %s.touch() RETURNS trigger "
+                         "LANGUAGE plpgsql AS $_$BEGIN RETURN NEW; END$_$" %
+                         schema)
+        ntables = self._count(self.tables, sch)
+        for tbl in range(ntables):
+            table = "%s.t%d" % (schema, tbl)
+            cols = ["id integer PRIMARY KEY"]
+            for col in range(self.columns):
+                cols.append("c%d %s" % (col, COLTYPES[(tbl + col) %
+                                                      len(COLTYPES)]))
+            for fkey in range(min(self.fkeys, tbl)):
+                cols.append("r%d integer REFERENCES %s.t%d (id)" % (
+                        fkey, schema, tbl - fkey - 1))
+            stmts.append("CREATE TABLE %s (%s)" % (table, ", ".join(cols)))
+            for idx in range(self.indexes):
+                stmts.append("CREATE INDEX t%d_c%d_idx ON %s (c%d)" % (
+                        tbl, idx, table, idx))
+        for fnc in range(self._count(self.functions, sch)):
+            stmts.append("CREATE FUNCTION %s.f%d(integer) RETURNS integer "
+                         "LANGUAGE sql IMMUTABLE AS 'SELECT $1 + %d'" % (
+                    schema, fnc, fnc))
+        for trg in range(min(self._count(self.triggers, sch), ntables)):
+            stmts.append("CREATE TRIGGER tr%d BEFORE UPDATE ON %s.t%d "
+                         "FOR EACH ROW EXECUTE PROCEDURE %s.touch()" % (
+                    trg, schema, trg, schema))
+        return stmts
+
+    def statements(self):
+        """Return the statements creating the whole database
+
+        :return: generator of SQL statements
+        """
+        for sch in range(self.schemas):
+            for stmt in self.schema_statements(sch):
+                yield stmt
+
+    def create(self, conn, batch=1000):
+        """Create the objects in a database
+
+        :param conn: a psycopg2 connection
+        :param batch: number of statements per transaction
+
+        The statements are committed in batches so as not to run out
+        of lock table space.
+        """
+        stmts = []
+        curs = conn.cursor()
+        for stmt in self.statements():
+            stmts.append(stmt)
+            if len(stmts) == batch:
+                curs.execute(";\n".join(stmts))
+                conn.commit()
+                stmts = []
+        if stmts:
+            curs.execute(";\n".join(stmts))
+            conn.commit()
+        curs.close()
+
+    def map(self):
+        """Return a map of the tables, as Database.to_map would
+
+        :return: dictionary
+
+        Only the tables, with their columns, constraints and indexes,
+        are included, so that the map can be used without a database.
+        """
+        dbmap = {}
+        for sch in range(self.schemas):
+            schema = "s%d" % sch
+            schmap = dbmap['schema %s' % schema] = {}
+            for tbl in range(self._count(self.tables, sch)):
+                cols = [{'id': {'type': 'integer', 'not_null': True}}]
+                for col in range(self.columns):
+                    cols.append({'c%d' % col: {'type': COLTYPES[
+                                    (tbl + col) % len(COLTYPES)]}})
+                tblmap = {'columns': cols, 'primary_key': {
+                        't%d_pkey' % tbl: {'columns': ['id'],
+                                           'access_method': 'btree'}}}
+                fkeys = {}
+                for fkey in range(min(self.fkeys, tbl)):
+                    cols.append({'r%d' % fkey: {'type': 'integer'}})
+                    fkeys['t%d_r%d_fkey' % (tbl, fkey)] = {
+                        'columns': ['r%d' % fkey], 'references': {
+                            'schema': schema, 'table': 't%d' % (
+                                tbl - fkey - 1), 'columns': ['id']}}
+                if fkeys:
+                    tblmap['foreign_keys'] = fkeys
+                indexes = {}
+                for idx in range(self.indexes):
+                    indexes['t%d_c%d_idx' % (tbl, idx)] = {
+                        'columns': ['c%d' % idx], 'access_method': 'btree'}
+                if indexes:
+                    tblmap['indexes'] = indexes
+                schmap['table t%d' % tbl] = tblmap
+        return dbmap
+
+    def alter_map(self, dbmap):
+        """Change a database map, as if a new version were designed
+
+        :param dbmap: map returned by Database.to_map
+        :return: the same map, changed in place
+
+        A column is added to every other table and the type of the
+        first column of every tenth table is changed.
+        """
+        for sch in range(self.schemas):
+            schmap = dbmap['schema s%d' % sch]
+            for tbl in range(self._count(self.tables, sch)):
+                columns = schmap['table t%d' % tbl]['columns']
+                if tbl % 2 == 0:
+                    columns.append({'added': {'type': 'text'}})
+                if tbl % 10 == 0 and self.columns:
+                    columns[1].values()[0]['type'] = 'text'
+        return dbmap
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Time the quoting and parsing of identifiers
+
+quote_id is timed over a million identifiers, a mix of regular,
+mixed-case, keyword and irregular names, against the previous
+character by character implementation.  split_qualname is timed over
+a million qualified names drawn from a smaller set of distinct names,
+as when the same tables are referred to by many objects, and over as
+many distinct names, which always miss the memo.
+"""
+
+import string
+import sys
+import time
+from optparse import OptionParser
+
+from pyrseas.identifier import quote_id, split_qualname
+
+VALID_FIRST_CHARS = string.lowercase + '_'
+VALID_CHARS = string.lowercase + string.digits + '_$'
+
+
+def walk_quote_id(name):
+    "Quote an identifier, walking its characters (the former quote_id)"
+    regular_id = True
+    if not name[0] in VALID_FIRST_CHARS:
+        regular_id = False
+    else:
+        for ltr in name[1:]:
+            if ltr not in VALID_CHARS:
+                regular_id = False
+                break
+    return regular_id and name or '"%s"' % name
+
+
+def identifiers(count):
+    """Return a list of identifiers
+
+    :param count: number of identifiers
+    :return: list of strings
+    """
+    kinds = ['c%d', 'customer_address_%d', 'Mixed%d', 'user', '%d_x',
+             'with space %d', 'order_line_item_%d', 'a$%d']
+    names = []
+    for i in xrange(count):
+        kind = kinds[i % len(kinds)]
+        names.append('%' in kind and kind % i or kind)
+    return names
+
+
+def timed(label, func, names, *args):
+    """Time a function over a list of names and print the result
+
+    :param label: description
+    :param func: function taking a name
+    :param names: list of names
+    :param args: other arguments to the function
+    :return: elapsed CPU time, in seconds
+    """
+    start = time.clock()
+    for name in names:
+        func(name, *args)
+    elapsed = time.clock() - start
+    print "%-40s %8.3f s %8.3f us/name" % (label, elapsed,
+                                          elapsed * 1e6 / len(names))
+    return elapsed
+
+
+def main():
+    """Run the microbenchmark"""
+    parser = OptionParser("usage: %prog [options]")
+    parser.add_option('-n', '--count', dest='count', type='int',
+                      help="number of identifiers (default %default)")
+    parser.add_option('--distinct', dest='distinct', type='int',
+                      help="distinct qualified names (default %default)")
+    parser.set_defaults(count=1000000, distinct=5000)
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error("too many arguments")
+
+    names = identifiers(options.count)
+    walk = timed("quote_id, character by character", walk_quote_id, names)
+    fast = timed("quote_id", quote_id, names)
+    timed("quote_id, keywords of 9.0", quote_id, names, 90000)
+    print "%-40s %8.2fx" % ("speedup", walk / fast)
+
+    schemas = ['public', 's1', '"My Schema"']
+    qualnames = ["%s.%s" % (schemas[i % len(schemas)], quote_id(name))
+                 for (i, name) in enumerate(names[:options.distinct])]
+    repeated = [qualnames[i % len(qualnames)]
+                for i in xrange(options.count)]
+    split_qualname.clear()
+    timed("split_qualname, %d distinct" % len(qualnames), split_qualname,
+          repeated)
+    print "%-40s %8d hits, %d misses" % ("memo", split_qualname.hits,
+                                         split_qualname.misses)
+    distinct = ["%s.%s" % (schemas[i % len(schemas)], quote_id(name))
+                for (i, name) in enumerate(names)]
+    split_qualname.clear()
+    timed("split_qualname, all distinct", split_qualname, distinct)
+    sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
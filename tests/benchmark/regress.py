@@ -0,0 +1,209 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Check Pyrseas operations for performance regressions
+
+A fixed set of scenarios is timed and compared with the baselines
+stored in baselines.json.  The scenarios run on objects built from a
+generated map (see generator.SchemaGenerator.map) and converted to
+the shape they have when read from the catalogs, so that neither a
+database server nor psycopg2 is needed.  Times are CPU times divided
+by that of a calibration loop, so that baselines recorded on one
+machine can be checked on another.  The script exits with status 1 if
+any scenario is slower than its baseline by more than the tolerance.
+"""
+
+import copy
+import gc
+import json
+import os
+import sys
+import time
+from optparse import OptionParser
+
+from pyrseas.database import Database
+from pyrseas.dbobject import quote_id
+from generator import SchemaGenerator
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'baselines.json')
+
+
+def cputime(func, *args):
+    """Return the CPU time taken by a function call
+
+    :param func: function to call
+    :param args: arguments to the function
+    :return: seconds
+
+    Garbage collection is disabled during the call, as in timeit.
+    """
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.clock()
+        func(*args)
+        return time.clock() - start
+    finally:
+        gc.enable()
+
+
+def calibration():
+    "A fixed workload of string formatting, dictionary and sorting work"
+    dct = {}
+    for i in xrange(200000):
+        dct['k%d' % i] = [i]
+    sorted(dct.items())
+
+
+def catalog_shape(dicts):
+    """Convert objects built from a map to their shape in the catalogs
+
+    :param dicts: a Database.Dicts object, already linked
+
+    Columns are numbered and constraint and index columns are given
+    by number, as returned by the catalog queries.
+    """
+    nums = {}
+    for (key, cols) in dicts.columns.items():
+        nums[key] = {}
+        for (num, col) in enumerate(cols):
+            col.number = num + 1
+            nums[key][col.name] = num + 1
+    for cns in dicts.constraints.values():
+        cns.keycols = [nums[(cns.schema, cns.table)][col]
+                       for col in cns.keycols]
+        if hasattr(cns, 'ref_table'):
+            cns.ref_cols = [nums[(cns.ref_schema, cns.ref_table)][col]
+                            for col in cns.ref_cols]
+    for idx in dicts.indexes.values():
+        idx.keycols = " ".join([str(nums[(idx.schema, idx.table)][col])
+                                for col in idx.keycols])
+
+
+class Scenarios(object):
+    """The timed scenarios, on a generated schema"""
+
+    names = ['link_refs', 'to_map', 'column_diff_map',
+             'constraint_diff_map', 'quote_id']
+
+    def __init__(self, generator, identifiers=1000000):
+        """Initialize the scenarios
+
+        :param generator: a SchemaGenerator
+        :param identifiers: number of identifiers to quote
+        """
+        self.generator = generator
+        self.identifiers = identifiers
+        self.inmap = generator.map()
+        self.altmap = generator.alter_map(copy.deepcopy(self.inmap))
+
+    def dicts(self, inmap, link=True):
+        """Build the objects described by a map
+
+        :param inmap: map as returned by SchemaGenerator.map
+        :param link: link related objects
+        :return: a Database.Dicts object
+        """
+        dicts = Database.Dicts()
+        dicts.schemas.from_map(inmap, dicts)
+        if link:
+            Database(None)._link_refs(dicts)
+        return dicts
+
+    def link_refs(self):
+        "Link the objects of a catalog"
+        dicts = self.dicts(self.inmap, False)
+        return cputime(Database(None)._link_refs, dicts)
+
+    def to_map(self):
+        "Convert the objects of a catalog to a map"
+        db = Database(None)
+        db.db = self.dicts(self.inmap)
+        catalog_shape(db.db)
+        return cputime(db.to_map)
+
+    def column_diff_map(self):
+        "Compare the columns of a catalog to those of a changed map"
+        db = self.dicts(self.inmap)
+        catalog_shape(db)
+        ndb = self.dicts(self.altmap)
+        return cputime(db.columns.diff_map, ndb.columns)
+
+    def constraint_diff_map(self):
+        "Compare the constraints of a catalog to those of a changed map"
+        db = self.dicts(self.inmap)
+        catalog_shape(db)
+        ndb = self.dicts(self.altmap)
+        return cputime(db.constraints.diff_map, ndb.constraints)
+
+    def quote_id(self):
+        "Quote a mix of regular and irregular identifiers"
+        kinds = ['c%d', 'tbl_%d', 'Mixed%d', '%d_x', 'with space %d']
+        names = [kinds[i % len(kinds)] % i for i in xrange(self.identifiers)]
+
+        def quote_all():
+            for name in names:
+                quote_id(name)
+        return cputime(quote_all)
+
+    def run(self, name, repeat=3):
+        """Time a scenario
+
+        :param name: name of the scenario
+        :param repeat: number of runs
+        :return: the best CPU time, in seconds
+        """
+        return min([getattr(self, name)() for i in range(repeat)])
+
+
+def main():
+    """Run the scenarios and compare them with the baselines"""
+    parser = OptionParser("usage: %prog [options] [scenario...]")
+    parser.add_option('--tolerance', dest='tolerance', type='float',
+                      help="allowed slowdown relative to the baseline "
+                      "(default %default)")
+    parser.add_option('--repeat', dest='repeat', type='int',
+                      help="runs of each scenario, of which the best is "
+                      "kept (default %default)")
+    parser.add_option('--update', action='store_true', dest='update',
+                      help="record the results as the new baselines")
+    parser.add_option('-b', '--baselines', dest='baselines',
+                      help="baselines file (default %default)")
+    parser.set_defaults(tolerance=0.3, repeat=3, baselines=BASELINES)
+    (options, args) = parser.parse_args()
+
+    baselines = json.load(open(options.baselines))
+    params = baselines['generator']
+    scenarios = Scenarios(SchemaGenerator(
+            params['tables'], params['schemas'], params['columns'],
+            params['fkeys'], params['indexes']), baselines['identifiers'])
+    names = args or scenarios.names
+    for name in names:
+        if name not in scenarios.names:
+            parser.error("unknown scenario '%s'" % name)
+    unit = min([cputime(calibration) for i in range(options.repeat)])
+    print "%-22s %10s %10s %10s" % ('scenario', 'cpu (s)', 'relative',
+                                    'baseline')
+    failed = []
+    for name in names:
+        relative = scenarios.run(name, options.repeat) / unit
+        baseline = baselines['scenarios'].get(name)
+        print "%-22s %10.3f %10.2f %10s" % (
+            name, relative * unit, relative,
+            baseline is not None and "%.2f" % baseline or '')
+        if options.update:
+            baselines['scenarios'][name] = round(relative, 2)
+        elif baseline is not None and \
+                relative > baseline * (1 + options.tolerance):
+            failed.append(name)
+    if options.update:
+        output = open(options.baselines, 'w')
+        json.dump(baselines, output, indent=2, sort_keys=True)
+        output.write('\n')
+    elif failed:
+        print >> sys.stderr, "regressions beyond %d%%: %s" % (
+            options.tolerance * 100, ", ".join(failed))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
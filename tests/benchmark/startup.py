@@ -0,0 +1,125 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Time the startup of the Pyrseas utilities
+
+Each utility module is imported in a fresh interpreter, a number of
+times, and the best and median wall clock times are reported.  A
+breakdown of the time spent importing each module, in the manner of
+Python 3's ``-X importtime``, which Python 2 lacks, is obtained by
+timing the calls to ``__import__`` in another interpreter.  The script
+exits with status 1 if a module that should only be imported when an
+option needs it is loaded at startup.
+"""
+
+import __builtin__
+import json
+import os
+import subprocess
+import sys
+import time
+from optparse import OptionParser, SUPPRESS_HELP
+
+UTILITIES = ['pyrseas.dbtoyaml', 'pyrseas.yamltodb']
+
+# modules that the utilities import only after parsing their arguments
+DEFERRED = ['yaml', 'psycopg2', 'pyrseas.database', 'pyrseas.executor',
+            'pyrseas.rehearse', 'pyrseas.monitor', 'pyrseas.journal',
+            'pyrseas.profiler', 'pyrseas.metrics', 'pyrseas.estimate',
+            'pyrseas.plan']
+
+
+def traced_import(module):
+    """Import a module, timing each module imported in turn
+
+    :param module: name of the module
+    :return: list of (self seconds, cumulative seconds, depth, name),
+      in the order the imports completed
+    """
+    times = []
+    children = [0.0]
+    real_import = __builtin__.__import__
+
+    def timed_import(name, *args, **kwargs):
+        before = len(sys.modules)
+        children.append(0.0)
+        start = time.time()
+        try:
+            return real_import(name, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            inner = children.pop()
+            children[-1] += elapsed
+            if len(sys.modules) > before:
+                times.append((elapsed - inner, elapsed, len(children) - 1,
+                              name))
+    __builtin__.__import__ = timed_import
+    try:
+        __import__(module)
+    finally:
+        __builtin__.__import__ = real_import
+    return times
+
+
+def startup(module, env):
+    """Import a module in a new interpreter
+
+    :param module: name of the module
+    :param env: environment of the interpreter
+    :return: tuple of wall clock seconds and the modules loaded
+    """
+    start = time.time()
+    output = subprocess.Popen(
+        [sys.executable, '-c', "import sys, %s; print ' '.join("
+         "[name for name in sys.modules if sys.modules[name]])" % module],
+        env=env, stdout=subprocess.PIPE).communicate()[0]
+    return (time.time() - start, output.split())
+
+
+def main():
+    """Run the startup benchmark"""
+    parser = OptionParser("usage: %prog [options] [module...]")
+    parser.add_option('-n', '--runs', dest='runs', type='int',
+                      help="interpreters started per module "
+                      "(default %default)")
+    parser.add_option('--top', dest='top', type='int',
+                      help="slowest imports shown per module "
+                      "(default %default)")
+    parser.add_option('--trace', dest='trace',
+                      help=SUPPRESS_HELP)
+    parser.set_defaults(runs=20, top=10)
+    (options, args) = parser.parse_args()
+
+    if options.trace:
+        json.dump(traced_import(options.trace), sys.stdout)
+        return
+    env = os.environ.copy()
+    root = os.path.dirname(os.path.dirname(os.path.dirname(
+                os.path.abspath(__file__))))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [root] + [path for path in [env.get('PYTHONPATH')] if path])
+    startup('sys', env)
+    base = min([startup('sys', env)[0] for i in range(options.runs)])
+    print "%-30s %10.1f ms" % ('interpreter', base * 1000)
+    deferred = []
+    for module in args or UTILITIES:
+        runs = [startup(module, env) for i in range(options.runs)]
+        walls = sorted([wall for (wall, loaded) in runs])
+        print "%-30s %10.1f ms best, %.1f ms median" % (
+            module, walls[0] * 1000, walls[len(walls) // 2] * 1000)
+        loaded = runs[0][1]
+        for name in DEFERRED:
+            if name in loaded:
+                deferred.append("%s imports %s" % (module, name))
+        output = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--trace', module],
+            env=env, stdout=subprocess.PIPE).communicate()[0]
+        times = sorted(json.loads(output), reverse=True)[:options.top]
+        for (own, cumulative, depth, name) in times:
+            print "    %8.2f ms self %8.2f ms cumulative  %s%s" % (
+                own * 1000, cumulative * 1000, '  ' * depth, name)
+    if deferred:
+        print >> sys.stderr, "\n".join(deferred)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -18,6 +18,14 @@ import test_operator
 import test_trigger
 import test_rule
 import test_conversion
+import test_executor
+import test_rehearse
+import test_dbconn
+import test_profiler
+import test_metrics
+import test_identifier
+import test_plan
+import test_estimate
 
 
 def suite():
@@ -37,6 +45,14 @@ def suite():
     tests.addTest(test_trigger.suite())
     tests.addTest(test_rule.suite())
     tests.addTest(test_conversion.suite())
+    tests.addTest(test_executor.suite())
+    tests.addTest(test_rehearse.suite())
+    tests.addTest(test_dbconn.suite())
+    tests.addTest(test_profiler.suite())
+    tests.addTest(test_metrics.suite())
+    tests.addTest(test_identifier.suite())
+    tests.addTest(test_plan.suite())
+    tests.addTest(test_estimate.suite())
     return tests
 
 if __name__ == '__main__':
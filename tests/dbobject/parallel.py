@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Run the Pyrseas unit tests in parallel
+
+The tests are dealt out to a number of worker processes, each running
+its share with unittest against its own database, named after
+PYRSEAS_TEST_DB with the worker number as suffix.  The worker
+databases are re-created before each test from the same template
+database, which is created first.
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from multiprocessing import cpu_count
+from optparse import OptionParser
+
+from __init__ import suite
+from utils import PostgresDb, TEST_BASE_DBNAME, TEST_USER, TEST_HOST
+from utils import TEST_PORT, TEST_TEMPLATE
+
+
+def test_ids(tests):
+    """Return the ids of the tests of a suite, in order
+
+    :param tests: a unittest.TestSuite
+    :return: list of test ids, e.g., 'test_table.TableToMapTestCase.test_x'
+    """
+    ids = []
+    for test in tests:
+        if isinstance(test, unittest.TestSuite):
+            ids.extend(test_ids(test))
+        else:
+            ids.append(test.id())
+    return ids
+
+
+def main():
+    """Run the tests over several workers and report their results"""
+    parser = OptionParser("usage: %prog [options] [module...]")
+    parser.add_option('-j', '--jobs', dest='jobs', type='int',
+                      help="number of worker processes (default %default)")
+    parser.set_defaults(jobs=cpu_count())
+    (options, args) = parser.parse_args()
+
+    if args:
+        tests = unittest.TestLoader().loadTestsFromNames(args)
+    else:
+        tests = suite()
+    ids = test_ids(tests)
+    PostgresDb(TEST_BASE_DBNAME, TEST_USER, TEST_HOST, TEST_PORT,
+               template=TEST_TEMPLATE).create_template()
+    jobs = min(options.jobs, len(ids))
+    workers = []
+    for num in range(jobs):
+        env = os.environ.copy()
+        env['PYRSEAS_TEST_WORKER'] = str(num + 1)
+        output = tempfile.TemporaryFile()
+        workers.append((subprocess.Popen(
+                    [sys.executable, '-m', 'unittest'] +
+                    ids[num::jobs],
+                    cwd=os.path.dirname(os.path.abspath(__file__)),
+                    env=env, stdout=output, stderr=subprocess.STDOUT),
+                        output))
+    failed = 0
+    for (num, (worker, output)) in enumerate(workers):
+        if worker.wait():
+            failed += 1
+        print "=== worker %d (%s_%d) ===" % (num + 1, TEST_BASE_DBNAME,
+                                              num + 1)
+        output.seek(0)
+        sys.stdout.write(output.read())
+        output.close()
+    if failed:
+        print >> sys.stderr, "%d of %d workers had failures" % (
+            failed, len(workers))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
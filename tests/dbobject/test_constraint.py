@@ -74,6 +74,24 @@ class CheckConstraintToSqlTestCase(PyrseasTestCase):
                          "ALTER TABLE t1 ADD CONSTRAINT t1_check_2_1 "
                          "CHECK (c2 != c1)")
 
+    def test_add_check_constraint_online(self):
+        "Add a CHECK constraint as NOT VALID and validate it separately"
+        if self.db.version < 90200:
+            self.skipTest('Only available on PG 9.2')
+        self.db.execute(DROP_STMT)
+        self.db.execute_commit("CREATE TABLE t1 (c1 INTEGER, c2 TEXT)")
+        inmap = new_std_map()
+        inmap['schema public'].update({'table t1': {
+                'columns': [{'c1': {'type': 'integer'}},
+                            {'c2': {'type': 'text'}}],
+                'check_constraints': {'t1_c1_check': {
+                        'columns': ['c1'], 'expression': 'c1 > 0'}}}})
+        dbsql = self.db.process_map(inmap, online=True)
+        self.assertEqual(dbsql, [
+                "ALTER TABLE t1 ADD CONSTRAINT t1_c1_check CHECK (c1 > 0) "
+                "NOT VALID",
+                "ALTER TABLE t1 VALIDATE CONSTRAINT t1_c1_check"])
+
 
 class PrimaryKeyToMapTestCase(PyrseasTestCase):
     """Test mapping of created PRIMARY KEYs"""
@@ -439,6 +457,56 @@ class ForeignKeyToSqlTestCase(PyrseasTestCase):
                          "ALTER TABLE t2 ADD CONSTRAINT t2_c23_fkey "
                          "FOREIGN KEY (c23, c24) REFERENCES t1 (c11, c12)")
 
+    def test_add_foreign_key_online(self):
+        "Add a foreign key as NOT VALID and validate it separately"
+        if self.db.version < 90100:
+            self.skipTest('Only available on PG 9.1')
+        self.db.execute(DROP_STMT + ", t2")
+        self.db.execute("CREATE TABLE t1 (c11 INTEGER PRIMARY KEY, c12 TEXT)")
+        self.db.execute_commit("CREATE TABLE t2 (c21 INTEGER PRIMARY KEY, "
+                               "c22 INTEGER)")
+        inmap = new_std_map()
+        inmap['schema public'].update({
+                'table t1': {'columns': [
+                        {'c11': {'type': 'integer', 'not_null': True}},
+                        {'c12': {'type': 'text'}}],
+                             'primary_key': {'t1_pkey': {
+                            'columns': ['c11'], 'access_method': 'btree'}}},
+                'table t2': {'columns': [
+                        {'c21': {'type': 'integer', 'not_null': True}},
+                        {'c22': {'type': 'integer'}}],
+                             'primary_key': {'t2_pkey': {
+                            'columns': ['c21'], 'access_method': 'btree'}},
+                             'foreign_keys': {'t2_c22_fkey': {
+                            'columns': ['c22'],
+                            'references': {'columns': ['c11'],
+                                           'table': 't1'}}}}})
+        dbsql = self.db.process_map(inmap, online=True)
+        self.assertEqual(dbsql, [
+                "ALTER TABLE t2 ADD CONSTRAINT t2_c22_fkey FOREIGN KEY (c22) "
+                "REFERENCES t1 (c11) NOT VALID",
+                "ALTER TABLE t2 VALIDATE CONSTRAINT t2_c22_fkey"])
+
+    def test_create_with_foreign_key_online(self):
+        "Foreign keys on tables created by the same plan are added normally"
+        self.db.execute_commit(DROP_STMT + ", t2")
+        inmap = new_std_map()
+        inmap['schema public'].update({'table t1': {
+                    'columns': [{'c11': {'type': 'integer'}},
+                                {'c12': {'type': 'text'}}]},
+                                   'table t2': {
+                    'columns': [{'c21': {'type': 'integer'}},
+                                {'c22': {'type': 'integer'}}],
+                    'foreign_keys': {'t2_c22_fkey': {
+                            'columns': ['c22'],
+                            'references': {'columns': ['c11'],
+                                           'table': 't1'}}}}})
+        dbsql = self.db.process_map(inmap, online=True)
+        self.assertEqual(len(dbsql), 3)
+        self.assertEqual(fix_indent(dbsql[2]),
+                         "ALTER TABLE t2 ADD CONSTRAINT t2_c22_fkey "
+                         "FOREIGN KEY (c22) REFERENCES t1 (c11)")
+
     def test_drop_foreign_key(self):
         "Drop a foreign key on an existing table"
         self.db.execute(DROP_STMT + ", t2")
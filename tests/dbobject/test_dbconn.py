@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""Test recording and replaying catalog queries"""
+
+import os
+import tempfile
+import unittest
+
+from pyrseas.dbconn import RecordingDbConnection, ReplayDbConnection
+from pyrseas.database import Database
+from utils import PyrseasTestCase, new_std_map
+
+CREATE_STMT1 = "CREATE TABLE t1 (c1 integer PRIMARY KEY, c2 text)"
+CREATE_STMT2 = "CREATE TABLE t2 (c1 integer REFERENCES t1, c2 date)"
+
+
+class RecordReplayTestCase(PyrseasTestCase):
+    """Test serving catalog query results from a fixture file"""
+
+    def setUp(self):
+        super(RecordReplayTestCase, self).setUp()
+        (fd, self.fixture) = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.fixture)
+        super(RecordReplayTestCase, self).tearDown()
+
+    def record(self):
+        dbconn = RecordingDbConnection(self.db.name, self.db.user,
+                                       self.db.host, self.db.port,
+                                       fixture=self.fixture)
+        return Database(dbconn).to_map()
+
+    def test_replay_map(self):
+        "Map a database from its recorded catalogs"
+        self.db.execute(CREATE_STMT1)
+        self.db.execute_commit(CREATE_STMT2)
+        dbmap = self.record()
+        replay = ReplayDbConnection(self.fixture)
+        self.assertEqual(replay.version, self.db.version)
+        self.assertEqual(Database(replay).to_map(), dbmap)
+
+    def test_replay_diff_map(self):
+        "Generate statements against recorded catalogs"
+        self.db.execute_commit(CREATE_STMT1)
+        self.record()
+        inmap = new_std_map()
+        inmap['schema public'].update({'table t1': {
+                    'columns': [{'c1': {'type': 'integer',
+                                        'not_null': True}},
+                                {'c2': {'type': 'text'}},
+                                {'c3': {'type': 'date'}}],
+                    'primary_key': {'t1_pkey': {
+                            'columns': ['c1'], 'access_method': 'btree'}}}})
+        stmts = Database(ReplayDbConnection(self.fixture)).diff_map(inmap)
+        self.assertEqual(stmts, self.db.process_map(inmap))
+        self.assertEqual(stmts, ["ALTER TABLE t1 ADD COLUMN c3 date"])
+
+    def test_replay_unrecorded(self):
+        "Error on a query that was not recorded"
+        self.db.execute_commit(CREATE_STMT1)
+        self.record()
+        replay = ReplayDbConnection(self.fixture)
+        self.assertRaises(KeyError, replay.fetchall, "SELECT 1")
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(RecordReplayTestCase)
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
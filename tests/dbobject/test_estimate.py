@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""Test the estimation of migration costs"""
+
+import unittest
+
+from pyrseas.dbobject.column import NO_REWRITE
+from pyrseas.estimate import CostEstimator, MB
+from pyrseas.plan import analyze_statement
+
+ALTER_TYPE = "ALTER TABLE t1 ALTER COLUMN c2 TYPE bigint"
+
+
+class StubConnection(object):
+    """A connection that only reports the server's version"""
+
+    version = 110000
+    conn = None
+
+
+class CostEstimatorTestCase(unittest.TestCase):
+    """Test estimating costs from relation sizes"""
+
+    def setUp(self):
+        self.estimator = CostEstimator(StubConnection())
+        self.estimator.sizes = {
+            't1': {'pages': 12800, 'rows': 1000000.0, 'heap': 100 * MB,
+                   'toast': 20 * MB, 'indexes': 30 * MB, 'num_indexes': 2},
+            's1.t2': {'pages': 128, 'rows': 1000.0, 'heap': MB, 'toast': 0,
+                      'indexes': 0, 'num_indexes': 0}}
+
+    def cost(self, stmt):
+        (read, write) = self.estimator._cost(analyze_statement(
+                stmt, dbversion=StubConnection.version))
+        return (read / MB, write / MB)
+
+    def test_rewrite(self):
+        "Read and write the table, and rebuild its indexes, on a rewrite"
+        self.assertEqual(self.cost(ALTER_TYPE), (360.0, 150.0))
+
+    def test_scan(self):
+        "Read the heap only to validate a constraint"
+        self.assertEqual(self.cost("ALTER TABLE t1 ADD CONSTRAINT "
+                                   "t1_c1_check CHECK (c1 > 0)"),
+                         (100.0, 0.0))
+
+    def test_index_build(self):
+        "Read the table and write a fraction of it to build an index"
+        self.assertEqual(self.cost("CREATE INDEX t1_idx ON t1 (c1)"),
+                         (120.0, 30.0))
+
+    def test_first_table(self):
+        "Charge only the table altered, not the referenced tables"
+        self.assertEqual(self.cost(
+                "ALTER TABLE s1.t2 ADD CONSTRAINT t2_c1_fkey FOREIGN KEY "
+                "(c1) REFERENCES t1 (c1)"), (1.0, 0.0))
+
+    def test_unknown_table(self):
+        "Charge nothing for a new table or one without a cost"
+        self.assertEqual(self.cost("CREATE TABLE t3 (c1 integer)"),
+                         (0.0, 0.0))
+        self.assertEqual(self.cost("COMMENT ON TABLE t1 IS 'Test'"),
+                         (0.0, 0.0))
+
+    def test_estimate(self):
+        "Estimate the duration of each statement and sum it per table"
+        (stmtcosts, tables) = self.estimator.estimate(
+            ["SET search_path TO s1, pg_catalog",
+             "CREATE INDEX t2_idx ON t2 (c1)",
+             "SET search_path TO public, pg_catalog",
+             ALTER_TYPE, "CREATE INDEX t1_idx ON t1 (c1)",
+             "CREATE TABLE t3 (c1 integer)"])
+        self.assertEqual([info['rows'] for info in stmtcosts],
+                         [0, 1000, 0, 1000000, 1000000, 0])
+        self.assertAlmostEqual(stmtcosts[3]['seconds'], 6.61)
+        self.assertAlmostEqual(stmtcosts[5]['seconds'], 0.01)
+        self.assertEqual(sorted(tables.keys()), ['s1.t2', 't1'])
+        self.assertEqual((tables['t1']['statements'],
+                          tables['t1']['read_mb'],
+                          tables['t1']['write_mb'],
+                          tables['t1']['rewrite']), (2, 480.0, 180.0, True))
+        self.assertFalse(tables['s1.t2']['rewrite'])
+
+    def test_estimate_type_changes(self):
+        "Charge nothing but the overhead for a type change without rewrite"
+        (stmtcosts, tables) = self.estimator.estimate(
+            [ALTER_TYPE], [('t1', 'c2', 'integer', 'bigint', NO_REWRITE)])
+        self.assertEqual((stmtcosts[0]['read_mb'], stmtcosts[0]['write_mb']),
+                         (0.0, 0.0))
+        self.assertFalse(tables['t1']['rewrite'])
+
+    def test_rates(self):
+        "Use the throughputs and overhead given"
+        estimator = CostEstimator(StubConnection(), read_rate=360.0,
+                                  write_rate=150.0, overhead=0)
+        estimator.sizes = self.estimator.sizes
+        (stmtcosts, tables) = estimator.estimate([ALTER_TYPE])
+        self.assertAlmostEqual(stmtcosts[0]['seconds'], 2.0)
+        self.assertEqual(estimator.report([ALTER_TYPE])[-1],
+                         "-- estimated total: 2.0 s")
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(CostEstimatorTestCase)
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+"""Test execution of generated statements"""
+
+import os
+import sys
+import tempfile
+import time
+import unittest
+from StringIO import StringIO
+from threading import Thread
+
+from pyrseas.executor import Executor, ParallelExecutor
+from pyrseas.executor import OK, FAILED, ROLLED_BACK, TIMED_OUT
+from pyrseas.monitor import Watchdog, LagThrottle
+from pyrseas.journal import Journal
+from pyrseas.plan import analyze_plan
+from utils import PyrseasTestCase, new_std_map, pgconnect, pgexecute
+
+CREATE_STMT = "CREATE TABLE t1 (c1 integer, c2 text)"
+CREATE_STMT2 = "CREATE TABLE t2 (c1 integer)"
+
+
+class ExecutorTestCase(PyrseasTestCase):
+    """Test applying statements to a database"""
+
+    def executor(self, **kwargs):
+        return Executor(self.db.dbconnection(), **kwargs)
+
+    def test_apply_map(self):
+        "Apply the statements to create a table"
+        inmap = new_std_map()
+        inmap['schema public'].update({'table t1': {
+                    'columns': [{'c1': {'type': 'integer'}},
+                                {'c2': {'type': 'text'}}]}})
+        stmts = self.db.process_map(inmap)
+        executor = self.executor()
+        report = executor.execute(stmts)
+        self.assertEqual([entry['status'] for entry in report],
+                         [OK] * len(stmts))
+        self.assertEqual(executor.failed(), None)
+        self.assertEqual(self.db.process_map(inmap), [])
+
+    def test_record_locks(self):
+        "Record the locks taken by a statement"
+        self.db.execute_commit(CREATE_STMT)
+        report = self.executor().execute(
+            ["ALTER TABLE t1 ADD COLUMN c3 date"])
+        self.assertEqual(report[0]['tables'], ['t1'])
+        self.assertTrue(['t1', 'AccessExclusiveLock'] in report[0]['locks'])
+        self.assertTrue(report[0]['duration'] >= 0)
+
+    def test_record_rows(self):
+        "Record the rows affected by a statement"
+        self.db.execute_commit(CREATE_STMT)
+        self.db.execute_commit("INSERT INTO t1 VALUES (1, 'a'), (2, 'b')")
+        report = self.executor().execute(["UPDATE t1 SET c2 = 'c'"])
+        self.assertEqual(report[0]['rows'], 2)
+
+    def test_backfill_batches(self):
+        "Run a backfill in batches over ranges of the key"
+        self.db.execute_commit("CREATE TABLE t1 (c1 integer PRIMARY KEY, "
+                               "c2 text)")
+        self.db.execute_commit("INSERT INTO t1 SELECT i, NULL "
+                               "FROM generate_series(1, 25) i")
+        report = self.executor(batch_size=10).execute(
+            ["UPDATE t1 SET c2 = 'a' WHERE c2 IS NULL /* batched by c1 */"])
+        self.assertEqual(report[0]['status'], OK)
+        self.assertEqual(report[0]['batches'], 3)
+        self.assertEqual(report[0]['rows'], 25)
+
+    def test_backfill_progress(self):
+        "Report the progress of a backfill after each batch"
+        self.db.execute_commit("CREATE TABLE t1 (c1 integer PRIMARY KEY, "
+                               "c2 text)")
+        self.db.execute_commit("INSERT INTO t1 SELECT i, NULL "
+                               "FROM generate_series(1, 20) i")
+        progress = tempfile.TemporaryFile()
+        self.executor(batch_size=10, progress=progress).execute(
+            ["UPDATE t1 SET c2 = 'a' WHERE c2 IS NULL /* batched by c1 */"])
+        progress.seek(0)
+        lines = progress.readlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith("t1: 1 batches, 10 rows, "
+                                            "50.0% done"))
+        self.assertTrue(lines[1].startswith("t1: 2 batches, 20 rows, "
+                                            "100.0% done, 0:00:00"))
+
+    def test_stop_on_failure(self):
+        "Stop at the first failing statement"
+        report = self.executor().execute([CREATE_STMT, CREATE_STMT,
+                                          CREATE_STMT2])
+        self.assertEqual(len(report), 2)
+        self.assertEqual(report[0]['status'], OK)
+        self.assertEqual(report[1]['status'], FAILED)
+        self.assertEqual(report[1]['sqlstate'], '42P07')
+
+    def test_single_transaction(self):
+        "Roll back all statements in a single transaction"
+        executor = self.executor(onetrans=True)
+        report = executor.execute([CREATE_STMT, CREATE_STMT])
+        self.assertEqual(report[0]['status'], ROLLED_BACK)
+        self.assertEqual(executor.failed()['statement'], CREATE_STMT)
+        self.assertEqual(self.db.database().to_map(), new_std_map())
+
+    def test_chunk_per_table(self):
+        "Roll back the statements of the failing chunk only"
+        stmts = [CREATE_STMT, "ALTER TABLE t1 ADD COLUMN c3 date",
+                 CREATE_STMT2, "ALTER TABLE t2 ADD COLUMN c1 integer"]
+        executor = self.executor(chunking='table')
+        report = executor.execute(stmts)
+        self.assertEqual([entry['status'] for entry in report],
+                         [OK, OK, ROLLED_BACK, FAILED])
+        dbmap = self.db.database().to_map()
+        self.assertTrue('table t1' in dbmap['schema public'])
+        self.assertFalse('table t2' in dbmap['schema public'])
+
+    def test_chunk_count(self):
+        "Run statements in chunks of a given size"
+        stmts = [CREATE_STMT, CREATE_STMT2, "CREATE TABLE t3 (c1 integer)",
+                 "CREATE INDEX CONCURRENTLY t3_idx ON t3 (c1)"]
+        executor = self.executor(chunking='count', chunk_size=2)
+        self.assertEqual(executor.chunks(stmts, analyze_plan(stmts)),
+                         [[0, 1], [2], [3]])
+        executor.execute(stmts)
+        self.assertEqual(executor.status(), OK)
+
+    def test_lock_timeout(self):
+        "Fail a statement waiting too long for a lock"
+        if self.db.version < 90300:
+            self.skipTest('Only available on PG 9.3')
+        self.db.execute_commit(CREATE_STMT)
+        self.db.execute("LOCK TABLE t1")
+        report = self.executor(lock_timeout=100).execute(
+            ["ALTER TABLE t1 ADD COLUMN c3 date"])
+        self.db.conn.rollback()
+        self.assertEqual(report[0]['status'], FAILED)
+        self.assertEqual(report[0]['sqlstate'], '55P03')
+
+    def test_lock_timeout_retry(self):
+        "Retry a statement waiting too long for a lock"
+        if self.db.version < 90300:
+            self.skipTest('Only available on PG 9.3')
+        self.db.execute_commit(CREATE_STMT)
+        self.db.execute("LOCK TABLE t1")
+        report = self.executor(lock_timeout=50, retries=2,
+                               retry_delay=0.01).execute(
+            ["ALTER TABLE t1 ADD COLUMN c3 date"])
+        self.db.conn.rollback()
+        self.assertEqual(report[0]['status'], FAILED)
+        self.assertEqual(len(report[0]['attempts']), 3)
+        self.assertTrue('delay' in report[0]['attempts'][0])
+        self.assertFalse('delay' in report[0]['attempts'][2])
+
+    def test_watchdog_cancel(self):
+        "Cancel a statement blocking another session"
+        self.db.execute_commit(CREATE_STMT)
+
+        def blocked():
+            time.sleep(0.5)
+            conn = pgconnect(self.db.name, self.db.user, self.db.host,
+                             self.db.port)
+            pgexecute(conn, "SELECT * FROM t1").close()
+            conn.close()
+        thread = Thread(target=blocked)
+        thread.start()
+        dbconn = self.db.dbconnection()
+        executor = Executor(dbconn, watchdog=Watchdog(
+                dbconn, max_blocked=1, interval=0.1))
+        report = executor.execute(["LOCK TABLE t1; SELECT pg_sleep(10)"])
+        thread.join()
+        self.assertEqual(report[0]['status'], FAILED)
+        self.assertEqual(report[0]['sqlstate'], '57014')
+        self.assertEqual(report[0]['blocking']['max_blocked'], 1)
+        self.assertTrue(report[0]['blocking']['cancelled'])
+
+    def test_throttle_without_standbys(self):
+        "Do not wait when there are no standbys"
+        if self.db.version < 90200:
+            self.skipTest('Only available on PG 9.2')
+        dbconn = self.db.dbconnection()
+        executor = Executor(dbconn, throttle=LagThrottle(dbconn, 0))
+        report = executor.execute([CREATE_STMT])
+        self.assertEqual(report[0]['status'], OK)
+        self.assertEqual(report[0]['throttled'], 0.0)
+
+    def test_backoff(self):
+        "Increase the retry delay exponentially up to the maximum"
+        executor = self.executor(retry_delay=1.0, max_delay=4.0)
+        self.assertTrue(0.5 <= executor.backoff(0) <= 1.0)
+        self.assertTrue(2.0 <= executor.backoff(2) <= 4.0)
+        self.assertTrue(2.0 <= executor.backoff(5) <= 4.0)
+
+    def test_time_limit(self):
+        "Stop starting statements once the time limit is reached"
+        executor = self.executor(time_limit=0)
+        report = executor.execute([CREATE_STMT, CREATE_STMT2])
+        self.assertEqual(report, [])
+        self.assertEqual(executor.status(), TIMED_OUT)
+
+
+class StubConnection(object):
+    """A connection answering the watchdog's check query"""
+
+    version = 90600
+
+    def __init__(self, rows, during_check=None):
+        self.conn = True
+        self.rows = rows
+        self.during_check = during_check
+        self.cancelled = []
+
+    def clone(self):
+        return self
+
+    def close(self):
+        self.conn = None
+
+    def connect(self):
+        self.conn = True
+
+    def fetchall(self, query):
+        if self.during_check:
+            self.during_check()
+        if isinstance(self.rows, Exception):
+            raise self.rows
+        return self.rows
+
+    def fetchone(self, query):
+        self.cancelled.append(query)
+        return [True]
+
+
+class WatchdogTestCase(unittest.TestCase):
+    """Test the watchdog's decisions, without a database"""
+
+    def test_cancel(self):
+        "Cancel a backend blocking too many sessions"
+        dbconn = StubConnection([{'pid': 1, 'blocked': 2, 'wait': 0.5}])
+        watchdog = Watchdog(dbconn, max_blocked=2)
+        watchdog.watch(1)
+        self.assertEqual(watchdog.check(), [1])
+        self.assertEqual(dbconn.cancelled, ["SELECT pg_cancel_backend(1)"])
+        self.assertTrue(watchdog.unwatch(1)['cancelled'])
+
+    def test_no_cancel_next_statement(self):
+        "Do not cancel a backend that moved on to another statement"
+        dbconn = StubConnection([{'pid': 1, 'blocked': 2, 'wait': 0.5}])
+        watchdog = Watchdog(dbconn, max_blocked=2)
+
+        def next_statement():
+            watchdog.unwatch(1)
+            watchdog.watch(1)
+        dbconn.during_check = next_statement
+        watchdog.watch(1)
+        self.assertEqual(watchdog.check(), [])
+        self.assertEqual(dbconn.cancelled, [])
+        self.assertFalse(watchdog.unwatch(1)['cancelled'])
+
+    def test_no_cancel_unwatched(self):
+        "Do not cancel a backend whose statement has completed"
+        dbconn = StubConnection([{'pid': 1, 'blocked': 2, 'wait': 0.5}])
+        watchdog = Watchdog(dbconn, max_blocked=2)
+        dbconn.during_check = lambda: watchdog.unwatch(1)
+        watchdog.watch(1)
+        self.assertEqual(watchdog.check(), [])
+        self.assertEqual(dbconn.cancelled, [])
+
+    def test_failed_check(self):
+        "Keep monitoring after a check fails"
+        dbconn = StubConnection(RuntimeError("connection lost"))
+        watchdog = Watchdog(dbconn, max_blocked=1, interval=0.01)
+        watchdog.watch(1)
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            watchdog.start()
+            time.sleep(0.1)
+            dbconn.rows = [{'pid': 1, 'blocked': 1, 'wait': 0.1}]
+            time.sleep(0.1)
+            watchdog.stop()
+            output = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertTrue("watchdog check failed: connection lost" in output)
+        self.assertEqual(dbconn.cancelled, ["SELECT pg_cancel_backend(1)"])
+
+
+class ParallelExecutorTestCase(PyrseasTestCase):
+    """Test applying statements concurrently"""
+
+    def executor(self, **kwargs):
+        return ParallelExecutor(self.db.dbconnection(), **kwargs)
+
+    def test_independent_statements(self):
+        "Run statements on different tables"
+        self.db.execute(CREATE_STMT)
+        self.db.execute_commit(CREATE_STMT2)
+        stmts = ["CREATE INDEX t1_idx ON t1 (c1)",
+                 "CREATE INDEX t2_idx ON t2 (c1)",
+                 "CREATE VIEW v1 AS SELECT c1 FROM t1",
+                 "COMMENT ON VIEW v1 IS 'Test view'"]
+        executor = self.executor(workers=3)
+        report = executor.execute(stmts)
+        self.assertEqual([entry['statement'] for entry in report], stmts)
+        self.assertEqual(executor.status(), OK)
+        dbmap = self.db.database().to_map()
+        self.assertEqual(dbmap['schema public']['view v1']['description'],
+                         'Test view')
+
+    def test_search_path(self):
+        "Set the search_path on every connection"
+        self.db.execute_commit("CREATE SCHEMA s1")
+        stmts = ["SET search_path TO s1, pg_catalog", CREATE_STMT,
+                 CREATE_STMT2, "SET search_path TO public, pg_catalog"]
+        self.executor(workers=2).execute(stmts)
+        dbmap = self.db.database().to_map()
+        self.assertTrue('table t1' in dbmap['schema s1'])
+        self.assertTrue('table t2' in dbmap['schema s1'])
+
+    def test_stop_on_failure(self):
+        "Do not start dependent statements after a failure"
+        executor = self.executor(workers=2)
+        report = executor.execute([CREATE_STMT, CREATE_STMT,
+                                   "CREATE INDEX t1_idx ON t1 (c1)"])
+        self.assertEqual(len(report), 2)
+        self.assertEqual(executor.failed()['sqlstate'], '42P07')
+
+    def test_failed_connection(self):
+        "Stop the watchdog if a worker cannot connect"
+        dbconn = self.db.dbconnection()
+        watchdog = Watchdog(dbconn, max_blocked=5)
+        executor = ParallelExecutor(dbconn, watchdog=watchdog, workers=2)
+        bad = dbconn.clone()
+        bad.dbname = 'pyrseas_no_such_db'
+        dbconn.clone = lambda: bad
+        self.assertRaises(Exception, executor.execute,
+                          [CREATE_STMT, CREATE_STMT2])
+        self.assertEqual(watchdog._thread, None)
+        self.assertEqual(watchdog.dbconn.conn, None)
+
+
+class JournalTestCase(PyrseasTestCase):
+    """Test resuming execution from a journal"""
+
+    stmts = [CREATE_STMT2,
+             "ALTER TABLE t1 ADD CONSTRAINT t1_c1_check CHECK (c1 > 0)",
+             "CREATE INDEX t2_idx ON t2 (c1)"]
+
+    def setUp(self):
+        super(JournalTestCase, self).setUp()
+        (fd, self.path) = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        os.remove(self.path)
+        self.db.execute(CREATE_STMT)
+        self.db.execute_commit("INSERT INTO t1 VALUES (0, 'a')")
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        super(JournalTestCase, self).tearDown()
+
+    def execute(self, journal, stmts):
+        return Executor(self.db.dbconnection(), journal=journal).execute(
+            stmts)
+
+    def fail_first_run(self):
+        journal = Journal(self.path)
+        self.assertFalse(journal.load())
+        journal.begin(self.stmts, 'spec')
+        report = self.execute(journal, self.stmts)
+        self.assertEqual(report[1]['status'], FAILED)
+        self.assertEqual(journal.completed(), set([0]))
+
+    def test_resume(self):
+        "Resume after the last completed statement"
+        self.fail_first_run()
+        self.db.execute_commit("DELETE FROM t1")
+        journal = Journal(self.path)
+        self.assertTrue(journal.load())
+        self.assertEqual(journal.verify(self.db.dbconnection(), 'spec'),
+                         None)
+        report = self.execute(journal, journal.statements)
+        self.assertEqual([entry['statement'] for entry in report],
+                         self.stmts[1:])
+        self.assertFalse(Journal(self.path).load())
+
+    def test_refuse_changed_catalog(self):
+        "Refuse to resume if the catalogs have changed"
+        self.fail_first_run()
+        self.db.execute_commit("CREATE TABLE t3 (c1 integer)")
+        journal = Journal(self.path)
+        self.assertTrue(journal.load())
+        self.assertNotEqual(journal.verify(self.db.dbconnection(), 'spec'),
+                            None)
+
+    def test_resume_after_crash(self):
+        "Resume an execution killed before it could finish the journal"
+        journal = Journal(self.path)
+        journal.begin(self.stmts, 'spec')
+        journal.finish = lambda: journal.dbconn.close()
+        report = self.execute(journal, self.stmts)
+        self.assertEqual(report[1]['status'], FAILED)
+        self.db.execute_commit("DELETE FROM t1")
+        journal = Journal(self.path)
+        self.assertTrue(journal.load())
+        self.assertNotEqual(journal.state['catalog_checksum'], None)
+        self.db.execute_commit("CREATE TABLE t3 (c1 integer)")
+        self.assertNotEqual(journal.verify(self.db.dbconnection(), 'spec'),
+                            None)
+        self.db.execute_commit("DROP TABLE t3")
+        self.assertEqual(journal.verify(self.db.dbconnection(), 'spec'),
+                         None)
+        report = self.execute(journal, journal.statements)
+        self.assertEqual([entry['statement'] for entry in report],
+                         self.stmts[1:])
+        self.assertFalse(Journal(self.path).load())
+
+    def test_type_changes(self):
+        "Restore the column type classifications made with the plan"
+        journal = Journal(self.path)
+        journal.begin(self.stmts, 'spec', [
+                ('t1', 'c1', 'integer', 'bigint', 'table rewrite')])
+        journal = Journal(self.path)
+        self.assertTrue(journal.load())
+        self.assertEqual(journal.type_changes, [
+                ('t1', 'c1', 'integer', 'bigint', 'table rewrite')])
+
+    def test_refuse_changed_spec(self):
+        "Refuse to resume if the input specification has changed"
+        self.fail_first_run()
+        journal = Journal(self.path)
+        journal.load()
+        self.assertNotEqual(journal.verify(self.db.dbconnection(), 'other'),
+                            None)
+
+
+def suite():
+    tests = unittest.TestLoader().loadTestsFromTestCase(ExecutorTestCase)
+    tests.addTest(unittest.TestLoader().loadTestsFromTestCase(
+            WatchdogTestCase))
+    tests.addTest(unittest.TestLoader().loadTestsFromTestCase(
+            ParallelExecutorTestCase))
+    tests.addTest(unittest.TestLoader().loadTestsFromTestCase(
+            JournalTestCase))
+    return tests
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
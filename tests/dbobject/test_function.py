@@ -350,6 +350,53 @@ class AggregateToSqlTestCase(PyrseasTestCase):
                          "INITCOND = '-1')")
 
 
+class HashedFunctionTestCase(PyrseasTestCase):
+    """Test comparing functions fetched as hashes of their sources"""
+
+    def hashed(self):
+        db = self.db.database()
+        db.dbconn.hash_definitions = True
+        return db
+
+    def inmap(self, source):
+        inmap = new_std_map()
+        inmap['schema public'].update({'function f1()': {
+                    'language': 'sql', 'returns': 'text', 'source': source,
+                    'volatility': 'immutable'}})
+        return inmap
+
+    def test_unchanged_function(self):
+        "Use the input source of a function whose hash matches"
+        self.db.execute(DROP_STMT1)
+        self.db.execute_commit(CREATE_STMT1)
+        db = self.hashed()
+        self.assertEqual(db.diff_map(self.inmap(SOURCE1)), [])
+        func = db.db.functions[('public', 'f1', '')]
+        self.assertEqual(func.source, SOURCE1)
+        self.assertFalse(hasattr(func, 'source_md5'))
+
+    def test_changed_function(self):
+        "Fetch the source of a function whose hash differs"
+        self.db.execute(DROP_STMT1)
+        self.db.execute_commit(CREATE_STMT1)
+        db = self.hashed()
+        dbsql = db.diff_map(self.inmap("SELECT 'example'::text"))
+        self.assertEqual(fix_indent(dbsql[1]), "CREATE OR REPLACE "
+                         "FUNCTION f1() RETURNS text LANGUAGE sql IMMUTABLE "
+                         "AS $_$SELECT 'example'::text$_$")
+        self.assertEqual(db.db.functions[('public', 'f1', '')].source,
+                         SOURCE1)
+        self.assertEqual(db.db.functions.hashed, {})
+
+    def test_map_hashed_function(self):
+        "Fetch the sources of functions being mapped"
+        self.db.execute(DROP_STMT1)
+        self.db.execute_commit(CREATE_STMT1)
+        dbmap = self.hashed().to_map()
+        self.assertEqual(dbmap['schema public']['function f1()']['source'],
+                         SOURCE1)
+
+
 def suite():
     tests = unittest.TestLoader().loadTestsFromTestCase(FunctionToMapTestCase)
     tests.addTest(unittest.TestLoader().loadTestsFromTestCase(
@@ -358,6 +405,8 @@ def suite():
             AggregateToMapTestCase))
     tests.addTest(unittest.TestLoader().loadTestsFromTestCase(
             AggregateToSqlTestCase))
+    tests.addTest(unittest.TestLoader().loadTestsFromTestCase(
+            HashedFunctionTestCase))
     return tests
 
 if __name__ == '__main__':
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""Test quoting and parsing identifiers"""
+
+import unittest
+
+from pyrseas.identifier import quote_id, quote_qualname, split_qualname
+from pyrseas.identifier import keywords, LRUMemo
+
+
+class QuoteIdTestCase(unittest.TestCase):
+    """Test quoting identifiers"""
+
+    def test_regular(self):
+        "Leave a regular identifier unquoted"
+        self.assertEqual(quote_id('order_line_2$'), 'order_line_2$')
+
+    def test_irregular(self):
+        "Quote mixed case identifiers and those with other characters"
+        self.assertEqual(quote_id('Mixed'), '"Mixed"')
+        self.assertEqual(quote_id('1st'), '"1st"')
+        self.assertEqual(quote_id('with space'), '"with space"')
+
+    def test_keyword(self):
+        "Quote a reserved keyword"
+        self.assertEqual(quote_id('user'), '"user"')
+        self.assertEqual(quote_id('name'), 'name')
+
+    def test_keyword_version(self):
+        "Quote a keyword only for the versions where it is reserved"
+        self.assertEqual(quote_id('lateral', 90200), 'lateral')
+        self.assertEqual(quote_id('lateral', 90300), '"lateral"')
+        self.assertTrue('lateral' in keywords())
+        self.assertFalse('lateral' in keywords(90200))
+
+    def test_embedded_quote(self):
+        "Double the quotes embedded in an identifier"
+        self.assertEqual(quote_id('a"b'), '"a""b"')
+
+    def test_qualname(self):
+        "Quote a schema-qualified name, omitting the public schema"
+        self.assertEqual(quote_qualname('public', 't1'), 't1')
+        self.assertEqual(quote_qualname('My Schema', 'order'),
+                         '"My Schema"."order"')
+
+
+class SplitQualnameTestCase(unittest.TestCase):
+    """Test parsing qualified names"""
+
+    def test_unqualified(self):
+        "Assume the public schema for an unqualified name"
+        self.assertEqual(split_qualname('t1'), ('public', 't1'))
+        self.assertEqual(split_qualname('t1', 's1'), ('s1', 't1'))
+
+    def test_qualified(self):
+        "Split a schema-qualified name"
+        self.assertEqual(split_qualname('s1.t1'), ('s1', 't1'))
+
+    def test_quoted(self):
+        "Unquote parts that may contain dots and quotes"
+        self.assertEqual(split_qualname('"My Schema"."a.b"'),
+                         ('My Schema', 'a.b'))
+        self.assertEqual(split_qualname('"a""b"'), ('public', 'a"b'))
+
+    def test_roundtrip(self):
+        "Parse the names produced by quote_qualname"
+        for (sch, name) in [('s1', 't1'), ('My Schema', 'a.b'),
+                            ('user', 'x"y')]:
+            self.assertEqual(split_qualname(quote_qualname(sch, name)),
+                             (sch, name))
+
+    def test_memo(self):
+        "Keep the most recently used results only"
+        calls = []
+
+        def func(arg):
+            calls.append(arg)
+            return arg * 2
+        memo = LRUMemo(func, 2)
+        self.assertEqual(memo(1), 2)
+        memo(2)
+        memo(1)
+        memo(3)
+        self.assertEqual((memo.hits, memo.misses), (1, 3))
+        memo(1)
+        memo(2)
+        self.assertEqual(calls, [1, 2, 3, 2])
+        memo.clear()
+        self.assertEqual((memo.hits, memo.misses, memo.cache), (0, 0, {}))
+
+
+def suite():
+    tests = unittest.TestLoader().loadTestsFromTestCase(QuoteIdTestCase)
+    tests.addTest(unittest.TestLoader().loadTestsFromTestCase(
+            SplitQualnameTestCase))
+    return tests
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Test exporting the metrics of mapping and diffing a database"""
+
+import json
+import unittest
+from StringIO import StringIO
+
+from pyrseas.metrics import Metrics
+from pyrseas.profiler import Profiler
+from utils import PyrseasTestCase, new_std_map
+
+CREATE_STMT = "CREATE TABLE t1 (c1 integer PRIMARY KEY, c2 text)"
+
+
+class MetricsTestCase(PyrseasTestCase):
+    """Test collecting and writing counters and timings"""
+
+    def collect(self):
+        db = self.db.database()
+        db.dbconn.profiler = Profiler()
+        db.to_map()
+        metrics = Metrics('dbtoyaml', self.db.name)
+        metrics.from_profiler(db.dbconn.profiler)
+        metrics.objects(db.db)
+        return metrics
+
+    def value(self, metrics, name, **labels):
+        return metrics.values[(name, tuple(sorted(labels.items())))]
+
+    def test_object_counts(self):
+        "Count the objects of each type and time the catalog queries"
+        self.db.execute_commit(CREATE_STMT)
+        metrics = self.collect()
+        self.assertEqual(self.value(metrics, 'objects', type='Table'), 1)
+        self.assertEqual(self.value(metrics, 'objects', type='Column'), 2)
+        self.assertEqual(self.value(metrics, 'objects', type='PrimaryKey'),
+                         1)
+        self.assertEqual(self.value(metrics, 'catalog_query_rows',
+                                    dict='ColumnDict'), 2)
+        self.assertTrue(self.value(metrics, 'catalog_query_seconds',
+                                   dict='ClassDict') >= 0)
+        self.assertTrue(self.value(metrics, 'phase_seconds',
+                                   phase='to_map') >= 0)
+
+    def test_statement_counts(self):
+        "Count the statements of each kind"
+        self.db.execute_commit(CREATE_STMT)
+        inmap = new_std_map()
+        inmap['schema public'].update({'table t1': {
+                    'columns': [{'c1': {'type': 'integer',
+                                        'not_null': True}},
+                                {'c2': {'type': 'text'}},
+                                {'c3': {'type': 'date'}}],
+                    'primary_key': {'t1_pkey': {
+                            'columns': ['c1'], 'access_method': 'btree'}},
+                    'indexes': {'t1_idx': {'columns': ['c3'],
+                                           'access_method': 'btree'}}}})
+        metrics = Metrics('yamltodb', self.db.name)
+        metrics.statements(self.db.process_map(inmap))
+        self.assertEqual(self.value(metrics, 'statements',
+                                    kind='ALTER TABLE'), 1)
+        self.assertEqual(self.value(metrics, 'statements',
+                                    kind='CREATE INDEX'), 1)
+
+    def test_write_formats(self):
+        "Write the metrics as JSON and in Prometheus text format"
+        self.db.execute_commit(CREATE_STMT)
+        metrics = self.collect()
+        metrics.add('yaml_bytes', 100)
+        output = StringIO()
+        metrics.write(output)
+        stats = json.loads(output.getvalue())
+        self.assertEqual(stats['labels'], {'program': 'dbtoyaml',
+                                           'database': self.db.name})
+        self.assertTrue({'name': 'yaml_bytes', 'labels': {},
+                         'value': 100} in stats['metrics'])
+        output = StringIO()
+        metrics.write(output, 'prometheus')
+        lines = output.getvalue().splitlines()
+        self.assertTrue("# TYPE pyrseas_yaml_bytes gauge" in lines)
+        self.assertTrue('pyrseas_yaml_bytes{database="%s",program='
+                        '"dbtoyaml"} 100' % self.db.name in lines)
+        self.assertTrue('pyrseas_objects{database="%s",program="dbtoyaml",'
+                        'type="Table"} 1' % self.db.name in lines)
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(MetricsTestCase)
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
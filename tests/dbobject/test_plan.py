@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""Test the analysis of plans"""
+
+import unittest
+
+from pyrseas.dbobject.column import NO_REWRITE, INDEX_REBUILD, backfill
+from pyrseas.plan import analyze_statement, analyze_plan
+from pyrseas.plan import statement_dependencies, merge_alter_table
+
+ADD_FKEY = "ALTER TABLE t1 ADD CONSTRAINT t1_c2_fkey FOREIGN KEY (c2) " \
+    "REFERENCES t2 (c1)"
+
+
+class AnalyzeStatementTestCase(unittest.TestCase):
+    """Test the analysis of single statements"""
+
+    def lock(self, stmt, dbversion=0):
+        return analyze_statement(stmt, dbversion=dbversion)['lock']
+
+    def flags(self, stmt, dbversion=0, type_changes=None, checked=None):
+        info = analyze_statement(stmt, 'public', dbversion, type_changes,
+                                 checked)
+        return [flag for flag in ['rewrite', 'scan', 'index_build']
+                if info[flag]]
+
+    def test_lock_levels(self):
+        "Determine the strongest lock taken by a statement"
+        self.assertEqual(self.lock("ALTER TABLE t1 ADD COLUMN c3 integer"),
+                         'ACCESS EXCLUSIVE')
+        self.assertEqual(self.lock(ADD_FKEY), 'SHARE ROW EXCLUSIVE')
+        self.assertEqual(self.lock("CREATE INDEX t1_idx ON t1 (c1)"),
+                         'SHARE')
+        self.assertEqual(self.lock("ALTER TABLE t1 VALIDATE CONSTRAINT "
+                                   "t1_c1_check"), 'SHARE UPDATE EXCLUSIVE')
+        self.assertEqual(self.lock(backfill('t1', 'c3 = c1', 'c1')),
+                         'ROW EXCLUSIVE')
+        self.assertEqual(self.lock("CREATE TRIGGER tr1 AFTER INSERT ON t1 "
+                                   "FOR EACH ROW EXECUTE PROCEDURE f1()"),
+                         'SHARE ROW EXCLUSIVE')
+        self.assertEqual(self.lock("DROP TRIGGER tr1 ON t1"),
+                         'ACCESS EXCLUSIVE')
+        self.assertEqual(self.lock("DROP TABLE t1"), 'ACCESS EXCLUSIVE')
+
+    def test_no_lock(self):
+        "Take no lock on existing tables to create or comment on one"
+        self.assertEqual(self.lock("CREATE TABLE t3 (c1 integer)"), None)
+        self.assertEqual(self.lock("COMMENT ON TABLE t1 IS 'Test'"), None)
+        info = analyze_statement("CREATE SCHEMA s1")
+        self.assertEqual((info['tables'], info['lock']), ([], None))
+
+    def test_foreign_key_tables(self):
+        "Include the referenced table"
+        self.assertEqual(analyze_statement(ADD_FKEY)['tables'],
+                         ['t1', 't2'])
+
+    def test_type_change(self):
+        "Rewrite a table unless the type change was classified otherwise"
+        stmt = "ALTER TABLE t1 ALTER COLUMN c2 TYPE bigint"
+        self.assertEqual(self.flags(stmt), ['rewrite'])
+        self.assertEqual(self.flags(stmt, type_changes={
+                    ('t1', 'c2'): NO_REWRITE}), [])
+        self.assertEqual(self.flags(stmt, type_changes={
+                    ('t1', 'c2'): INDEX_REBUILD}), ['index_build'])
+
+    def test_add_column_default(self):
+        "Rewrite a table for a default before 11 or a volatile default"
+        stmt = "ALTER TABLE t1 ADD COLUMN c3 integer DEFAULT 0"
+        self.assertEqual(self.flags(stmt, 100000), ['rewrite'])
+        self.assertEqual(self.flags(stmt, 110000), [])
+        self.assertEqual(self.flags(
+                "ALTER TABLE t1 ADD COLUMN c3 integer DEFAULT "
+                "nextval('s1')", 110000), ['rewrite'])
+
+    def test_backfill(self):
+        "Count a batched backfill as a rewrite"
+        self.assertEqual(self.flags(backfill(
+                    't1', 'c3 = c1', 'c1', 'c3 IS NULL')), ['rewrite'])
+
+    def test_scan(self):
+        "Scan a table to validate a constraint"
+        self.assertEqual(self.flags("ALTER TABLE t1 ADD CONSTRAINT "
+                                    "t1_c1_check CHECK (c1 > 0)"), ['scan'])
+        self.assertEqual(self.flags("ALTER TABLE t1 ADD CONSTRAINT "
+                                    "t1_c1_check CHECK (c1 > 0) NOT VALID"),
+                         [])
+        self.assertEqual(self.flags(ADD_FKEY), ['scan'])
+        self.assertEqual(self.flags("ALTER TABLE t1 VALIDATE CONSTRAINT "
+                                    "t1_c1_check"), ['scan'])
+
+    def test_set_not_null(self):
+        "Skip the scan for SET NOT NULL after a validated CHECK on 12"
+        stmt = "ALTER TABLE t1 ALTER COLUMN c1 SET NOT NULL"
+        checked = set([('t1', 'c1')])
+        self.assertEqual(self.flags(stmt, 120000), ['scan'])
+        self.assertEqual(self.flags(stmt, 110000, checked=checked),
+                         ['scan'])
+        self.assertEqual(self.flags(stmt, 120000, checked=checked), [])
+
+    def test_index_build(self):
+        "Build an index, unless attaching an existing one"
+        self.assertEqual(self.flags("CREATE UNIQUE INDEX t1_idx ON t1 "
+                                    "(c1)"), ['index_build'])
+        self.assertEqual(self.flags("ALTER TABLE t1 ADD CONSTRAINT t1_pkey "
+                                    "PRIMARY KEY (c1)"), ['index_build'])
+        self.assertEqual(self.flags("ALTER TABLE t1 ADD CONSTRAINT t1_pkey "
+                                    "PRIMARY KEY USING INDEX t1_idx"), [])
+
+    def test_non_transactional(self):
+        "Detect the statements that cannot run in a transaction block"
+        info = analyze_statement("CREATE INDEX CONCURRENTLY t1_idx ON t1 "
+                                 "(c1)")
+        self.assertEqual((info['lock'], info['transactional']),
+                         ('SHARE UPDATE EXCLUSIVE', False))
+        info = analyze_statement("DROP INDEX CONCURRENTLY t1_idx")
+        self.assertEqual((info['tables'], info['transactional']),
+                         (['t1_idx'], False))
+        stmt = "ALTER TYPE mood ADD VALUE 'ok'"
+        self.assertFalse(analyze_statement(stmt, dbversion=110000)[
+                'transactional'])
+        self.assertTrue(analyze_statement(stmt, dbversion=120000)[
+                'transactional'])
+        self.assertTrue(analyze_statement("CREATE INDEX t1_idx ON t1 (c1)")[
+                'transactional'])
+
+    def test_qualify(self):
+        "Qualify unqualified names by the first schema in the search_path"
+        self.assertEqual(analyze_statement(ADD_FKEY, 's1')['tables'],
+                         ['s1.t1', 's1.t2'])
+        self.assertEqual(analyze_statement(
+                "CREATE INDEX t1_idx ON s2.t1 (c1)", 's1')['tables'],
+                         ['s2.t1'])
+        self.assertEqual(analyze_statement(
+                "DROP TABLE public.t1", 's1')['tables'], ['t1'])
+        self.assertEqual(analyze_statement(
+                'COMMENT ON COLUMN "My Table".c1 IS \'Test\'', 's1')[
+                'tables'], ['s1."My Table"'])
+
+    def test_non_string(self):
+        "Report nothing for a statement that is not a string"
+        info = analyze_statement(None)
+        self.assertEqual((info['tables'], info['lock'],
+                          info['transactional']), ([], None, True))
+
+
+class AnalyzePlanTestCase(unittest.TestCase):
+    """Test the analysis of plans"""
+
+    def test_search_path(self):
+        "Follow SET search_path statements"
+        infos = analyze_plan(["SET search_path TO s1, pg_catalog",
+                              "CREATE INDEX t1_idx ON t1 (c1)",
+                              "SET search_path TO public, pg_catalog",
+                              "CREATE INDEX t2_idx ON t2 (c1)"])
+        self.assertEqual([info['tables'] for info in infos],
+                         [[], ['s1.t1'], [], ['t2']])
+
+    def test_not_null_check(self):
+        "Follow the validation of a NOT NULL helper CHECK constraint"
+        stmts = ["ALTER TABLE t1 ADD CONSTRAINT t1_c1_nn CHECK "
+                 "(c1 IS NOT NULL) NOT VALID",
+                 "ALTER TABLE t1 VALIDATE CONSTRAINT t1_c1_nn",
+                 "ALTER TABLE t1 ALTER COLUMN c1 SET NOT NULL"]
+        self.assertFalse(analyze_plan(stmts, 120000)[2]['scan'])
+        self.assertTrue(analyze_plan(stmts, 110000)[2]['scan'])
+        self.assertTrue(analyze_plan(stmts[:1] + stmts[2:], 120000)[1][
+                'scan'])
+
+    def test_type_changes(self):
+        "Use the column type classifications saved by diff_map"
+        stmts = ["ALTER TABLE t1 ALTER COLUMN c1 TYPE varchar(32)"]
+        info = analyze_plan(stmts, 0, [('t1', 'c1', 'varchar(16)',
+                                        'varchar(32)', NO_REWRITE)])[0]
+        self.assertFalse(info['rewrite'])
+        self.assertTrue(analyze_plan(stmts)[0]['rewrite'])
+
+
+class StatementDependenciesTestCase(unittest.TestCase):
+    """Test determining the dependencies between statements"""
+
+    def deps(self, stmts):
+        return statement_dependencies(stmts, analyze_plan(stmts))
+
+    def test_barrier(self):
+        "Order everything around statements that affect no table"
+        self.assertEqual(self.deps(
+                ["CREATE SCHEMA s1", "CREATE TABLE s1.t1 (c1 integer)",
+                 "CREATE TABLE s1.t2 (c1 integer)",
+                 "SET search_path TO s1, pg_catalog",
+                 "CREATE INDEX t1_idx ON t1 (c1)",
+                 "CREATE INDEX t2_idx ON t2 (c1)"]),
+                         [set(), set([0]), set([0]), set([0, 1, 2]),
+                          set([3]), set([3])])
+
+    def test_view(self):
+        "Create a view after its base tables, and comment on it after"
+        self.assertEqual(self.deps(
+                ["CREATE TABLE t1 (c1 integer)",
+                 "CREATE TABLE t2 (c1 integer)",
+                 "CREATE TABLE t3 (c1 integer)",
+                 "CREATE VIEW v1 AS SELECT t1.c1 FROM t1 JOIN t2 USING (c1)",
+                 "COMMENT ON VIEW v1 IS 'Test view'",
+                 "DROP TABLE t3"]),
+                         [set(), set(), set(), set([0, 1]), set([3]),
+                          set([2])])
+
+    def test_mentioned_later(self):
+        "Depend on an earlier statement mentioning the table affected"
+        self.assertEqual(self.deps(
+                ["CREATE VIEW v1 AS SELECT c1 FROM t1",
+                 "ALTER TABLE t1 ADD COLUMN c3 integer"]),
+                         [set(), set([0])])
+
+    def test_quoted(self):
+        "Compare quoted names exactly and unquoted names in lowercase"
+        self.assertEqual(self.deps(
+                ['CREATE TABLE "My Table" (c1 integer)',
+                 'CREATE INDEX "my table_idx" ON "My Table" (c1)',
+                 "CREATE TABLE my (c1 integer)",
+                 "CREATE INDEX my_idx ON MY (c1)",
+                 'CREATE INDEX t1_idx ON "t1" (c1)',
+                 "CREATE TABLE t1 (c1 integer)"]),
+                         [set(), set([0]), set(), set([2]), set(),
+                          set([4])])
+
+    def test_qualified(self):
+        "Compare the relation names without their schema"
+        self.assertEqual(self.deps(
+                ["CREATE TABLE s1.t1 (c1 integer)",
+                 "CREATE INDEX t1_idx ON s1.t1 (c1)",
+                 "CREATE TABLE s1.t2 (c1 integer)",
+                 "CREATE TABLE s2.t1 (c1 integer)"]),
+                         [set(), set([0]), set(), set([0, 1])])
+
+    def test_non_string(self):
+        "Treat an entry that is not a string as a barrier"
+        stmts = ["CREATE TABLE t1 (c1 integer)", None,
+                 "CREATE TABLE t2 (c1 integer)"]
+        infos = analyze_plan(stmts)
+        self.assertEqual(statement_dependencies(stmts, infos),
+                         [set(), set([0]), set([1])])
+        infos[1] = dict(infos[0])
+        self.assertEqual(statement_dependencies(stmts, infos),
+                         [set(), set([0]), set([1])])
+
+
+class MergeAlterTableTestCase(unittest.TestCase):
+    """Test combining ALTER TABLE statements"""
+
+    def test_merge(self):
+        "Combine the subcommands on the same table"
+        self.assertEqual(merge_alter_table(
+                ["ALTER TABLE t1 ADD COLUMN c3 integer",
+                 "ALTER TABLE public.t1 ALTER COLUMN c2 TYPE bigint"]),
+                         ["ALTER TABLE t1\n    ADD COLUMN c3 integer,\n"
+                          "    ALTER COLUMN c2 TYPE bigint"])
+
+    def test_search_path(self):
+        "Keep the table name as written after SET search_path"
+        stmts = ["SET search_path TO s1, pg_catalog",
+                 "ALTER TABLE public.t1 ADD COLUMN c3 integer",
+                 "ALTER TABLE public.t1 ADD COLUMN c4 integer",
+                 "ALTER TABLE t1 ADD COLUMN c5 integer"]
+        self.assertEqual(merge_alter_table(stmts), [
+                stmts[0], "ALTER TABLE public.t1\n    ADD COLUMN c3 "
+                "integer,\n    ADD COLUMN c4 integer", stmts[3]])
+
+
+def suite():
+    tests = unittest.TestLoader().loadTestsFromTestCase(
+        AnalyzeStatementTestCase)
+    tests.addTest(unittest.TestLoader().loadTestsFromTestCase(
+            AnalyzePlanTestCase))
+    tests.addTest(unittest.TestLoader().loadTestsFromTestCase(
+            StatementDependenciesTestCase))
+    tests.addTest(unittest.TestLoader().loadTestsFromTestCase(
+            MergeAlterTableTestCase))
+    return tests
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Test profiling the phases of mapping and diffing a database"""
+
+import unittest
+
+from pyrseas.profiler import Profiler
+from utils import PyrseasTestCase, new_std_map
+
+CREATE_STMT = "CREATE TABLE t1 (c1 integer PRIMARY KEY, c2 text)"
+
+
+class ProfilerTestCase(PyrseasTestCase):
+    """Test recording the cost of each phase"""
+
+    def profiled(self):
+        db = self.db.database()
+        db.dbconn.profiler = Profiler()
+        return db
+
+    def phase(self, profiler, name):
+        return [phase for phase in profiler.phases
+                if phase['phase'] == name][0]
+
+    def test_profile_to_map(self):
+        "Record the catalog queries and the conversion to a map"
+        self.db.execute_commit(CREATE_STMT)
+        db = self.profiled()
+        db.to_map()
+        profiler = db.dbconn.profiler
+        self.assertEqual([phase['phase'] for phase in profiler.phases
+                          if phase['depth'] == 0],
+                         ['from_catalog', 'to_map'])
+        classes = self.phase(profiler, 'ClassDict')
+        self.assertEqual(classes['depth'], 1)
+        self.assertEqual(classes['rows'], 1)
+        idx = profiler.phases.index(self.phase(profiler, 'ColumnDict'))
+        query = profiler.phases[idx + 1]
+        self.assertEqual((query['phase'], query['depth'], query['rows']),
+                         ('query', 2, 2))
+        for phase in profiler.phases:
+            self.assertTrue(phase['wall'] >= 0)
+            self.assertTrue(phase['maxrss_kb'] > 0)
+        self.assertEqual(len(profiler.report()), len(profiler.phases) + 1)
+
+    def test_profile_diff_map(self):
+        "Record the statements generated by diff_map"
+        self.db.execute_commit(CREATE_STMT)
+        inmap = new_std_map()
+        inmap['schema public'].update({'table t1': {
+                    'columns': [{'c1': {'type': 'integer',
+                                        'not_null': True}},
+                                {'c2': {'type': 'text'}},
+                                {'c3': {'type': 'date'}}],
+                    'primary_key': {'t1_pkey': {
+                            'columns': ['c1'], 'access_method': 'btree'}}}})
+        db = self.profiled()
+        stmts = db.diff_map(inmap)
+        profiler = db.dbconn.profiler
+        self.assertEqual([phase['phase'] for phase in profiler.phases
+                          if phase['depth'] == 0],
+                         ['from_catalog', 'from_map', 'diff_map'])
+        self.assertEqual(self.phase(profiler, 'diff_map')['rows'],
+                         len(stmts))
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(ProfilerTestCase)
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
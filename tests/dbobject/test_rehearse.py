@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""Test rehearsals of generated statements on a scratch database"""
+
+import unittest
+
+from pyrseas.executor import OK
+from pyrseas.rehearse import Rehearsal
+from utils import PyrseasTestCase, new_std_map, pgconnect, pgexecute
+from utils import ADMIN_DB
+
+CREATE_STMT = "CREATE TABLE t1 (c1 integer PRIMARY KEY, c2 text)"
+
+
+class RehearsalTestCase(PyrseasTestCase):
+    """Test applying statements to a scratch copy of a database"""
+
+    def rehearsal(self, **kwargs):
+        return Rehearsal(self.db.dbconnection(), maintenance_db=ADMIN_DB,
+                         **kwargs)
+
+    def scratch_exists(self, rehearsal):
+        conn = pgconnect(ADMIN_DB, self.db.user, self.db.host, self.db.port)
+        curs = pgexecute(conn, "SELECT 1 FROM pg_database WHERE datname = "
+                         "'%s'" % rehearsal.scratch)
+        row = curs.fetchone()
+        curs.close()
+        conn.close()
+        return row is not None
+
+    def test_rehearse_map(self):
+        "Apply the statements to a scratch database only"
+        self.db.execute_commit(CREATE_STMT)
+        inmap = new_std_map()
+        inmap['schema public'].update({'table t1': {
+                    'columns': [{'c1': {'type': 'integer',
+                                        'not_null': True}},
+                                {'c2': {'type': 'text'}},
+                                {'c3': {'type': 'date'}}],
+                    'primary_key': {'t1_pkey': {
+                            'columns': ['c1'], 'access_method': 'btree'}}}})
+        stmts = self.db.process_map(inmap)
+        rehearsal = self.rehearsal()
+        report = rehearsal.run(stmts)
+        self.assertEqual([entry['status'] for entry in report],
+                         [OK] * len(stmts))
+        self.assertTrue(['t1', 'AccessExclusiveLock'] in report[0]['locks'])
+        self.assertEqual(self.db.process_map(inmap), stmts)
+        self.assertFalse(self.scratch_exists(rehearsal))
+        lines = rehearsal.report()
+        self.assertTrue(lines[-1].endswith(", ok"))
+
+    def test_rehearse_sample(self):
+        "Copy a sample of the rows before applying the statements"
+        self.db.execute_commit(CREATE_STMT)
+        self.db.execute_commit("INSERT INTO t1 SELECT i, 'a' "
+                               "FROM generate_series(1, 1000) i")
+        rehearsal = self.rehearsal(sample=100)
+        report = rehearsal.run(["UPDATE t1 SET c2 = 'b'"])
+        self.assertEqual(report[0]['rows'], 1000)
+        self.assertFalse(self.scratch_exists(rehearsal))
+
+    def test_quoted_scratch(self):
+        "Quote a scratch database name that is not a regular identifier"
+        self.db.execute_commit(CREATE_STMT)
+        rehearsal = self.rehearsal(scratch='Pyrseas-Rehearsal')
+        report = rehearsal.run(["ALTER TABLE t1 ADD COLUMN c3 date"])
+        self.assertEqual(report[0]['status'], OK)
+        self.assertFalse(self.scratch_exists(rehearsal))
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(RehearsalTestCase)
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -3,7 +3,9 @@
 
 import unittest
 
-from utils import PyrseasTestCase, fix_indent, new_std_map
+from pyrseas.executor import Executor, OK
+from pyrseas.plan import analyze_plan
+from utils import PyrseasTestCase, fix_indent, new_std_map, pgexecute
 
 
 TYPELIST = [
@@ -274,9 +276,8 @@ class TableToSqlTestCase(PyrseasTestCase):
                                         'default': 'now()'}}]}})
         dbsql = self.db.process_map(inmap)
         self.assertEqual(fix_indent(dbsql[0]),
-                "ALTER TABLE t1 ADD COLUMN c3 smallint NOT NULL")
-        self.assertEqual(fix_indent(dbsql[1]),
-                "ALTER TABLE t1 ADD COLUMN c4 date DEFAULT now()")
+                "ALTER TABLE t1 ADD COLUMN c3 smallint NOT NULL, "
+                "ADD COLUMN c4 date DEFAULT now()")
 
     def test_set_column_not_null(self):
         "Change a nullable column to NOT NULL"
@@ -290,6 +291,24 @@ class TableToSqlTestCase(PyrseasTestCase):
         self.assertEqual(fix_indent(dbsql[0]),
                          "ALTER TABLE t1 ALTER COLUMN c1 SET NOT NULL")
 
+    def test_set_column_not_null_online(self):
+        "Change a nullable column to NOT NULL using a validated CHECK"
+        if self.db.version < 120000:
+            self.skipTest('Only available on PG 12')
+        self.db.execute(DROP_STMT)
+        self.db.execute_commit(CREATE_STMT)
+        inmap = new_std_map()
+        inmap['schema public'].update({'table t1': {
+                'columns': [{'c1': {'type': 'integer', 'not_null': True}},
+                            {'c2': {'type': 'text'}}]}})
+        dbsql = self.db.process_map(inmap, online=True)
+        self.assertEqual(dbsql, [
+                "ALTER TABLE t1 ADD CONSTRAINT t1_c1_nn_check "
+                "CHECK (c1 IS NOT NULL) NOT VALID",
+                "ALTER TABLE t1 VALIDATE CONSTRAINT t1_c1_nn_check",
+                "ALTER TABLE t1 ALTER COLUMN c1 SET NOT NULL",
+                "ALTER TABLE t1 DROP CONSTRAINT t1_c1_nn_check"])
+
     def test_change_column_types(self):
         "Change the datatypes of two columns"
         self.db.execute(DROP_STMT)
@@ -300,9 +319,23 @@ class TableToSqlTestCase(PyrseasTestCase):
                                 {'c2': {'type': 'varchar(25)'}}]}})
         dbsql = self.db.process_map(inmap)
         self.assertEqual(fix_indent(dbsql[0]),
-                         "ALTER TABLE t1 ALTER COLUMN c1 TYPE bigint")
-        self.assertEqual(fix_indent(dbsql[1]),
-                         "ALTER TABLE t1 ALTER COLUMN c2 TYPE varchar(25)")
+                         "ALTER TABLE t1 ALTER COLUMN c1 TYPE bigint, "
+                         "ALTER COLUMN c2 TYPE varchar(25)")
+
+    def test_alter_and_drop_columns(self):
+        "Change a column type and drop another one in a single statement"
+        self.db.execute(DROP_STMT)
+        self.db.execute_commit("CREATE TABLE t1 (c1 INTEGER, c2 TEXT, "
+                               "c3 SMALLINT)")
+        inmap = new_std_map()
+        inmap['schema public'].update({'table t1': {
+                    'columns': [{'c1': {'type': 'bigint'}},
+                                {'c2': {'type': 'text'}}]}})
+        dbsql = self.db.process_map(inmap)
+        self.assertEqual(len(dbsql), 1)
+        self.assertEqual(fix_indent(dbsql[0]),
+                         "ALTER TABLE t1 ALTER COLUMN c1 TYPE bigint, "
+                         "DROP COLUMN c3")
 
     def test_drop_column(self):
         "Drop a column from a table"
@@ -426,6 +459,182 @@ class TableInheritToSqlTestCase(PyrseasTestCase):
                                  "DROP TABLE t1"])
 
 
+class ColumnTypeChangeTestCase(PyrseasTestCase):
+    """Test classification of column data type changes"""
+
+    def test_same_type_other_spelling(self):
+        "Do not change a column type spelled differently in the input"
+        self.db.execute(DROP_STMT)
+        self.db.execute_commit("CREATE TABLE t1 (c1 int4, c2 varchar(16))")
+        inmap = new_std_map()
+        inmap['schema public'].update({'table t1': {
+                    'columns': [{'c1': {'type': 'int'}},
+                                {'c2': {'type': 'varchar(16)'}}]}})
+        dbsql = self.db.process_map(inmap)
+        self.assertEqual(dbsql, [])
+
+    def test_relax_varchar(self):
+        "Increase the length of a varchar column without a table rewrite"
+        if self.db.version < 90200:
+            self.skipTest('Only available on PG 9.2')
+        self.db.execute(DROP_STMT)
+        self.db.execute_commit("CREATE TABLE t1 (c1 integer, "
+                               "c2 varchar(16), c3 varchar(16))")
+        inmap = new_std_map()
+        inmap['schema public'].update({'table t1': {
+                    'columns': [{'c1': {'type': 'bigint'}},
+                                {'c2': {'type': 'varchar(32)'}},
+                                {'c3': {'type': 'text'}}]}})
+        db = self.db.database()
+        dbsql = db.diff_map(inmap)
+        self.assertEqual(fix_indent(dbsql[0]),
+                         "ALTER TABLE t1 ALTER COLUMN c1 TYPE bigint, "
+                         "ALTER COLUMN c2 TYPE varchar(32), "
+                         "ALTER COLUMN c3 TYPE text")
+        self.assertEqual(sorted(db.type_changes), [
+                ('t1', 'c1', 'integer', 'bigint', 'table rewrite'),
+                ('t1', 'c2', 'character varying(16)', 'varchar(32)',
+                 'no rewrite'),
+                ('t1', 'c3', 'character varying(16)', 'text',
+                 'no rewrite')])
+
+    def test_shrink_varchar(self):
+        "Decreasing the length of a varchar column rewrites the table"
+        self.db.execute(DROP_STMT)
+        self.db.execute_commit("CREATE TABLE t1 (c1 varchar(16))")
+        inmap = new_std_map()
+        inmap['schema public'].update({'table t1': {
+                    'columns': [{'c1': {'type': 'varchar(8)'}}]}})
+        db = self.db.database()
+        db.diff_map(inmap)
+        self.assertEqual(db.type_changes, [
+                ('t1', 'c1', 'character varying(16)', 'varchar(8)',
+                 'table rewrite')])
+
+    def pkey_bigint_map(self):
+        inmap = new_std_map()
+        inmap['schema public'].update({'table t1': {
+                    'columns': [{'c1': {'type': 'bigint', 'not_null': True}},
+                                {'c2': {'type': 'text'}}],
+                    'primary_key': {'t1_pkey': {
+                            'columns': ['c1'], 'access_method': 'btree'}}}})
+        return inmap
+
+    def test_change_type_online(self):
+        "Change a primary key type through a shadow column"
+        if self.db.version < 120000:
+            self.skipTest('Only available on PG 12')
+        self.db.execute(DROP_STMT)
+        self.db.execute_commit("CREATE TABLE t1 (c1 integer PRIMARY KEY, "
+                               "c2 text)")
+        dbsql = self.db.process_map(self.pkey_bigint_map(), online=True)
+        self.assertEqual(dbsql[0], "ALTER TABLE t1 ADD COLUMN c1_new bigint")
+        self.assertEqual(dbsql[3], "UPDATE t1 SET c1_new = c1 WHERE c1_new "
+                         "IS NULL AND c1 IS NOT NULL /* batched by c1 */")
+        self.assertEqual(dbsql[6], "CREATE UNIQUE INDEX CONCURRENTLY "
+                         "t1_pkey_new ON t1 (c1_new)")
+        self.assertTrue(dbsql[7].startswith("DO $_$"))
+        self.assertTrue("ADD CONSTRAINT t1_pkey PRIMARY KEY USING INDEX "
+                        "t1_pkey_new" in dbsql[7])
+        self.assertEqual(dbsql[8], "DROP FUNCTION t1_c1_sync()")
+        info = analyze_plan(dbsql, self.db.version)[7]
+        self.assertEqual((info['tables'], info['lock'], info['scan']),
+                         (['t1'], 'ACCESS EXCLUSIVE', False))
+
+    def test_apply_change_type_online(self):
+        "Apply a primary key type change through a shadow column"
+        if self.db.version < 120000:
+            self.skipTest('Only available on PG 12')
+        self.db.execute(DROP_STMT)
+        self.db.execute("CREATE TABLE t1 (c1 integer PRIMARY KEY, c2 text)")
+        self.db.execute_commit("INSERT INTO t1 SELECT i, 'row ' || i "
+                               "FROM generate_series(1, 250) i")
+        db = self.db.database()
+        stmts = db.diff_map(self.pkey_bigint_map(), True)
+        executor = Executor(self.db.dbconnection(), batch_size=100)
+        executor.execute(stmts, db.type_changes)
+        self.assertEqual(executor.status(), OK)
+        dbmap = self.db.database().to_map()
+        self.assertEqual(dbmap['schema public']['table t1']['columns'], [
+                {'c2': {'type': 'text'}},
+                {'c1': {'type': 'bigint', 'not_null': True}}])
+        self.assertEqual(dbmap['schema public']['table t1']['primary_key'],
+                         {'t1_pkey': {'columns': ['c1'],
+                                      'access_method': 'btree'}})
+        curs = pgexecute(self.db.conn, "SELECT count(*), sum(c1), "
+                         "count(NULLIF(c2, 'row ' || c1)) FROM t1")
+        self.assertEqual(list(curs.fetchone()), [250, 31375, 0])
+        curs.close()
+
+    def test_change_type_online_not_null_pre_12(self):
+        "Change a NOT NULL column type in place before PG 12"
+        if self.db.version < 90200 or self.db.version >= 120000:
+            self.skipTest('Only applicable on PG 9.2 to 11')
+        self.db.execute(DROP_STMT)
+        self.db.execute_commit("CREATE TABLE t1 (c1 integer PRIMARY KEY, "
+                               "c2 text)")
+        dbsql = self.db.process_map(self.pkey_bigint_map(), online=True)
+        self.assertEqual(fix_indent(dbsql[0]),
+                         "ALTER TABLE t1 ALTER COLUMN c1 TYPE bigint")
+
+    def test_add_column_volatile_default_online(self):
+        "Add a column with a volatile default and backfill it in batches"
+        if self.db.version < 120000:
+            self.skipTest('Only available on PG 12')
+        self.db.execute(DROP_STMT)
+        self.db.execute_commit("CREATE TABLE t1 (c1 integer PRIMARY KEY)")
+        inmap = new_std_map()
+        inmap['schema public'].update({'table t1': {
+                    'columns': [{'c1': {'type': 'integer', 'not_null': True}},
+                                {'c2': {'type': 'double precision',
+                                        'not_null': True,
+                                        'default': 'random()'}}],
+                    'primary_key': {'t1_pkey': {
+                            'columns': ['c1'], 'access_method': 'btree'}}}})
+        dbsql = self.db.process_map(inmap, online=True)
+        self.assertEqual(fix_indent(dbsql[0]),
+                         "ALTER TABLE t1 ADD COLUMN c2 double precision, "
+                         "ALTER COLUMN c2 SET DEFAULT random()")
+        self.assertEqual(dbsql[1], "UPDATE t1 SET c2 = DEFAULT WHERE c2 IS "
+                         "NULL /* batched by c1 */")
+        self.assertEqual(dbsql[4], "ALTER TABLE t1 ALTER COLUMN c2 SET "
+                         "NOT NULL")
+
+    def test_change_type_online_without_key(self):
+        "Change a column type in place if there is no integer primary key"
+        self.db.execute(DROP_STMT)
+        self.db.execute_commit("CREATE TABLE t1 (c1 integer, c2 text)")
+        inmap = new_std_map()
+        inmap['schema public'].update({'table t1': {
+                    'columns': [{'c1': {'type': 'bigint'}},
+                                {'c2': {'type': 'text'}}]}})
+        dbsql = self.db.process_map(inmap, online=True)
+        self.assertEqual(fix_indent(dbsql[0]),
+                         "ALTER TABLE t1 ALTER COLUMN c1 TYPE bigint")
+
+    def test_change_type_online_dependent_view(self):
+        "Change a column type in place if a view depends on the column"
+        if self.db.version < 90200:
+            self.skipTest('Only available on PG 9.2 and later')
+        self.db.execute(DROP_STMT)
+        self.db.execute("CREATE TABLE t1 (c1 integer PRIMARY KEY, "
+                        "c2 integer)")
+        self.db.execute_commit("CREATE VIEW v1 AS SELECT c2 FROM t1")
+        inmap = new_std_map()
+        inmap['schema public'].update({'table t1': {
+                    'columns': [{'c1': {'type': 'integer', 'not_null': True}},
+                                {'c2': {'type': 'bigint'}}],
+                    'primary_key': {'t1_pkey': {
+                            'columns': ['c1'], 'access_method': 'btree'}}},
+                                       'view v1': {
+                    'definition': " SELECT t1.c2 FROM t1;"}})
+        dbsql = [fix_indent(stmt) for stmt in self.db.process_map(
+                inmap, online=True)]
+        self.assertTrue("ALTER TABLE t1 ALTER COLUMN c2 TYPE bigint"
+                        in dbsql)
+        self.assertFalse([stmt for stmt in dbsql if 'c2_new' in stmt])
+
+
 def suite():
     tests = unittest.TestLoader().loadTestsFromTestCase(TableToMapTestCase)
     tests.addTest(unittest.TestLoader().loadTestsFromTestCase(
@@ -434,6 +643,8 @@ def suite():
             TableCommentToSqlTestCase))
     tests.addTest(unittest.TestLoader().loadTestsFromTestCase(
             TableInheritToSqlTestCase))
+    tests.addTest(unittest.TestLoader().loadTestsFromTestCase(
+            ColumnTypeChangeTestCase))
     return tests
 
 if __name__ == '__main__':
@@ -132,6 +132,31 @@ class ViewToSqlTestCase(PyrseasTestCase):
         self.assertEqual(fix_indent(dbsql[0]), "CREATE OR REPLACE VIEW v1 AS "
                          "SELECT now()::date AS todays_date")
 
+    def test_unchanged_view_hashed(self):
+        "Compare an unchanged view fetched as a hash of its definition"
+        self.db.execute(DROP_STMT)
+        self.db.execute_commit("CREATE VIEW v1 AS SELECT now()::date AS today")
+        inmap = new_std_map()
+        inmap['schema public'].update({'view v1': {
+                    'definition': " SELECT now()::date AS today;"}})
+        db = self.db.database()
+        db.dbconn.hash_definitions = True
+        self.assertEqual(db.diff_map(inmap), [])
+        self.assertEqual(db.db.tables.hashed, {})
+
+    def test_change_view_defn_hashed(self):
+        "Change a view definition fetched as a hash"
+        self.db.execute(DROP_STMT)
+        self.db.execute_commit("CREATE VIEW v1 AS SELECT now()::date AS today")
+        inmap = new_std_map()
+        inmap['schema public'].update({'view v1': {
+                    'definition': " SELECT now()::date AS todays_date;"}})
+        db = self.db.database()
+        db.dbconn.hash_definitions = True
+        dbsql = db.diff_map(inmap)
+        self.assertEqual(fix_indent(dbsql[0]), "CREATE OR REPLACE VIEW v1 AS "
+                         "SELECT now()::date AS todays_date")
+
 
 def suite():
     tests = unittest.TestLoader().loadTestsFromTestCase(ViewToMapTestCase)
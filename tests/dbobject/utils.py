@@ -58,12 +58,20 @@ def pgexecute_auto(dbconn, query):
     return curs
 
 
-TEST_DBNAME = os.environ.get("PYRSEAS_TEST_DB", 'pyrseas_testdb')
+TEST_BASE_DBNAME = os.environ.get("PYRSEAS_TEST_DB", 'pyrseas_testdb')
+TEST_WORKER = os.environ.get("PYRSEAS_TEST_WORKER", None)
+TEST_DBNAME = TEST_WORKER and "%s_%s" % (TEST_BASE_DBNAME, TEST_WORKER) \
+    or TEST_BASE_DBNAME
+TEST_TEMPLATE = TEST_BASE_DBNAME + '_template'
 TEST_USER = os.environ.get("PYRSEAS_TEST_USER", os.getenv("USER"))
 TEST_HOST = os.environ.get("PYRSEAS_TEST_HOST", None)
 TEST_PORT = os.environ.get("PYRSEAS_TEST_PORT", None)
 ADMIN_DB = os.environ.get("PYRSEAS_ADMIN_DB", 'postgres')
+TEST_RESET = os.environ.get("PYRSEAS_TEST_RESET", 'template')
 CREATE_DDL = "CREATE DATABASE %s TEMPLATE = template0"
+CLONE_DDL = "CREATE DATABASE %s TEMPLATE = %s"
+TERMINATE_QUERY = """SELECT pg_terminate_backend(%s) FROM pg_stat_activity
+                     WHERE datname = '%s' AND %s != pg_backend_pid()"""
 
 
 class PostgresDb(object):
@@ -73,12 +81,15 @@ class PostgresDb(object):
     tests need to create and drop databases and other objects,
     independently.
     """
-    def __init__(self, name, user, host, port):
+    def __init__(self, name, user, host, port, reset=TEST_RESET,
+                 template=None):
         self.name = name
         self.conn = None
         self.user = user
         self.host = host
         self.port = port and int(port)
+        self.reset_strategy = reset
+        self.template = template or name + '_template'
         self._version = 0
 
     def connect(self):
@@ -121,6 +132,54 @@ class PostgresDb(object):
         curs.close()
         conn.close()
 
+    def create_template(self, conn=None):
+        """Create the template database if it doesn't exist
+
+        :param conn: a connection to the admin database, if open
+        """
+        admin = conn or pgconnect(ADMIN_DB, self.user, self.host, self.port)
+        curs = pgexecute(admin,
+                         "SELECT 1 FROM pg_database WHERE datname = '%s'" %
+                         self.template)
+        row = curs.fetchone()
+        curs.close()
+        admin.rollback()
+        if not row:
+            curs = pgexecute_auto(admin, CREATE_DDL % self.template)
+            curs.close()
+        if not conn:
+            admin.close()
+
+    def reset(self):
+        """Return the database to an empty state and connect to it
+
+        With the 'template' strategy, the database is dropped and
+        re-created as a copy of a pristine template database, itself
+        created from template0 if it doesn't exist.  This takes a
+        few statements, instead of one per object dropped by
+        `clear`, which is used with the 'clear' strategy.
+        """
+        if self.reset_strategy == 'clear':
+            self.connect()
+            self.clear()
+            return
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+        conn = pgconnect(ADMIN_DB, self.user, self.host, self.port)
+        curs = pgexecute(conn, "SHOW server_version_num")
+        pid = int(curs.fetchone()[0]) < 90200 and 'procpid' or 'pid'
+        curs.close()
+        self.create_template(conn)
+        curs = pgexecute_auto(conn, TERMINATE_QUERY % (pid, self.name, pid))
+        curs.close()
+        curs = pgexecute_auto(conn, "DROP DATABASE IF EXISTS %s" % self.name)
+        curs.close()
+        curs = pgexecute_auto(conn, CLONE_DDL % (self.name, self.template))
+        curs.close()
+        conn.close()
+        self.connect()
+
     def clear(self):
         "Drop tables and other objects"
         curs = pgexecute(
@@ -228,18 +287,24 @@ class PostgresDb(object):
         curs.close()
         return row and True
 
+    def dbconnection(self):
+        "Return a DbConnection object for the test database"
+        return DbConnection(self.name, self.user, self.host, self.port)
+
+    def database(self):
+        "Return a Database object for the test database"
+        return Database(self.dbconnection())
+
     def execute_and_map(self, ddlstmt):
         "Execute a DDL statement, commit, and return a map of the database"
         self.execute(ddlstmt)
         self.conn.commit()
-        db = Database(DbConnection(self.name, self.user, self.host, self.port))
-        return db.to_map()
+        return self.database().to_map()
 
-    def process_map(self, input_map):
+    def process_map(self, input_map, online=False):
         """Process an input map and return the SQL statements necessary to
         convert the database to match the map."""
-        db = Database(DbConnection(self.name, self.user, self.host, self.port))
-        stmts = db.diff_map(input_map)
+        stmts = self.database().diff_map(input_map, online)
         return stmts
 
 
@@ -247,9 +312,9 @@ class PyrseasTestCase(TestCase):
     """Base class for most test cases"""
 
     def setUp(self):
-        self.db = PostgresDb(TEST_DBNAME, TEST_USER, TEST_HOST, TEST_PORT)
-        self.db.connect()
-        self.db.clear()
+        self.db = PostgresDb(TEST_DBNAME, TEST_USER, TEST_HOST, TEST_PORT,
+                             template=TEST_TEMPLATE)
+        self.db.reset()
 
     def tearDown(self):
         self.db.close()